@@ -0,0 +1,149 @@
+"""
+Сравнение чанкеров: фиксированный (800 символов) и по абзацам с бюджетом токенов.
+
+Для каждого чанкера показывает число чанков, обращений к модели
+эмбеддингов, размер индекса (векторы + тексты) и recall@k. Запросы -
+предложения корпуса без первых и последних слов; попадание засчитывается,
+если среди top-k найденных чанков есть чанк, содержащий предложение
+целиком (разрезанное предложение не считается найденным).
+
+По умолчанию эмбеддинги - хэшированные символьные триграммы, чтобы
+бенчмарк работал без LM Studio; с --lmstudio используется настоящая
+модель. Без корпуса (txt файлы после parser.py) генерируется синтетический.
+
+Запуск:
+    python -m benchmarks.bench_chunker --corpus src/storage/files --k 4
+"""
+
+import argparse
+import math
+import re
+import time
+import zlib
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from src.embeddings.indexer import BATCH_SIZE
+from src.ingestion.chunker import SENTENCE_BOUNDARY_RE, chunk_structured, chunk_text, count_tokens
+
+WORD_RE = re.compile(r"\w+")
+
+
+def synthetic_corpus(n_docs: int):
+    """Документы, похожие на страницы кейсов: заголовки разделов и абзацы"""
+    rng = np.random.default_rng(0)
+    # Словарь из псевдослов: иначе все предложения похожи и recall ничего не различает
+    syllables = "ка ро ми на ту ле за по си ве да ры ко жу ни ба".split()
+    vocab = ["".join(rng.choice(syllables, rng.integers(2, 5))) for _ in range(5000)]
+    docs = []
+    for d in range(n_docs):
+        lines = [f"Кейс {d}: проект для компании {d}"]
+        for section in range(rng.integers(3, 7)):
+            lines.append(f"Раздел {section}")
+            for _ in range(rng.integers(1, 4)):
+                sentences = []
+                for _ in range(rng.integers(2, 6)):
+                    words = rng.choice(vocab, rng.integers(8, 16))
+                    sentences.append(" ".join(words).capitalize() + f" {d}-{section}.")
+                lines.append(" ".join(sentences))
+        docs.append("\n".join(lines))
+    return docs
+
+
+def load_corpus(directory: Path, n_docs: int):
+    docs = [p.read_text(encoding="utf-8") for p in sorted(directory.glob("*.txt"))] if directory.exists() else []
+    docs = [d for d in docs if d.strip()]
+    if docs:
+        return docs, f"{directory} ({len(docs)} docs)"
+    return synthetic_corpus(n_docs), f"synthetic ({n_docs} docs)"
+
+
+def make_queries(docs, limit: int):
+    """(запрос, предложение) - предложения из 8+ слов без крайних слов"""
+    queries = []
+    for doc in docs:
+        for line in doc.split("\n"):
+            for sentence in SENTENCE_BOUNDARY_RE.split(line.strip()):
+                words = sentence.split()
+                if len(words) >= 8:
+                    queries.append((" ".join(words[2:-2]), sentence))
+    step = max(1, len(queries) // limit)
+    return queries[::step][:limit]
+
+
+def hashing_embeddings(texts, dim: int = 512):
+    """Мешок хэшированных символьных триграмм слов, нормированный"""
+    vectors = np.zeros((len(texts), dim), dtype="float32")
+    for row, text in enumerate(texts):
+        for word in WORD_RE.findall(text.lower()):
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                vectors[row, zlib.crc32(padded[i:i + 3].encode("utf-8")) % dim] += 1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+def lmstudio_embeddings(texts):
+    from src.embeddings.provider import get_embeddings
+
+    vectors = []
+    for i in range(0, len(texts), BATCH_SIZE):
+        batch = get_embeddings(texts[i:i + BATCH_SIZE])
+        if len(batch) != len(texts[i:i + BATCH_SIZE]):
+            raise RuntimeError("Embedding request failed, is LM Studio running?")
+        vectors.extend(batch)
+    vectors = np.array(vectors, dtype="float32")
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+
+def evaluate(name: str, chunks, queries, embed, k: int):
+    start = time.perf_counter()
+    vectors = embed(chunks)
+    embed_time = time.perf_counter() - start
+
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    _, found = index.search(embed([q for q, _ in queries]), k)
+    hits = sum(any(sentence in chunks[i] for i in row if i >= 0)
+               for (_, sentence), row in zip(queries, found))
+
+    text_bytes = sum(len(c.encode("utf-8")) for c in chunks)
+    index_mb = (vectors.nbytes + text_bytes) / (1024 * 1024)
+    tokens = sum(count_tokens(c) for c in chunks)
+    print(f"{name:<12} chunks={len(chunks):6d}  embed_calls={math.ceil(len(chunks) / BATCH_SIZE):5d}  "
+          f"tokens={tokens:8d}  index={index_mb:7.2f} MB  recall@{k}={hits / len(queries):.3f}  "
+          f"embed={embed_time:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default="src/storage/files", help="папка с txt файлами")
+    parser.add_argument("--docs", type=int, default=200, help="документов в синтетическом корпусе")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--lmstudio", action="store_true", help="настоящие эмбеддинги через LM Studio")
+    args = parser.parse_args()
+
+    docs, source = load_corpus(Path(args.corpus), args.docs)
+    queries = make_queries(docs, args.queries)
+    if not queries:
+        print("[BENCH] No sentences long enough for queries")
+        return
+    embed = lmstudio_embeddings if args.lmstudio else hashing_embeddings
+    print(f"[BENCH] corpus: {source}, {len(queries)} queries")
+
+    chunkers = {
+        "fixed": lambda text: chunk_text(text),
+        "structured": lambda text: chunk_structured(text),
+    }
+    for name, chunker in chunkers.items():
+        start = time.perf_counter()
+        chunks = [c for doc in docs for c in chunker(doc)]
+        print(f"[BENCH] {name}: chunked in {time.perf_counter() - start:.3f}s")
+        evaluate(name, chunks, queries, embed, args.k)
+
+
+if __name__ == "__main__":
+    main()
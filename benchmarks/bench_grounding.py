@@ -0,0 +1,97 @@
+"""
+Бенчмарк проверки ответа по контексту (детекции галлюцинаций).
+
+Сравнивает прежнюю проверку (регулярное выражение по всему контексту
+на каждый ответ, 10 произвольных слов из множества) с GroundingChecker:
+по сигнатурам чанков из индекса BM25 и по тексту контекста. Для каждого
+варианта - пропускная способность (ответов в секунду) и доля ответов,
+помеченных как галлюцинация: среди взятых из контекста (меньше - лучше)
+и среди взятых из других кейсов (больше - лучше).
+
+Запуск:
+    python -m benchmarks.bench_grounding --answers 2000
+"""
+
+import argparse
+import re
+import time
+
+import numpy as np
+
+from benchmarks.bench_chunker import synthetic_corpus
+from src.embeddings.lexical import LexicalIndex, build_lexical_index
+from src.ingestion.chunker import SENTENCE_BOUNDARY_RE, chunk_structured
+from src.rag.grounding import GroundingChecker
+
+
+def legacy_is_hallucination(answer: str, context: str) -> bool:
+    """Прежняя detect_hallucinations из бота"""
+    answer_lower = answer.lower()
+    uncertainty_phrases = [
+        "я не уверен", "не знаю", "не могу сказать",
+        "не имею информации", "не могу найти", "не располагаю данными",
+        "у меня нет данных", "информация отсутствует"
+    ]
+    if any(phrase in answer_lower for phrase in uncertainty_phrases):
+        return True
+    if re.search(r'\[\d+\]', answer):
+        return False
+    if len(answer.split()) < 5:
+        return False
+    context_keywords = set(re.findall(r'\b[а-яё]{5,}\b', context.lower()))
+    context_keywords -= {"который", "которые", "которых", "также", "очень", "многие", "другие"}
+    return not any(keyword in answer_lower for keyword in list(context_keywords)[:10])
+
+
+def make_cases(n_docs: int, n_answers: int):
+    """(ID чанков контекста, контекст, ответ, ответ из контекста?)"""
+    chunks, doc_of = [], []
+    for d, doc in enumerate(synthetic_corpus(n_docs)):
+        for chunk in chunk_structured(doc):
+            chunks.append(chunk)
+            doc_of.append(d)
+    doc_of = np.array(doc_of)
+    rng = np.random.default_rng(0)
+    cases = []
+    for i in range(n_answers):
+        ids = rng.choice(len(chunks), 3, replace=False)
+        grounded = i % 2 == 0
+        # Ответ - два предложения из контекста или из чанка другого кейса
+        source = ids[0] if grounded else rng.choice(np.flatnonzero(~np.isin(doc_of, doc_of[ids])))
+        sentences = [s for s in SENTENCE_BOUNDARY_RE.split(chunks[source].replace("\n", " ")) if len(s.split()) >= 5]
+        answer = " ".join(sentences[:2]) or chunks[source]
+        cases.append(([int(j) for j in ids], "\n---\n".join(chunks[j] for j in ids), answer, grounded))
+    return chunks, cases
+
+
+def measure(name: str, check, cases):
+    start = time.perf_counter()
+    flags = [check(case) for case in cases]
+    elapsed = time.perf_counter() - start
+    flags = np.array(flags)
+    grounded = np.array([case[3] for case in cases])
+    print(f"{name:<18} {len(cases) / elapsed:9.0f} answers/s  "
+          f"flagged: grounded {flags[grounded].mean():6.1%}  invented {flags[~grounded].mean():6.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=300)
+    parser.add_argument("--answers", type=int, default=2000)
+    args = parser.parse_args()
+
+    chunks, cases = make_cases(args.docs, args.answers)
+    start = time.perf_counter()
+    lexical = LexicalIndex(build_lexical_index(np.arange(len(chunks)), chunks))
+    print(f"[BENCH] {len(chunks)} chunks, signatures built in {time.perf_counter() - start:.2f} s, "
+          f"{len(cases)} answers")
+
+    checker = GroundingChecker()
+    measure("legacy", lambda case: legacy_is_hallucination(case[2], case[1]), cases)
+    measure("checker (text)", lambda case: checker.is_hallucination(case[2], case[1]), cases)
+    measure("checker (bm25)", lambda case: checker.is_hallucination(case[2], lexical=lexical, chunk_ids=case[0]),
+            cases)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Сравнение типов FAISS индекса: Flat, HNSW, IVF, IVF-PQ.
+
+Для каждого типа показывает время построения, размер индекса в памяти,
+p50/p99 задержки одиночного запроса и recall@k относительно точного
+поиска (Flat). Векторы берутся из текущего src/storage/index.faiss, если
+он есть, иначе генерируется синтетический корпус из кластеров.
+Параметры HNSW/IVF/PQ читаются из тех же переменных окружения, что и
+при построении индекса (HNSW_M, HNSW_EF_SEARCH, IVF_NLIST, IVF_NPROBE, PQ_M).
+
+Запуск:
+    python -m benchmarks.bench_index --metric cosine --k 4
+    python -m benchmarks.bench_index --vectors 50000 --dim 1024
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from src.embeddings.index_factory import (
+    INDEX_TYPES, configure_search, extract_vectors, index_kind, prepare_vectors,
+    rebuild_index, stores_exact_vectors
+)
+
+
+def synthetic_vectors(n_vectors: int, dim: int, seed: int = 0):
+    """Векторы, сгруппированные вокруг центров, как эмбеддинги похожих текстов"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n_vectors // 50), dim)).astype("float32")
+    labels = rng.integers(0, len(centers), n_vectors)
+    return centers[labels] + 0.3 * rng.normal(size=(n_vectors, dim)).astype("float32")
+
+
+def load_vectors(path: Path, n_vectors: int, dim: int):
+    if path.exists():
+        index = faiss.read_index(str(path))
+        if isinstance(index, (faiss.IndexIDMap2, faiss.IndexIVF)) and stores_exact_vectors(index) and index.ntotal:
+            return extract_vectors(index)[1], f"{path} ({index.ntotal} x {index.d})"
+    return synthetic_vectors(n_vectors, dim), f"synthetic ({n_vectors} x {dim})"
+
+
+def make_queries(vectors, n_queries: int):
+    """Запросы - зашумлённые векторы корпуса"""
+    rng = np.random.default_rng(1)
+    picked = vectors[rng.integers(0, len(vectors), n_queries)]
+    scale = float(np.std(vectors)) * 0.1
+    return picked + scale * rng.normal(size=picked.shape).astype("float32")
+
+
+def measure_latency(index, queries, k: int):
+    """Задержки одиночных запросов в миллисекундах и найденные ID"""
+    timings, found = [], []
+    for q in queries:
+        start = time.perf_counter()
+        _, I = index.search(q.reshape(1, -1), k)
+        timings.append((time.perf_counter() - start) * 1000)
+        found.append(I[0])
+    return np.array(timings), np.array(found)
+
+
+def recall(found, exact, k: int) -> float:
+    return float(np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", default="src/storage/index.faiss", help="индекс с векторами корпуса")
+    parser.add_argument("--vectors", type=int, default=20000, help="размер синтетического корпуса")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--metric", choices=("l2", "cosine"), default="l2")
+    parser.add_argument("--types", default=",".join(INDEX_TYPES), help="через запятую")
+    args = parser.parse_args()
+
+    raw, source = load_vectors(Path(args.index), args.vectors, args.dim)
+    ids = np.arange(len(raw), dtype="int64")
+    print(f"[BENCH] vectors: {source}, {args.queries} queries, k={args.k}, metric={args.metric}")
+
+    vectors = np.ascontiguousarray(raw, dtype="float32")
+    if args.metric == "cosine":
+        faiss.normalize_L2(vectors)
+
+    exact = None
+    for index_type in args.types.split(","):
+        start = time.perf_counter()
+        index = configure_search(rebuild_index(ids, vectors, index_type, args.metric))
+        build_time = time.perf_counter() - start
+
+        queries = prepare_vectors(make_queries(raw, args.queries), index)
+        timings, found = measure_latency(index, queries, args.k)
+        if exact is None:
+            # Эталон - точный поиск по тем же векторам
+            exact_index = rebuild_index(ids, vectors, "flat", args.metric)
+            exact = measure_latency(exact_index, queries, args.k)[1]
+
+        size_mb = faiss.serialize_index(index).nbytes / (1024 * 1024)
+        kind = index_kind(index)
+        label = index_type if kind == index_type else f"{index_type}->{kind}"
+        print(f"{label:<12} build={build_time:7.2f}s  size={size_mb:8.1f} MB  "
+              f"p50={np.percentile(timings, 50):7.3f} ms  p99={np.percentile(timings, 99):7.3f} ms  "
+              f"recall@{args.k}={recall(found, exact, args.k):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Микро-бенчмарк очистки HTML в extract_text_from_html.
+
+Генерирует синтетические страницы двух видов: широкие (много блоков)
+и глубокие (сильно вложенные), и показывает, как растёт время разбора
+с размером документа. При линейной очистке время на килобайт не должно
+расти вместе с размером.
+
+Запуск:
+    python -m benchmarks.bench_parser
+"""
+
+import argparse
+import time
+
+from src.ingestion.parser import extract_text_from_html
+
+
+def wide_html(blocks: int) -> str:
+    """Страница из множества плоских блоков, как у конструкторов сайтов"""
+    parts = []
+    for i in range(blocks):
+        parts.append(
+            f'<div class="t-rec" id="rec{i}"><div class="t-container">'
+            f'<p>Абзац {i} с описанием проекта и <b>выделением</b>.</p>'
+            f'<div class="t-spacer"><div></div></div>'
+            f'<a href="/cases/{i}"><img src="/img/{i}.png"></a></div></div>'
+        )
+        if i % 10 == 0:
+            parts.append('<div class="banner"><p>Реклама</p></div>')
+    return "<html><body>" + "".join(parts) + "</body></html>"
+
+
+def deep_html(depth: int, copies: int) -> str:
+    """Страница из повторяющихся глубоко вложенных блоков"""
+    block = "".join(f'<div class="level{d}">' for d in range(depth))
+    block += "<p>Текст на самом дне вложенности</p><span> </span>"
+    block += "</div>" * depth
+    return "<html><body>" + block * copies + "</body></html>"
+
+
+def measure(html: str, repeat: int) -> float:
+    """Лучшее время разбора в секундах"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        extract_text_from_html(html)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cases = [(f"wide {n} blocks", wide_html(n)) for n in (250, 1000, 4000)]
+    cases += [(f"deep {d} levels", deep_html(d, 20)) for d in (25, 50, 100)]
+
+    for name, html in cases:
+        seconds = measure(html, args.repeat)
+        size_kb = len(html.encode("utf-8")) / 1024
+        print(f"{name:<18} {size_kb:8.0f} KB  {seconds * 1000:9.1f} ms  "
+              f"{seconds * 1e6 / size_kb:7.1f} us/KB")
+
+
+if __name__ == "__main__":
+    main()
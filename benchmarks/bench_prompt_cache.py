@@ -0,0 +1,145 @@
+"""
+Бенчмарк времени до первого токена (TTFT) для раскладок промпта и
+кэша промпта сервера.
+
+Варианты: раскладка single (инструкция и контекст в одном системном
+сообщении) или prefix (неизменная инструкция отдельным сообщением), с
+cache_prompt и без. Каждый запрос - новый контекст из синтетического
+корпуса, упакованный в CONTEXT_TOKENS, как в боте.
+
+По умолчанию запросы идут на заглушку, которая ведёт себя как
+llama.cpp server: промпт в формате ChatML, слоты помнят токены прошлого
+запроса, с cache_prompt общее начало с самым похожим слотом не
+пересчитывается, остальное "считается" prefill-ms на токен. С --url -
+настоящий OpenAI-совместимый сервер (llama.cpp, LM Studio).
+
+Запуск:
+    python -m benchmarks.bench_prompt_cache --requests 50
+    python -m benchmarks.bench_prompt_cache --url http://localhost:8080/v1 --model qwen
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import numpy as np
+
+from benchmarks.bench_chunker import synthetic_corpus
+from src.ingestion.chunker import TOKEN_RE, chunk_structured, count_tokens
+from src.rag.prompt_builder import CONTEXT_TOKENS, PROMPT_LAYOUTS, build_messages, pack_context
+from src.rag.streaming import iter_sse_text
+
+
+class LlamaStubHandler(BaseHTTPRequestHandler):
+    """Потоковый /chat/completions с prefill, пропорциональным непрокэшированным токенам"""
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in payload["messages"])
+        tokens = TOKEN_RE.findall(prompt + "<|im_start|>assistant\n")
+
+        server = self.server
+        with server.lock:
+            # Как llama.cpp: слот с самым длинным общим началом промпта
+            shared = [len(os.path.commonprefix([slot, tokens])) for slot in server.slots]
+            slot = int(np.argmax(shared))
+            reused = shared[slot] if payload.get("cache_prompt") else 0
+            server.slots[slot] = tokens
+            server.reused += reused
+            server.total += len(tokens)
+        time.sleep((len(tokens) - reused) * server.prefill_ms / 1000)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for piece in ("Ответ", " по", " контексту"):
+            self.wfile.write(f'data: {json.dumps({"choices": [{"delta": {"content": piece}}]})}\n\n'.encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(prefill_ms: float, slots: int):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LlamaStubHandler)
+    server.lock = threading.Lock()
+    server.slots = [[] for _ in range(slots)]
+    server.prefill_ms = prefill_ms
+    server.reused = server.total = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def make_requests(n_requests: int, budget: int):
+    """(вопрос, контекст, источники): по три чанка разных кейсов на запрос"""
+    docs = synthetic_corpus(max(20, n_requests))
+    chunks = [[{"text": chunk, "url": f"https://eora.ru/cases/{d}"} for chunk in chunk_structured(doc)]
+              for d, doc in enumerate(docs)]
+    rng = np.random.default_rng(0)
+    requests = []
+    for _ in range(n_requests):
+        picked = [chunks[d][rng.integers(len(chunks[d]))]
+                  for d in rng.choice(len(chunks), 3, replace=False)]
+        context, sources, _, _ = pack_context(picked, budget, count_tokens)
+        requests.append((f"Что сделали для компании {picked[0]['url'].rsplit('/', 1)[1]}?", context, sources))
+    return requests
+
+
+async def time_to_first_token(session, url: str, model: str, messages, cache_prompt: bool) -> float:
+    payload = {"model": model, "messages": messages, "stream": True, "max_tokens": 8, "temperature": 0}
+    if cache_prompt:
+        payload["cache_prompt"] = True
+    start = time.perf_counter()
+    async with session.post(f"{url}/chat/completions", json=payload) as response:
+        response.raise_for_status()
+        ttft = None
+        async for _ in iter_sse_text(response.content):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+    return (ttft if ttft is not None else time.perf_counter() - start) * 1000
+
+
+async def run(args):
+    stub = None
+    url = args.url
+    if url is None:
+        stub, url = start_stub(args.prefill_ms, args.slots)
+    requests = make_requests(args.requests, args.budget)
+    prompt_tokens = np.mean([sum(count_tokens(m["content"]) for m in build_messages(*r)) for r in requests])
+    print(f"[BENCH] {url}: {len(requests)} requests, ~{prompt_tokens:.0f} prompt tokens each")
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
+        for layout in PROMPT_LAYOUTS:
+            for cache_prompt in (False, True):
+                if stub is not None:
+                    stub.slots = [[] for _ in range(args.slots)]
+                    stub.reused = stub.total = 0
+                timings = [await time_to_first_token(session, url, args.model,
+                                                     build_messages(*r, layout=layout), cache_prompt)
+                           for r in requests]
+                reused = f"  reused {stub.reused / stub.total:.0%} tokens" if stub is not None else ""
+                print(f"{layout:<7} cache_prompt={str(cache_prompt):<5} TTFT "
+                      f"p50={np.percentile(timings, 50):7.1f} ms  p99={np.percentile(timings, 99):7.1f} ms{reused}")
+    if stub is not None:
+        stub.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="OpenAI-совместимый сервер вместо заглушки")
+    parser.add_argument("--model", default="local-model")
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--budget", type=int, default=CONTEXT_TOKENS, help="бюджет контекста в токенах")
+    parser.add_argument("--prefill-ms", type=float, default=0.5, help="заглушка: мс prefill на токен")
+    parser.add_argument("--slots", type=int, default=1, help="заглушка: слотов KV кэша")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Бенчмарк задержки поиска: загрузка индекса на каждый запрос против
+резидентного SearchEngine, а также цена загрузки движка с mmap и без:
+время запуска и частная (не разделяемая с другими процессами) память.
+Строка batched - поиск всех запросов одним вызовом search_vectors
+(время на запрос).
+
+Работает на синтетическом индексе и готовых векторах запросов, поэтому
+не требует запущенного LM Studio.
+
+Запуск:
+    python -m benchmarks.bench_search --vectors 20000 --dim 1024
+"""
+
+import argparse
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from src.embeddings.indexer import SearchEngine, save_metadata
+from src.storage.chunk_store import ChunkStore
+
+
+def build_synthetic_index(directory: Path, n_vectors: int, dim: int):
+    """
+    Создаёт индекс и метаданные, похожие по размеру на настоящие
+
+    Метаданные пишутся в двух форматах: прежний pickle с текстами
+    (для варианта reload) и числовые массивы + хранилище чанков.
+    """
+    rng = np.random.default_rng(0)
+    vectors = rng.random((n_vectors, dim), dtype=np.float32)
+    ids = np.arange(n_vectors, dtype="int64")
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+    index.add_with_ids(vectors, ids)
+
+    index_path = directory / "index.faiss"
+    pickle_path = directory / "meta.pkl"
+    meta_path = directory / "meta.npy"
+    faiss.write_index(index, str(index_path))
+
+    # ~800 символов, тексты разные, чтобы pickle не сворачивал повторы
+    texts = [f"{i} " + "Пример текста чанка из кейса компании. " * 20 for i in range(n_vectors)]
+    urls = {i: f"https://eora.ru/cases/{i // 10}" for i in range(n_vectors)}
+    metadata = {i: {"file": f"page_{i}_chunk0.txt", "text": texts[i], "url": urls[i]} for i in range(n_vectors)}
+    with open(pickle_path, "wb") as f:
+        pickle.dump(metadata, f)
+
+    ChunkStore(directory).append(texts)
+    save_metadata(meta_path, urls)
+    print(f"[BENCH] metadata: pickle {pickle_path.stat().st_size / 1024:.0f} KB, "
+          f"arrays {meta_path.stat().st_size / 1024:.0f} KB")
+    return index_path, pickle_path, meta_path
+
+
+def search_reload(index_path: Path, pickle_path: Path, query_emb, top_k: int):
+    """Старое поведение: чтение индекса и метаданных на каждый запрос"""
+    index = faiss.read_index(str(index_path))
+    with open(pickle_path, "rb") as f:
+        metadata = pickle.load(f)
+    D, I = index.search(np.array([query_emb]).astype("float32"), top_k)
+    return [metadata[idx] for idx in I[0]]
+
+
+def private_memory_mb() -> float:
+    """RssAnon процесса (Linux): память, которую нельзя разделить с другими процессами"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def load_cost(index_path: Path, meta_path: Path, mmap: bool, query):
+    """Время загрузки с первым запросом и прирост частной памяти"""
+    before = private_memory_mb()
+    start = time.perf_counter()
+    engine = SearchEngine(index_path, meta_path, mmap=mmap)
+    engine.search_vector(query, 4)
+    elapsed = (time.perf_counter() - start) * 1000
+    return engine, elapsed, private_memory_mb() - before
+
+
+def measure(fn, queries):
+    """Возвращает задержки вызовов в миллисекундах"""
+    timings = []
+    for q in queries:
+        start = time.perf_counter()
+        fn(q)
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings)
+
+
+def report(name: str, timings):
+    print(f"{name:<12} p50={np.percentile(timings, 50):8.2f} ms  "
+          f"p99={np.percentile(timings, 99):8.2f} ms  mean={timings.mean():8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_path, pickle_path, meta_path = build_synthetic_index(Path(tmp), args.vectors, args.dim)
+        queries = np.random.default_rng(1).random((args.queries, args.dim), dtype=np.float32)
+
+        engines = {}
+        for mmap in (False, True):
+            engines[mmap], elapsed, memory = load_cost(index_path, meta_path, mmap, queries[0])
+            print(f"[BENCH] load mmap={str(mmap):<5} {elapsed:8.1f} ms, private memory +{memory:.1f} MB")
+
+        print(f"[BENCH] {args.vectors} vectors x {args.dim} dim, {args.queries} queries, top_k={args.top_k}")
+        report("reload", measure(lambda q: search_reload(index_path, pickle_path, q, args.top_k), queries))
+        report("resident", measure(lambda q: engines[False].search_vector(q, args.top_k), queries))
+        report("mmap", measure(lambda q: engines[True].search_vector(q, args.top_k), queries))
+
+        start = time.perf_counter()
+        engines[False].search_vectors(queries, args.top_k)
+        per_query = (time.perf_counter() - start) * 1000 / len(queries)
+        print(f"{'batched':<12} {per_query:8.2f} ms per query")
+
+
+if __name__ == "__main__":
+    main()
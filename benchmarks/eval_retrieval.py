@@ -0,0 +1,147 @@
+"""
+Оценка поиска: только векторы, только BM25 и гибрид (reciprocal rank fusion).
+
+Для каждого режима показывает recall@k (среди top-k есть чанк нужной
+страницы) и время поиска всех запросов одним батчем без учёта эмбеддинга.
+Запросы берутся из файла (строки "вопрос<TAB>url страницы") или
+генерируются из чанков индекса двух видов: fragment - предложение без
+крайних слов, keyword - два самых редких слова чанка (как запрос с
+названием клиента).
+
+По умолчанию работает на синтетическом корпусе с хэшированными
+эмбеддингами; с --lmstudio - на текущем индексе src/storage и настоящей
+модели эмбеддингов.
+
+Запуск:
+    python -m benchmarks.eval_retrieval --k 4
+    python -m benchmarks.eval_retrieval --lmstudio --queries queries.tsv
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from benchmarks.bench_chunker import hashing_embeddings, make_queries, synthetic_corpus
+from src.embeddings.diversity import DIVERSITY_MODES, SEARCH_DIVERSITY
+from src.embeddings.index_factory import rebuild_index
+from src.embeddings.indexer import SEARCH_MODES, SearchEngine, load_metadata, save_metadata
+from src.embeddings.lexical import LexicalIndex, save_lexical_index, tokenize
+from src.ingestion.chunker import chunk_structured
+from src.storage.chunk_store import ChunkStore
+
+
+def build_synthetic(directory: Path, n_docs: int):
+    """Индекс, метаданные, BM25 и тексты синтетического корпуса"""
+    texts, urls = [], []
+    for d, doc in enumerate(synthetic_corpus(n_docs)):
+        for chunk in chunk_structured(doc):
+            texts.append(chunk)
+            urls.append(f"https://eora.ru/cases/{d}")
+    ids = ChunkStore(directory).append(texts)
+    index = rebuild_index(np.array(ids, dtype="int64"), hashing_embeddings(texts), "flat", "l2")
+    faiss.write_index(index, str(directory / "index.faiss"))
+    save_metadata(directory / "meta.npy", dict(zip(ids, urls)))
+    save_lexical_index(directory / "bm25.npz", ids, texts)
+    return f"synthetic ({n_docs} docs, {len(texts)} chunks)"
+
+
+def generate_queries(directory: Path, limit: int):
+    """(тип, запрос, url) из чанков индекса"""
+    doc_of, table = load_metadata(directory / "meta.npy")
+    chunk_store = ChunkStore(directory)
+    lexical = LexicalIndex.load(directory / "bm25.npz")
+    df = np.diff(lexical.term_starts)
+
+    rng = np.random.default_rng(0)
+    live = np.flatnonzero(doc_of >= 0)
+    picked = rng.choice(live, min(limit, len(live)), replace=False)
+    queries = []
+    for record_id in picked:
+        text, url = chunk_store.get(int(record_id)), table[doc_of[record_id]]
+        fragments = make_queries([text], 1)
+        if fragments:
+            queries.append(("fragment", fragments[0][0], url))
+        words = {}
+        for word in text.split():
+            terms = tokenize(word)
+            if terms and terms[0] in lexical.vocab:
+                words.setdefault(word.strip(".,:;!?()«»\"").lower(), df[lexical.vocab[terms[0]]])
+        rare = sorted(words, key=words.get)[:2]
+        if rare:
+            queries.append(("keyword", " ".join(rare), url))
+    return queries
+
+
+def load_queries(path: Path):
+    queries = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if "\t" in line:
+            query, url = line.split("\t", 1)
+            queries.append(("file", query.strip(), url.strip()))
+    return queries
+
+
+def evaluate(engine: SearchEngine, queries, vectors, k: int, mode: str, diversity: str):
+    """Все запросы - одним вызовом search_vectors, как батч бота"""
+    start = time.perf_counter()
+    results = engine.search_vectors(vectors, k, queries=[query for _, query, _ in queries],
+                                    mode=mode, diversity=diversity)
+    elapsed = (time.perf_counter() - start) * 1000
+    hits = {}
+    for (kind, _, url), rows in zip(queries, results):
+        hits.setdefault(kind, []).append(any(r["url"] == url for r in rows))
+    hits["all"] = [found for values in hits.values() for found in values]
+    recalls = "  ".join(f"{kind}={np.mean(values):.3f}" for kind, values in hits.items())
+    print(f"{mode:<8} recall@{k}: {recalls}  "
+          f"batch {elapsed:8.1f} ms ({elapsed / len(queries):6.3f} ms/query)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lmstudio", action="store_true", help="текущий индекс и настоящие эмбеддинги")
+    parser.add_argument("--index-dir", default="src/storage")
+    parser.add_argument("--queries", help="файл: вопрос<TAB>url страницы")
+    parser.add_argument("--docs", type=int, default=300, help="документов в синтетическом корпусе")
+    parser.add_argument("--limit", type=int, default=300, help="сгенерированных запросов")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--diversity", choices=DIVERSITY_MODES, default=SEARCH_DIVERSITY)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.lmstudio:
+            directory, source = Path(args.index_dir), args.index_dir
+        else:
+            directory = Path(tmp)
+            source = build_synthetic(directory, args.docs)
+
+        queries = load_queries(Path(args.queries)) if args.queries else generate_queries(directory, args.limit)
+        if not queries:
+            print("[BENCH] No queries")
+            return
+        texts = [query for _, query, _ in queries]
+        if args.lmstudio:
+            from src.embeddings.indexer import BATCH_SIZE
+            from src.embeddings.provider import get_embeddings
+            vectors = []
+            for i in range(0, len(texts), BATCH_SIZE):
+                batch = get_embeddings(texts[i:i + BATCH_SIZE])
+                if len(batch) != len(texts[i:i + BATCH_SIZE]):
+                    raise RuntimeError("Embedding request failed, is LM Studio running?")
+                vectors.extend(batch)
+        else:
+            vectors = hashing_embeddings(texts)
+
+        engine = SearchEngine(directory / "index.faiss", directory / "meta.npy", mmap=False)
+        if not engine.load() or engine._state[4] is None:
+            raise RuntimeError(f"No index with BM25 in {directory}, run build_index first")
+        print(f"[BENCH] index: {source}, {len(queries)} queries, diversity={args.diversity}")
+        for mode in SEARCH_MODES:
+            evaluate(engine, queries, vectors, args.k, mode, args.diversity)
+
+
+if __name__ == "__main__":
+    main()
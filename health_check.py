@@ -8,6 +8,8 @@ import sys
 import requests
 from pathlib import Path
 from dotenv import load_dotenv
+from src.rag.backends import LLM_BACKENDS
+from src.storage.db import DB_PATH, DocumentStore
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -30,32 +32,30 @@ def check_environment():
     return True
 
 def check_services():
-    """Проверка доступности LM Studio."""
-    try:
-        base_url = os.getenv("LMSTUDIO_BASE_URL")
-        if not base_url:
-            print("❌ LMSTUDIO_BASE_URL не установлен")
-            return False
-            
-        response = requests.get(f"{base_url}/models", timeout=10)
-        
-        if response.status_code == 200:
-            print("✅ LM Studio доступен")
-            return True
-        else:
-            print(f"❌ LM Studio недоступен (код: {response.status_code})")
-            return False
-            
-    except Exception as e:
-        print(f"❌ Ошибка подключения к LM Studio: {str(e)}")
-        print("   Убедитесь, что LM Studio запущен и доступен по указанному URL")
-        return False
+    """Проверка доступности LM Studio (всех серверов из LLM_BACKENDS)."""
+    available = 0
+    for base_url in LLM_BACKENDS:
+        try:
+            response = requests.get(f"{base_url}/models", timeout=10)
+
+            if response.status_code == 200:
+                print(f"✅ LM Studio доступен: {base_url}")
+                available += 1
+            else:
+                print(f"❌ LM Studio недоступен: {base_url} (код: {response.status_code})")
+
+        except Exception as e:
+            print(f"❌ Ошибка подключения к LM Studio {base_url}: {str(e)}")
+            print("   Убедитесь, что LM Studio запущен и доступен по указанному URL")
+
+    # Бот работает, пока отвечает хотя бы один сервер
+    return available > 0
 
 def check_files():
     """Проверка наличия необходимых файлов."""
     required_files = [
         "sources.txt",
-        "src/storage/files/url_mapping.json"
+        "src/storage/documents.db"
     ]
     
     missing_files = []
@@ -72,12 +72,37 @@ def check_files():
     print("✅ Все необходимые файлы присутствуют")
     return True
 
+def check_database():
+    """Проверка содержимого базы документов."""
+    if not DB_PATH.exists():
+        print("❌ База документов не найдена. Запустите run_ingestion.bat")
+        return False
+
+    store = DocumentStore()
+    try:
+        documents = store.count_documents()
+        failed = store.count_documents("failed")
+        chunks = store.count_chunks()
+        vectors = store.count_vectors()
+    finally:
+        store.close()
+
+    if documents == 0:
+        print("❌ База документов пуста. Запустите run_ingestion.bat")
+        return False
+
+    print(f"✅ База документов: {documents} документов, {chunks} чанков, {vectors} векторов")
+    if failed:
+        print(f"⚠️  Не удалось загрузить {failed} документов")
+    return True
+
 def check_index():
     """Проверка наличия и валидности векторного индекса."""
     index_path = Path("src/storage/index.faiss")
-    meta_path = Path("src/storage/meta.pkl")
+    meta_path = Path("src/storage/meta.npy")
+    chunks_path = Path("src/storage/chunks.bin")
     
-    if not index_path.exists() or not meta_path.exists():
+    if not index_path.exists() or not meta_path.exists() or not chunks_path.exists():
         print("⚠️  Векторный индекс отсутствует. Запустите run_ingestion.bat")
         return False
         
@@ -97,6 +122,7 @@ def main():
         check_environment(),
         check_services(),
         check_files(),
+        check_database(),
         check_index()
     ]
     
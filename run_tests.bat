@@ -1,7 +1,7 @@
 @echo off
 echo Запуск тестов...
 
-python -m pytest tests/test_basic.py -v
+python -m pytest tests -v
 
 if %errorlevel% equ 0 (
     echo ✅ Все тесты прошли успешно
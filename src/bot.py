@@ -1,23 +1,52 @@
 import os
 import asyncio
 import re
+import time
 import aiohttp
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.types import Message
-from src.embeddings.indexer import search
-from src.rag.prompt_builder import build_system_prompt
+from src.embeddings.batcher import QueryBatcher
+from src.embeddings.indexer import SearchEngine
+from src.embeddings.retrieval import AsyncRetriever
+from src.rag.answer_cache import ANSWER_CACHE, AnswerCache
+from src.rag.backends import BackendUnavailableError, get_pool
+from src.rag.grounding import GroundingChecker
+from src.rag.limiter import LLM_CONCURRENCY, GenerationLimiter, QueueFullError
+from src.rag.prompt_builder import PROMPT_CACHE, build_messages, get_token_counter, pack_context
 from src.rag.response_formatter import add_html_links
+from src.rag.streaming import LLM_STREAM, ProgressiveEditor, iter_sse_text
 
 # Инициализация бота
 bot = Bot(token=os.getenv("TELEGRAM_TOKEN"))
 dp = Dispatcher()
 
+# Индекс загружается один раз при старте и живёт в памяти процесса
+search_engine = SearchEngine()
+
 # Настройки
-CHAT_URL = os.getenv("LMSTUDIO_BASE_URL", "http://localhost:1234/v1")
 LLM_MODEL = os.getenv("LMSTUDIO_MODEL", "TheBloke/Saiga2-7B-GGUF")
 TOP_K = int(os.getenv("TOP_K", 2))
 REQUEST_TIMEOUT = 120  # Таймаут запросов в секундах
+KEEPALIVE_TIMEOUT = 60  # Секунд держать простаивающее соединение с LM Studio
+
+# Одна сессия на всё время работы: соединения с LM Studio переиспользуются
+http_session = None
+# Не больше LLM_CONCURRENCY генераций на сервер одновременно, остальные ждут в очереди
+generation_limiter = GenerationLimiter(max_active=LLM_CONCURRENCY * len(get_pool().backends))
+
+# Эмбеддинг запроса - асинхронно, FAISS - в собственном пуле потоков
+retriever = AsyncRetriever(search_engine, lambda: get_http_session())
+
+async def search_batch(queries: list) -> list:
+    return await retriever.search_many(queries, TOP_K, return_snapshot=True)
+
+# Запросы одновременных пользователей ищутся одним вызовом модели и FAISS
+search_batcher = QueryBatcher(search_batch, name="SEARCH")
+# Готовые ответы на похожие вопросы с тем же найденным контекстом
+answer_cache = AnswerCache() if ANSWER_CACHE else None
+# Проверка ответа по сигнатурам чанков контекста из индекса BM25
+grounding_checker = GroundingChecker()
 
 # Сообщения
 WELCOME_MESSAGE = """
@@ -49,48 +78,64 @@ HELP_MESSAGE = """
 • Что вы делали для Dodo Pizza?
 • Какие проекты у вас есть в сфере AI?
 
-⏱️ Генерация ответа может занять до 1 минуты. Пожалуйста, наберитесь терпения!
+⏱️ Ответ появляется по мере генерации, полностью он может занять до 1 минуты.
 
 Если что-то пошло не так, используйте команду /start для перезапуска.
 """
 
-async def ask_lmstudio(question: str, context: str, sources: list) -> str:
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая HTTP сессия бота (создаётся при первом обращении внутри event loop)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=LLM_CONCURRENCY * 2, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        http_session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        )
+    return http_session
+
+async def ask_lmstudio(question: str, context: str, sources: list, on_text=None) -> str:
     """
     Асинхронный запрос к LLM для генерации ответа
     Возвращает сгенерированный текст или сообщение об ошибке
+
+    С on_text ответ запрашивается потоком (SSE), и корутина on_text
+    получает накопленный текст после каждого фрагмента.
     """
-    url = f"{CHAT_URL}/chat/completions"
-    
-    # Формируем системный промпт
-    system_prompt = build_system_prompt(context, sources)
-    
-    # Формируем запрос
+    # Формируем запрос: неизменная инструкция отдельно от контекста и вопроса
     payload = {
         "model": LLM_MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": question}
-        ],
+        "messages": build_messages(question, context, sources),
         "temperature": 0.3,
         "max_tokens": 1024,
-        "stop": ["\n\n"]
+        "stop": ["\n\n"],
+        "stream": on_text is not None
     }
+    if PROMPT_CACHE:
+        # llama.cpp совместимые серверы переиспользуют KV кэш общего начала промпта
+        payload["cache_prompt"] = True
     
-    # Выполняем запрос с таймаутом
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as session:
-        try:
-            async with session.post(url, json=payload) as response:
-                response.raise_for_status()
+    # Выполняем запрос с таймаутом через общую сессию на наименее загруженный сервер
+    session = get_http_session()
+    try:
+        async with get_pool().post(session, "/chat/completions", payload) as response:
+            response.raise_for_status()
+            if on_text is None:
                 data = await response.json()
                 return data["choices"][0]["message"]["content"]
-        except asyncio.TimeoutError:
-            return "⚠️ Генерация ответа заняла слишком много времени."
-        except aiohttp.ClientError as e:
-            print(f"HTTP ошибка: {str(e)}")
-            return "⚠️ Ошибка соединения с сервером генерации."
-        except Exception as e:
-            print(f"Ошибка запроса: {str(e)}")
-            return "⚠️ Произошла ошибка при генерации ответа."
+
+            answer = ""
+            async for piece in iter_sse_text(response.content):
+                answer += piece
+                await on_text(answer)
+            return answer
+    except asyncio.TimeoutError:
+        return "⚠️ Генерация ответа заняла слишком много времени."
+    except (aiohttp.ClientError, BackendUnavailableError) as e:
+        print(f"HTTP ошибка: {str(e)}")
+        return "⚠️ Ошибка соединения с сервером генерации."
+    except Exception as e:
+        print(f"Ошибка запроса: {str(e)}")
+        return "⚠️ Произошла ошибка при генерации ответа."
 
 @dp.message(Command("start"))
 async def handle_start(message: Message):
@@ -130,56 +175,21 @@ async def handle_examples(message: Message):
     )
     await message.answer(examples, parse_mode=None)
 
-async def detect_hallucinations(answer: str, context: str) -> bool:
+async def detect_hallucinations(answer: str, context: str, chunk_ids: list = None, lexical=None) -> bool:
     """
     Обнаружение возможных галлюцинаций LLM.
     Возвращает True если ответ вероятно содержит галлюцинации.
+
+    С chunk_ids ответ сверяется с сигнатурами чанков из индекса BM25
+    lexical - того, по которому они найдены, иначе - с терминами текста
+    контекста.
     """
-    answer_lower = answer.lower()
-    
-    # Очень консервативный подход: только явные признаки галлюцинаций
-    uncertainty_phrases = [
-        "я не уверен", "не знаю", "не могу сказать", 
-        "не имею информации", "не могу найти", "не располагаю данными",
-        "у меня нет данных", "информация отсутствует"
-    ]
-    
-    # Если ответ содержит фразы неопределенности - это галлюцинация
-    if any(phrase in answer_lower for phrase in uncertainty_phrases):
-        return True
-    
-    # Если ответ содержит ссылки на источники, вероятно это не галлюцинация
-    if re.search(r'\[\d+\]', answer):
-        return False
-        
-    # Если ответ очень короткий (менее 5 слов) - не проверяем дальше
-    if len(answer.split()) < 5:
-        return False
-    
-    # Очень простой тест на релевантность: проверяем наличие некоторых ключевых слов из контекста
-    context_lower = context.lower()
-    
-    # Извлекаем существительные и прилагательные из контекста (слова длиной > 4 символов)
-    context_keywords = set(re.findall(r'\b[а-яё]{5,}\b', context_lower))
-    
-    # Исключаем самые частые слова
-    common_words = {"который", "которые", "которых", "также", "очень", "многие", "другие"}
-    context_keywords = context_keywords - common_words
-    
-    # Берем первые 10 ключевых слов из контекста
-    context_sample = list(context_keywords)[:10]
-    
-    # Если в ответе есть хотя бы одно ключевое слово из контекста, считаем релевантным
-    for keyword in context_sample:
-        if keyword in answer_lower:
-            return False
-    
-    # Если не нашли ни одного совпадения, возможно это галлюцинация
-    return True
+    return grounding_checker.is_hallucination(answer, context, lexical, chunk_ids)
 
 @dp.message()
 async def handle_message(message: Message):
     """Обработка пользовательских сообщений"""
+    received = time.perf_counter()
     query = message.text.strip()
     if not query:
         await message.answer("Пожалуйста, введите текст вопроса", parse_mode=None)
@@ -205,10 +215,12 @@ async def handle_message(message: Message):
     
     try:
         # Поиск релевантных чанков
-        chunks = await asyncio.to_thread(search, query, TOP_K)
+        # generation - поколение индекса, по которому искали: ключ кэша ответов
+        query_emb, chunks, lexical, generation = await search_batcher.submit(query) or (None, [], None, None)
         
-        # Если ничего не найдено
+        # Если ничего не найдено или всё дальше порога SEARCH_MAX_DISTANCE - без LLM
         if not chunks:
+            print(f"[SEARCH] No relevant chunks for: {query[:50]}")
             await processing_msg.edit_text(
                 "❌ В нашей базе знаний нет информации по этому вопросу. "
                 "Попробуйте задать вопрос о решениях EORA.\n\n"
@@ -217,21 +229,47 @@ async def handle_message(message: Message):
             )
             return
             
-        # Формируем контекст из найденных чанков
-        context_text = "\n---\n".join([c["text"] for c in chunks])
-        
-        # Извлекаем уникальные URL источников
-        sources = []
-        for c in chunks:
-            url = c.get("url", "")
-            if url and url != "unknown_url" and url not in sources:
-                sources.append(url)
+        # Похожий вопрос с тем же контекстом уже задавали - отвечаем сразу
+        chunk_ids = [c["id"] for c in chunks]
+        if answer_cache is not None:
+            cached = answer_cache.get(query_emb, chunk_ids, generation)
+            if cached is not None:
+                stats = answer_cache.stats()
+                print(f"[CACHE] Answer hit, hit rate {stats['hit_rate']:.1%} "
+                      f"({stats['hits']}/{stats['hits'] + stats['misses']})")
+                cached_answer, parse_mode = cached
+                await processing_msg.edit_text(cached_answer, parse_mode=parse_mode,
+                                               disable_web_page_preview=True)
+                return
+
+        # Собираем контекст в бюджет токенов; источники нумеруются по попавшим в него чанкам
+        context_text, sources, context_tokens, packed_ids = pack_context(chunks)
+        print(f"[PROMPT] Context: {context_tokens} tokens, {len(sources)} sources")
         
         # Обновляем статус
         await processing_msg.edit_text("🤖 Формирую ответ...", parse_mode=None)
         
-        # Генерация ответа
-        answer = await ask_lmstudio(query, context_text, sources)
+        # Генерация ответа: по мере поступления токенов правим сообщение
+        editor = ProgressiveEditor(lambda text: processing_msg.edit_text(text, parse_mode=None),
+                                   started=received)
+        async def show_position(position: int):
+            status = f"⏳ Вы в очереди на генерацию ответа: {position}" if position else "🤖 Формирую ответ..."
+            await processing_msg.edit_text(status, parse_mode=None)
+
+        try:
+            async with generation_limiter.slot(on_position=show_position):
+                answer = await ask_lmstudio(query, context_text, sources,
+                                            on_text=editor.update if LLM_STREAM else None)
+        except QueueFullError as e:
+            print(f"[LLM] Request shed: {str(e)}, {generation_limiter.stats()}")
+            await processing_msg.edit_text(
+                "⚠️ Сейчас слишком много запросов. Пожалуйста, повторите вопрос через минуту.",
+                parse_mode=None
+            )
+            return
+        if editor.time_to_first_edit is not None:
+            print(f"[LLM] first visible token {editor.time_to_first_edit * 1000:.0f} ms, "
+                  f"total {(editor.clock() - editor.started) * 1000:.0f} ms, {editor.edits} edits")
         
         # Проверка пустого ответа
         if not answer.strip():
@@ -239,7 +277,7 @@ async def handle_message(message: Message):
 
         # Детекция галлюцинаций (только для нестандартных ответов)
         if not answer.startswith("⚠️"):
-            if await detect_hallucinations(answer, context_text):
+            if await detect_hallucinations(answer, context_text, packed_ids, lexical):
                 answer = (
                     "⚠️ Не удалось найти точную информацию в нашей базе знаний. "
                     "Попробуйте переформулировать вопрос или уточнить детали.\n\n"
@@ -262,30 +300,50 @@ async def handle_message(message: Message):
         if not is_eora_related:
             clean_answer = re.sub(r'<a href=[^>]+>\[(\d+)\]</a>', r'[\1]', html_answer)
             clean_answer = re.sub(r'\[\d+\]', '', clean_answer)
+            final_answer, parse_mode = clean_answer, None
             await processing_msg.edit_text(
                 clean_answer, 
                 parse_mode=None
             )
         else:
+            final_answer, parse_mode = html_answer, "HTML"
             await processing_msg.edit_text(
                 html_answer, 
                 parse_mode="HTML",
                 disable_web_page_preview=True
             )
+
+        # Ошибки и отказы не кэшируем
+        if answer_cache is not None and not answer.startswith("⚠️"):
+            answer_cache.put(query_emb, chunk_ids, generation, final_answer, parse_mode)
     except Exception as e:
         print(f"Ошибка обработки: {str(e)}")
         await message.answer("⚠️ Произошла ошибка при обработке запроса", parse_mode=None)
 
 async def main():
     """Основная функция запуска бота"""
+    # Загрузка векторного индекса до приёма сообщений
+    if not await asyncio.to_thread(search_engine.load):
+        print("[WARN] Векторный индекс не найден, запустите run_ingestion.bat")
+    # Токенизатор для бюджета контекста загружается до первого вопроса
+    await asyncio.to_thread(get_token_counter)
+
     # Установка команд меню
     await bot.set_my_commands([
         types.BotCommand(command="start", description="Начать работу"),
         types.BotCommand(command="help", description="Помощь по использованию")
     ])
     
+    # Фоновая проверка серверов LLM: упавшие отключаются, поднявшиеся возвращаются
+    health_task = asyncio.create_task(get_pool().run_health_checks(get_http_session()))
+
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        health_task.cancel()
+        retriever.close()
+        await http_session.close()
 
 if __name__ == "__main__":
     print("Запуск EORA Knowledge Assistant...")
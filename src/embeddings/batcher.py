@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import numpy as np
+from dotenv import load_dotenv
+
+from src.embeddings.provider import get_embeddings
+
+load_dotenv()
+
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", 5))  # Сколько ждать соседние запросы
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", 32))  # Батч уходит сразу при стольких запросах
+STATS_WINDOW = 1000  # Последних запросов для перцентилей задержки
+LOG_EVERY = 100  # Батчей между выводом статистики
+
+class QueryBatcher:
+    """
+    Микробатчинг запросов от одновременных пользователей.
+
+    Первый запрос открывает окно в EMBED_BATCH_WINDOW_MS; всё, что пришло
+    за это время (но не больше EMBED_BATCH_MAX), обрабатывается одним
+    вызовом batch_fn(texts) (обычная функция - в отдельном потоке,
+    корутина - в event loop), а результаты раздаются ждущим обработчикам.
+    По умолчанию batch_fn - get_embeddings, бот передаёт
+    AsyncRetriever.search_many, чтобы одним вызовом шли и модель, и FAISS.
+    Одинаковые тексты в батче считаются один раз. Работает внутри одного
+    event loop.
+    """
+
+    def __init__(self, batch_fn=get_embeddings, window_ms: float = EMBED_BATCH_WINDOW_MS,
+                 max_items: int = EMBED_BATCH_MAX, name: str = "EMBED"):
+        self.batch_fn = batch_fn
+        self.name = name
+        self.window = window_ms / 1000
+        self.max_items = max(1, max_items)
+        self._pending = []  # (текст, future, время постановки в очередь)
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+        self.max_batch = 0
+        self._delays = deque(maxlen=STATS_WINDOW)
+
+    async def submit(self, text: str):
+        """Результат batch_fn для текста или None, если вызов не удался"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future, time.perf_counter()))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        started = time.perf_counter()
+        self._record(batch, started)
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            if asyncio.iscoroutinefunction(self.batch_fn):
+                results = await self.batch_fn(texts)
+            else:
+                results = await asyncio.to_thread(self.batch_fn, texts)
+        except Exception as e:
+            print(f"[{self.name} ERROR] {str(e)}")
+            results = []
+
+        by_text = dict(zip(texts, results)) if len(results) == len(texts) else {}
+        for text, future, _ in batch:
+            # Обработчик мог быть отменён, пока ждал батч
+            if not future.done():
+                future.set_result(by_text.get(text))
+
+    def _record(self, batch, started: float):
+        self.batches += 1
+        self.items += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self._delays.extend(started - enqueued for _, _, enqueued in batch)
+        if self.batches % LOG_EVERY == 0:
+            stats = self.stats()
+            print(f"[{self.name}] batches={stats['batches']} avg_batch={stats['avg_batch']:.2f} "
+                  f"max_batch={stats['max_batch']} queue p50={stats['queue_p50_ms']:.1f} ms "
+                  f"p99={stats['queue_p99_ms']:.1f} ms")
+
+    def stats(self) -> dict:
+        """Размеры батчей и задержка в очереди (по последним STATS_WINDOW запросам)"""
+        delays = np.array(self._delays) * 1000 if self._delays else np.zeros(1)
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": self.items / self.batches if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "queue_p50_ms": float(np.percentile(delays, 50)),
+            "queue_p99_ms": float(np.percentile(delays, 99))
+        }
@@ -0,0 +1,160 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+# Максимальное число параметров в одном SQL запросе
+SQL_BATCH = 500
+# Время использования записей пишется в базу пачками: не чаще раза в
+# TOUCH_INTERVAL секунд или при накоплении TOUCH_BATCH записей
+TOUCH_INTERVAL = 30.0
+TOUCH_BATCH = 1000
+
+def text_hash(text: str) -> str:
+    """sha256 текста - ключ кэша вместе с именем модели"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Дисковый кэш эмбеддингов на SQLite с вытеснением по LRU.
+
+    Ключ - (модель, sha256 текста), значение - вектор float32. Число записей
+    ограничено max_entries: при переполнении удаляются давно не
+    использованные. Попадания не пишут в базу на каждом чтении: время
+    использования копится в памяти и сбрасывается пачкой. Счётчики
+    hits/misses ведутся для текущего процесса.
+    """
+
+    def __init__(self, path, max_entries: int = 200_000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched = {}  # (модель, хэш текста) -> время последнего попадания
+        self._flushed_at = time.monotonic()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+
+    def __len__(self):
+        # Файл общий с другими процессами (бот и индексатор): счётчик в памяти бы расходился
+        with self._lock:
+            return self._count()
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _flush_touched(self):
+        """Записывает накопленное время использования (без commit)"""
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(used, model, key) for (model, key), used in self._touched.items()]
+            )
+            self._touched.clear()
+        self._flushed_at = time.monotonic()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Пакетный поиск векторов в кэше
+
+        Returns:
+            Список той же длины, что texts: векторы float32 (только для
+            чтения, поверх байтов из базы), None на месте промахов
+        """
+        keys = [text_hash(t) for t in texts]
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+
+        with self._lock:
+            for i in range(0, len(unique_keys), SQL_BATCH):
+                batch = unique_keys[i:i+SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+                found.update(rows)
+
+            # Время использования для LRU копится в памяти и пишется пачкой
+            if found:
+                now = time.time()
+                self._touched.update(((model, key), now) for key in found)
+                if (len(self._touched) >= TOUCH_BATCH
+                        or time.monotonic() - self._flushed_at >= TOUCH_INTERVAL):
+                    self._flush_touched()
+                    self._conn.commit()
+
+            results = []
+            for key in keys:
+                blob = found.get(key)
+                if blob is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append(np.frombuffer(blob, dtype=np.float32))
+            return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """Сохраняет векторы в кэш и вытесняет лишние записи"""
+        now = time.time()
+        rows = {
+            text_hash(t): np.asarray(v, dtype=np.float32).tobytes()
+            for t, v in zip(texts, vectors)
+        }
+        with self._lock:
+            # Перед вытеснением LRU должен видеть все попадания
+            self._flush_touched()
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                [(model, key, blob, now) for key, blob in rows.items()]
+            )
+            # Считаем в той же транзакции: после INSERT запись заблокирована
+            # для других процессов до commit
+            overflow = self._count() - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE (model, text_hash) IN ("
+                    " SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (overflow,)
+                )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """Статистика попаданий для мониторинга"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Разнообразие результатов: url (лучший чанк каждой страницы), mmr или none
+SEARCH_DIVERSITY = os.getenv("SEARCH_DIVERSITY", "url").lower()
+DIVERSITY_MODES = ("none", "url", "mmr")
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.5))  # Вес релевантности против новизны
+
+def first_per_group(groups) -> np.ndarray:
+    """Позиции первого (лучшего) элемента каждой группы в исходном порядке"""
+    _, first = np.unique(np.asarray(groups), return_index=True)
+    return np.sort(first)
+
+def mmr_order(relevance, vectors, top_k: int, lam: float = MMR_LAMBDA) -> np.ndarray:
+    """
+    Порядок выбора кандидатов по maximal marginal relevance
+
+    На каждом шаге берётся кандидат с наибольшим
+    lam * релевантность - (1 - lam) * max косинус с уже выбранными.
+    Релевантность приводится к [0, 1], поэтому подходит любая оценка
+    "больше - лучше" (сходство, BM25, RRF). Косинусы всех пар считаются
+    одним умножением матриц, шаг выбора - векторная операция над кандидатами.
+
+    Returns:
+        Позиции выбранных кандидатов (не больше top_k)
+    """
+    relevance = np.asarray(relevance, dtype="float32")
+    n = min(top_k, len(relevance))
+    if n <= 0:
+        return np.empty(0, dtype="int64")
+    span = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / span if span > 0 else np.ones_like(relevance)
+
+    vectors = np.asarray(vectors, dtype="float32")
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = unit @ unit.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    taken = np.zeros(len(relevance), dtype=bool)
+    taken[selected[0]] = True
+    while len(selected) < n:
+        gain = lam * relevance - (1 - lam) * redundancy
+        gain[taken] = -np.inf
+        best = int(np.argmax(gain))
+        selected.append(best)
+        taken[best] = True
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return np.array(selected, dtype="int64")
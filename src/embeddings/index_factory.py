@@ -0,0 +1,215 @@
+import os
+import math
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Тип индекса: flat (точный перебор), hnsw, ivf, ivfpq
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat").lower()
+# Метрика: l2 или cosine (скалярное произведение нормированных векторов)
+INDEX_METRIC = os.getenv("INDEX_METRIC", "l2").lower()
+HNSW_M = int(os.getenv("HNSW_M", 32))  # Связей на узел графа
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 80))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 64))  # Больше - точнее и медленнее
+IVF_NLIST = int(os.getenv("IVF_NLIST", 0))  # Число кластеров (0 - по размеру индекса)
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", 16))  # Просматриваемых кластеров на запрос
+IVF_MIN_TRAIN = int(os.getenv("IVF_MIN_TRAIN", 1000))  # До этого размера IVF не обучается
+PQ_M = int(os.getenv("PQ_M", 0))  # Байт на вектор (0 - автоматически)
+PQ_NBITS = int(os.getenv("PQ_NBITS", 8))
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+METRICS = {"l2": faiss.METRIC_L2, "cosine": faiss.METRIC_INNER_PRODUCT}
+POINTS_PER_CENTROID = 39  # Минимум, который FAISS считает достаточным для k-means
+
+def index_spec(index_type: str = INDEX_TYPE, metric: str = INDEX_METRIC) -> str:
+    """Строка настроек индекса для сравнения с сохранённой в базе"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown INDEX_TYPE {index_type!r}, expected one of {', '.join(INDEX_TYPES)}")
+    if metric not in METRICS:
+        raise ValueError(f"Unknown INDEX_METRIC {metric!r}, expected l2 or cosine")
+    return f"{index_type}:{metric}"
+
+def needs_training(index_type: str = INDEX_TYPE) -> bool:
+    return index_type in ("ivf", "ivfpq")
+
+def min_train_size(index_type: str = INDEX_TYPE) -> int:
+    """Сколько векторов нужно, чтобы обучить индекс"""
+    if index_type == "ivfpq":
+        return max(IVF_MIN_TRAIN, POINTS_PER_CENTROID * 2 ** PQ_NBITS)
+    return IVF_MIN_TRAIN
+
+def _nlist(n_vectors: int) -> int:
+    if IVF_NLIST:
+        return IVF_NLIST
+    # ~4*sqrt(n) кластеров, но не меньше POINTS_PER_CENTROID векторов на кластер
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // POINTS_PER_CENTROID))
+
+def _pq_m(dim: int) -> int:
+    """Наибольший делитель размерности, не больше 64 байт на вектор"""
+    if PQ_M:
+        return PQ_M
+    return max(m for m in range(1, min(dim, 64) + 1) if dim % m == 0)
+
+def factory_string(index_type: str, dim: int, n_vectors: int) -> str:
+    """Описание индекса для faiss.index_factory"""
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M},Flat"
+    if index_type == "ivf":
+        return f"IVF{_nlist(n_vectors)},Flat"
+    if index_type == "ivfpq":
+        return f"IVF{_nlist(n_vectors)},PQ{_pq_m(dim)}x{PQ_NBITS}"
+    return "Flat"
+
+def create_index(dim: int, index_type: str = "flat", metric: str = INDEX_METRIC, n_vectors: int = 0):
+    """
+    Пустой индекс с внешними ID заданного типа
+
+    Flat и HNSW оборачиваются в IndexIDMap2. IVF хранит ID в своих
+    инвертированных списках и удаляет по ним сам: обёртка IndexIDMap2
+    над IVF ломается на повторном remove_ids после обучения.
+    """
+    inner = faiss.index_factory(dim, factory_string(index_type, dim, n_vectors), METRICS[metric])
+    if index_type == "hnsw":
+        inner.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type == "ivfpq":
+        # Полисемантическое обучение нужно только для поиска по Хэммингу,
+        # а обучение замедляет в десятки раз
+        faiss.downcast_index(inner).do_polysemous_training = False
+    if needs_training(index_type):
+        return inner
+    return faiss.IndexIDMap2(inner)
+
+def prepare_vectors(vectors, index) -> np.ndarray:
+    """float32 матрица; для косинусной метрики - нормированная"""
+    vectors = np.ascontiguousarray(np.array(vectors, dtype="float32").reshape(len(vectors), -1))
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        faiss.normalize_L2(vectors)
+    return vectors
+
+def _inner(index):
+    return faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+
+def index_kind(index) -> str:
+    """Тип индекса (с обёрткой IndexIDMap2 или без): flat / hnsw / ivf / ivfpq"""
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+def supports_remove(index) -> bool:
+    """HNSW не умеет удалять векторы - его приходится перестраивать"""
+    return index_kind(index) != "hnsw"
+
+def stores_exact_vectors(index) -> bool:
+    """Можно ли без потерь достать векторы для перестройки индекса"""
+    return index_kind(index) in ("flat", "hnsw", "ivf")
+
+def _ivf_ids(index) -> np.ndarray:
+    """Внешние ID из инвертированных списков IVF"""
+    invlists = index.invlists
+    sizes = [invlists.list_size(l) for l in range(index.nlist)]
+    return np.concatenate([np.empty(0, dtype="int64")] +
+                          [faiss.rev_swig_ptr(invlists.get_ids(l), n).copy()
+                           for l, n in enumerate(sizes) if n])
+
+def extract_vectors(index):
+    """Все (ID, векторы) индекса: у IDMap2 в порядке добавления, у IVF по возрастанию ID"""
+    if isinstance(index, faiss.IndexIVF):
+        ids = np.sort(_ivf_ids(index))
+        previous = index.direct_map.type
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        vectors = reconstruct_vectors(index, ids)
+        index.set_direct_map_type(previous)
+        return ids, vectors
+    ids = faiss.vector_to_array(index.id_map).astype("int64")
+    inner = faiss.downcast_index(index.index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.make_direct_map()  # IVF в обёртке - формат прежних версий
+    vectors = inner.reconstruct_n(0, index.ntotal) if index.ntotal else np.empty((0, index.d), "float32")
+    return ids, vectors
+
+def rebuild_index(ids, vectors, index_type: str, metric: str):
+    """
+    Строит индекс заданного типа из готовых векторов
+
+    Обучаемые индексы (IVF) при нехватке векторов для обучения остаются
+    точными (Flat) до следующей перестройки.
+    """
+    dim = vectors.shape[1]
+    if needs_training(index_type) and len(vectors) < min_train_size(index_type):
+        index_type = "flat"
+    index = create_index(dim, index_type, metric, len(vectors))
+    if not index.is_trained:
+        index.train(vectors)
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    return index
+
+def configure_search(index, ef_search: int = HNSW_EF_SEARCH, nprobe: int = IVF_NPROBE,
+                     direct_map: bool = True):
+    """
+    Выставляет параметры поиска из настроек (а не те, что записаны в файле индекса)
+
+    direct_map: строить для IVF прямую карту ID -> позиция, чтобы доставать
+    векторы кандидатов. Карта живёт в памяти процесса, поэтому для
+    индекса, открытого через mmap, её не строят.
+    """
+    kind = index_kind(index)
+    if kind == "hnsw":
+        faiss.ParameterSpace().set_index_parameter(index, "efSearch", ef_search)
+    elif kind in ("ivf", "ivfpq"):
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", nprobe)
+        if direct_map:
+            # Хэш-таблица, в отличие от массива, допускает любые ID и удаление
+            _inner(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+def can_reconstruct(index) -> bool:
+    """Можно ли достать векторы по ID: IVF без прямой карты не может"""
+    inner = _inner(index)
+    return not isinstance(inner, faiss.IndexIVF) or inner.direct_map.type != faiss.DirectMap.NoMap
+
+def reconstruct_vectors(index, ids) -> np.ndarray:
+    """Векторы по внешним ID (для ivfpq - приближённые, восстановленные из кодов)"""
+    ids = np.asarray(ids, dtype="int64")
+    if not len(ids):
+        return np.empty((0, index.d), dtype="float32")
+    return index.reconstruct_batch(ids)
+
+def candidate_distances(index, query, ids) -> np.ndarray:
+    """
+    Расстояния от подготовленного вектора запроса до векторов с данными ID
+    без восстановления векторов: поиск IVF по всем кластерам только среди
+    ids (для ivfpq - те же приближённые расстояния, что и в обычном поиске).
+    Не найденным ID - NaN.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    distances = np.full(len(ids), np.nan, dtype="float32")
+    if not len(ids):
+        return distances
+    params = faiss.SearchParametersIVF(sel=faiss.IDSelectorBatch(ids), nprobe=_inner(index).nlist)
+    D, I = index.search(np.asarray(query, dtype="float32").reshape(1, -1), len(ids), params=params)
+    found = I[0] >= 0
+    order = np.argsort(ids)
+    distances[order[np.searchsorted(ids[order], I[0][found])]] = to_distances(D[0][found], index)
+    return distances
+
+def to_distances(raw, index) -> np.ndarray:
+    """
+    Расстояния FAISS в виде "меньше - ближе": для l2 - квадрат расстояния,
+    для cosine - 1 - косинус (FAISS возвращает скалярное произведение)
+    """
+    raw = np.asarray(raw, dtype="float32")
+    return 1.0 - raw if index.metric_type == faiss.METRIC_INNER_PRODUCT else raw
+
+def vector_distances(query, vectors, index) -> np.ndarray:
+    """Расстояния от подготовленного вектора запроса до векторов индекса в той же шкале"""
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return to_distances(vectors @ query, index)
+    return ((vectors - query) ** 2).sum(axis=1).astype("float32")
@@ -1,122 +1,631 @@
 import os
-import pickle
+import threading
+import time
 import faiss
 import numpy as np
-import json
 from pathlib import Path
+from typing import Dict, List, Optional
 from tqdm import tqdm
-from src.embeddings.provider import get_embeddings
+from src.embeddings.provider import get_embeddings, EMBED_MODEL
+from src.embeddings.lexical import LEXICAL_PATH, LexicalIndex, save_lexical_index
+from src.embeddings.diversity import DIVERSITY_MODES, SEARCH_DIVERSITY, first_per_group, mmr_order
+from src.embeddings.index_factory import (
+    INDEX_METRIC, INDEX_TYPE, can_reconstruct, candidate_distances, configure_search, create_index,
+    extract_vectors, index_kind, index_spec, min_train_size, needs_training, prepare_vectors,
+    rebuild_index, reconstruct_vectors, stores_exact_vectors, supports_remove, to_distances,
+    vector_distances
+)
+from src.storage.chunk_store import ChunkStore
+from src.storage.db import DocumentStore
 
 # Константы путей
 INDEX_PATH = Path("src/storage/index.faiss")
-META_PATH = Path("src/storage/meta.pkl")
+META_PATH = Path("src/storage/meta.npy")
 BATCH_SIZE = 32  # Оптимальный размер батча
+# Открывать индекс и метаданные через mmap: несколько процессов бота делят
+# одни страницы в кэше ОС, а запуск не читает файлы целиком
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() == "true"
+# Режим поиска: vector (только FAISS), bm25 (только по словам) или hybrid
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid").lower()
+SEARCH_MODES = ("vector", "bm25", "hybrid")
+RRF_K = 60  # Сглаживание reciprocal rank fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))  # Кандидатов от каждого поиска
+# Порог расстояния до запроса, дальше которого чанки не попадают в контекст
+# (в шкале INDEX_METRIC: квадрат L2 или 1 - косинус); 0 - без порога
+SEARCH_MAX_DISTANCE = float(os.getenv("SEARCH_MAX_DISTANCE", 0))
+# Метка поколения в конце файлов индекса и метаданных: FAISS и numpy
+# читают свои данные по заголовку и хвост не замечают
+STAMP_MAGIC = b"EORAGEN1"
+STAMP_SIZE = len(STAMP_MAGIC) + 8
 
-def build_index(chunks_dir="src/storage/files/chunks"):
-    """Построение FAISS индекса из текстовых чанков"""
+def _urls_path(meta_path: Path) -> Path:
+    """Таблица URL лежит рядом с массивом метаданных: meta.npy -> meta.urls.txt"""
+    return meta_path.with_suffix(".urls.txt")
+
+def _load_url_table(path: Path) -> List[str]:
+    if not path.exists():
+        return []
+    return path.read_text(encoding="utf-8").split("\n")[:-1]
+
+def _replace_file(path: Path, write):
+    """Пишет файл во временный и подменяет: читатели видят либо старый, либо новый"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+def _stamp_bytes(stamp: int) -> bytes:
+    return STAMP_MAGIC + int(stamp).to_bytes(8, "little")
+
+def read_stamp(path: Path) -> Optional[int]:
+    """Метка поколения из конца файла индекса или метаданных (None у файлов без неё)"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(-STAMP_SIZE, os.SEEK_END)
+            tail = f.read(STAMP_SIZE)
+    except OSError:
+        return None
+    if not tail.startswith(STAMP_MAGIC):
+        return None
+    return int.from_bytes(tail[len(STAMP_MAGIC):], "little")
+
+def save_metadata(path: Path, urls: Dict[int, str], stamp: int = None):
+    """
+    Сохраняет метаданные поиска: массив doc_of (.npy) и таблицу URL
+
+    doc_of[vector_id] - номер URL в таблице (-1 для удалённых векторов).
+    Тексты чанков в метаданные не входят: они читаются из ChunkStore по
+    тому же ID. Таблица URL только дописывается и пишется первой, поэтому
+    процесс, успевший прочитать старый doc_of, найдёт свои URL на прежних
+    местах. stamp - метка поколения, такая же, как у файла индекса.
+    """
+    urls_path = _urls_path(path)
+    table = _load_url_table(urls_path)
+    position = {url: i for i, url in enumerate(table)}
+    for url in urls.values():
+        if url not in position:
+            position[url] = len(table)
+            table.append(url)
+    _replace_file(urls_path, lambda f: f.write("".join(f"{url}\n" for url in table).encode("utf-8")))
+
+    doc_of = np.full(max(urls, default=-1) + 1, -1, dtype="int32")
+    if urls:
+        doc_of[np.fromiter(urls.keys(), dtype="int64")] = [position[url] for url in urls.values()]
+    def write(f):
+        np.save(f, doc_of)
+        if stamp is not None:
+            f.write(_stamp_bytes(stamp))
+    _replace_file(path, write)
+
+def load_metadata(path: Path, mmap: bool = False):
+    """Читает метаданные поиска: (doc_of, список URL); doc_of можно отобразить в память"""
+    doc_of = np.load(path, mmap_mode="r" if mmap else None)
+    return doc_of, _load_url_table(_urls_path(path))
+
+def read_index(path: Path, mmap: bool = False):
+    """
+    Читает FAISS индекс; с mmap из файла отображаются только массивы кодов
+    плоских индексов (векторы flat и HNSW). Граф HNSW и списки IVF
+    читаются в память каждого процесса
+    """
+    return faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC if mmap else 0)
+
+def _load_existing_index():
+    """Загружает текущий индекс для инкрементального обновления или None"""
+    if not INDEX_PATH.exists() or not META_PATH.exists():
+        return None, None
+    try:
+        index = read_index(INDEX_PATH)
+        doc_of, table = load_metadata(META_PATH)
+    except Exception as e:
+        print(f"[ERROR] Failed to load existing index: {str(e)}")
+        return None, None
+    # Индексы старого формата (без ID) обновлять инкрементально нельзя
+    if not isinstance(index, (faiss.IndexIDMap2, faiss.IndexIVF)):
+        return None, None
+    # Сбой между записью индекса и метаданных
+    if read_stamp(INDEX_PATH) != read_stamp(META_PATH):
+        print("[INDEX] Index and metadata are from different saves, rebuilding from scratch")
+        return None, None
+    # IVF в обёртке IndexIDMap2 после удалений мог разойтись со своими ID
+    if isinstance(index, faiss.IndexIDMap2) and needs_training(index_kind(index)):
+        print("[INDEX] Legacy IVF index format, rebuilding from scratch")
+        return None, None
+    urls = {int(i): table[doc_of[i]] for i in np.flatnonzero(doc_of >= 0)}
+    return index, urls
+
+def _save_index(index, urls: Dict[int, str]):
+    """Атомарно сохраняет индекс и метаданные"""
+    INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+
+    # Файлы подменяются, а не перезаписываются: работающий бот никогда не
+    # прочитает наполовину записанный индекс, а отображённые в память
+    # старые файлы остаются целыми, пока он их не отпустит. Между двумя
+    # подменами файлы из разных сохранений - их выдаёт разная метка поколения
+    stamp = time.time_ns()
+    tmp_index = INDEX_PATH.with_suffix(".faiss.tmp")
+    faiss.write_index(index, str(tmp_index))
+    with open(tmp_index, "ab") as f:
+        f.write(_stamp_bytes(stamp))
+    save_metadata(META_PATH, urls, stamp)
+    os.replace(tmp_index, INDEX_PATH)
+
+class IndexWriter:
+    """
+    Инкрементальная запись FAISS индекса с внешними ID с учётом базы документов.
+
+    ID вектора совпадает с номером записи текста чанка в ChunkStore.
+    Тип индекса задаётся INDEX_TYPE / INDEX_METRIC (см. index_factory).
+    Загружает текущий индекс и таблицу vectors; если они не согласованы или
+    сменилась модель эмбеддингов, начинает индекс с нуля. Изменения
+    копятся в памяти и фиксируются вызовом save().
+    """
+
+    def __init__(self, store: DocumentStore, incremental: bool = True):
+        self.store = store
+        self.spec = index_spec(INDEX_TYPE, INDEX_METRIC)
+        self.index, self.urls, self.indexed = None, {}, {}
+        self.changed = False
+
+        stored_model = store.get_setting("embed_model")
+        if incremental:
+            if stored_model == str(EMBED_MODEL):
+                self.index, self.urls = _load_existing_index()
+                self.indexed = store.indexed_vectors()
+                # Индекс, не согласованный с базой, обновлять небезопасно
+                if self.index is not None and not (self.index.ntotal == len(self.indexed) == len(self.urls)):
+                    print("[INDEX] Database does not match index, rebuilding from scratch")
+                    self.index = None
+                if self.index is not None:
+                    self._convert(store.get_setting("index_type", "flat:l2"))
+            elif stored_model is not None:
+                print("[INDEX] Embedding model changed, rebuilding from scratch")
+        if self.index is None:
+            self.urls, self.indexed = {}, {}
+            store.clear_vectors()
+
+        self._added = []
+        self._removed = []
+        self._dead = set()  # Удалённые из HNSW векторы, ждущие перестройки
+
+    def _convert(self, stored_spec: str):
+        """Смена INDEX_TYPE: перестраиваем индекс из его же векторов без обращения к модели"""
+        if stored_spec == self.spec:
+            return
+        same_metric = stored_spec.split(":")[-1] == INDEX_METRIC
+        if not same_metric or not stores_exact_vectors(self.index):
+            print(f"[INDEX] Index type changed ({stored_spec} -> {self.spec}), rebuilding from scratch")
+            self.index = None
+            return
+        print(f"[INDEX] Index type changed ({stored_spec} -> {self.spec}), converting stored vectors")
+        ids, vectors = extract_vectors(self.index)
+        self.index = rebuild_index(ids, vectors, INDEX_TYPE, INDEX_METRIC)
+        self.changed = True
+
+    def needs_embedding(self, name: str, content_hash: str, record_id: int) -> bool:
+        """Нужно ли (пере)векторизовать чанк"""
+        entry = self.indexed.get(name)
+        return entry is None or entry["hash"] != content_hash or entry["id"] != record_id
+
+    def remove(self, names):
+        """Удаляет векторы чанков из индекса"""
+        ids = [self.indexed.pop(name)["id"] for name in names if name in self.indexed]
+        if not ids:
+            return
+        if supports_remove(self.index):
+            self.index.remove_ids(np.array(ids, dtype="int64"))
+        else:
+            self._dead.update(ids)
+        for vector_id in ids:
+            self.urls.pop(vector_id, None)
+        self._removed.extend(ids)
+        self.changed = True
+
+    def add(self, names, hashes, record_ids, urls, vectors):
+        """Добавляет векторы чанков под ID их записей (предыдущие версии чанков удаляются)"""
+        self.remove([name for name in names if name in self.indexed])
+
+        if self.index is None:
+            # Обучаемые индексы копят векторы в точном индексе до обучения в save()
+            start_type = "flat" if needs_training(INDEX_TYPE) else INDEX_TYPE
+            self.index = create_index(len(vectors[0]), start_type, INDEX_METRIC)
+        vectors = prepare_vectors(vectors, self.index)
+        self.index.add_with_ids(vectors, np.array(record_ids, dtype="int64"))
+
+        for name, content_hash, vector_id, url in zip(names, hashes, record_ids, urls):
+            self.indexed[name] = {"id": vector_id, "hash": content_hash}
+            self._added.append((vector_id, name, content_hash))
+            self.urls[vector_id] = url
+        self.changed = True
+
+    def update_url(self, name: str, url: str):
+        """URL документа мог смениться без изменения текста"""
+        entry = self.indexed.get(name)
+        if entry and entry["id"] in self.urls and self.urls[entry["id"]] != url:
+            self.urls[entry["id"]] = url
+            self.changed = True
+
+    def _finalize(self):
+        """Перестройка HNSW после удалений и обучение IVF, когда векторов достаточно"""
+        if self._dead:
+            ids, vectors = extract_vectors(self.index)
+            keep = ~np.isin(ids, np.fromiter(self._dead, dtype="int64"))
+            self.index = rebuild_index(ids[keep], vectors[keep], INDEX_TYPE, INDEX_METRIC)
+            self._dead.clear()
+        elif (needs_training(INDEX_TYPE) and index_kind(self.index) == "flat"
+              and self.index.ntotal >= min_train_size(INDEX_TYPE)):
+            print(f"[INDEX] Training {INDEX_TYPE} index on {self.index.ntotal} vectors")
+            self.index = rebuild_index(*extract_vectors(self.index), INDEX_TYPE, INDEX_METRIC)
+
+    def save(self) -> bool:
+        """Сохраняет индекс и фиксирует изменения в базе"""
+        if self.index is None:
+            return False
+        self._finalize()
+        _save_index(self.index, self.urls)
+        # База обновляется после файлов индекса: при сбое между ними
+        # несовпадение будет замечено и индекс перестроится
+        self.store.update_vectors(self._added, self._removed)
+        self.store.set_settings({"embed_model": EMBED_MODEL, "index_type": self.spec})
+        self._added, self._removed = [], []
+        self.changed = False
+        return True
+
+def _live(ids, doc_of) -> np.ndarray:
+    """Маска ID, у которых есть документ в doc_of"""
+    live = ids < len(doc_of)
+    live[live] = doc_of[ids[live]] >= 0
+    return live
+
+def _lexical_path() -> Path:
+    """Индекс BM25 лежит рядом с FAISS индексом"""
+    return INDEX_PATH.with_name(LEXICAL_PATH.name)
+
+def save_lexical(writer: IndexWriter, chunk_store: ChunkStore):
+    """Перестраивает индекс BM25 по чанкам, векторы которых лежат в индексе"""
+    ids = sorted(writer.urls)
+    save_lexical_index(_lexical_path(), ids, chunk_store.get_many(ids))
+    print(f"[INDEX] Saved BM25 index for {len(ids)} chunks")
+
+def build_index(incremental=True, store: DocumentStore = None, chunk_store: ChunkStore = None):
+    """
+    Построение FAISS индекса из чанков, записанных чанкером
+
+    В инкрементальном режиме векторизуются только новые и изменённые чанки
+    (по sha256 содержимого), а векторы исчезнувших чанков удаляются из
+    индекса по ID. Какие чанки уже лежат в индексе, хранится в таблице
+    vectors базы документов. Повторный запуск без изменений не обращается
+    к модели.
+
+    Args:
+        incremental: False - перестроить индекс с нуля
+        store: База документов (по умолчанию src/storage/documents.db)
+        chunk_store: Хранилище текстов чанков (по умолчанию src/storage/chunks.bin)
+    """
     print("[INDEX] Building FAISS index...")
-    vectors = []
-    metadata = []
+    store = store or DocumentStore()
+    chunk_store = chunk_store if chunk_store is not None else ChunkStore()
 
-    chunk_dir = Path(chunks_dir)
-    files = list(chunk_dir.glob("*.txt"))
-    if not files:
+    chunks = store.all_chunks()
+    if not chunks:
         print("[INDEX] No chunks found.")
         return
 
-    # Загрузка маппинга URL с обработкой ошибок
-    url_mapping = {}
-    mapping_file = Path("src/storage/files/url_mapping.json")
-    if mapping_file.exists():
-        try:
-            with open(mapping_file, "r", encoding="utf-8") as f:
-                url_mapping = json.load(f)
-        except (json.JSONDecodeError, UnicodeDecodeError) as e:
-            print(f"[ERROR] Invalid mapping file: {str(e)}")
-            url_mapping = {}
-
-    # Сбор текстов и метаданных
-    texts = []
-    for file_path in tqdm(files, desc="Processing chunks"):
-        try:
-            text = file_path.read_text(encoding="utf-8")
-            texts.append(text)
-            
-            # Извлечение оригинального имени файла
-            if "_chunk" in file_path.stem:
-                original_filename = file_path.stem.rsplit("_chunk", 1)[0] + ".html"
-            else:
-                original_filename = file_path.stem + ".html"
-                
-            # Получение URL из маппинга
-            url_entry = url_mapping.get(original_filename)
-            final_url = "unknown_url"
-            
-            if isinstance(url_entry, dict):
-                final_url = url_entry.get("final_url", "unknown_url")
-            elif isinstance(url_entry, str):
-                final_url = url_entry
-            
-            metadata.append({
-                "file": file_path.name,
-                "text": text,
-                "url": final_url
-            })
-        except Exception as e:
-            print(f"[ERROR] Processing {file_path.name}: {str(e)}")
+    # Чанки из старых версий (файлы без записи в хранилище) нужно разбить заново
+    missing = [c for c in chunks if c["record_id"] is None or c["record_id"] >= len(chunk_store)]
+    if missing:
+        print(f"[INDEX] {len(missing)} chunks are missing from the chunk store, "
+              f"run the chunker with --full")
+        chunks = [c for c in chunks if c["record_id"] is not None and c["record_id"] < len(chunk_store)]
+
+    url_mapping = store.url_by_filename()
+    writer = IndexWriter(store, incremental)
+
+    # Чанки, которые исчезли, удаляются из индекса; изменённые заменяются при добавлении
+    current = {c["chunk_id"] for c in chunks}
+    stale = [name for name in writer.indexed if name not in current]
+    pending = [c for c in chunks if writer.needs_embedding(c["chunk_id"], c["content_hash"], c["record_id"])]
+    writer.remove(stale)
 
-    if not texts:
-        print("[INDEX] No texts to process")
+    # URL могли обновиться без изменения текста - метаданные дешево пересчитать
+    for c in chunks:
+        writer.update_url(c["chunk_id"], url_mapping.get(c["filename"], "unknown_url"))
+
+    if writer.index is not None and not writer.changed and not pending:
+        if not _lexical_path().exists():
+            save_lexical(writer, chunk_store)
+        print(f"[INDEX] Index is up to date ({writer.index.ntotal} vectors).")
         return
 
-    # Генерация эмбеддингов батчами
-    for i in tqdm(range(0, len(texts), BATCH_SIZE), desc="Embedding"):
-        batch = texts[i:i+BATCH_SIZE]
+    # Генерация эмбеддингов батчами: в индекс и базу попадают только
+    # успешно векторизованные чанки, остальные повторятся при следующем запуске
+    added = 0
+    for i in tqdm(range(0, len(pending), BATCH_SIZE), desc="Embedding"):
+        batch = pending[i:i+BATCH_SIZE]
         try:
-            batch_embs = get_embeddings(batch)
-            if batch_embs:
-                vectors.extend(batch_embs)
+            batch_embs = get_embeddings(chunk_store.get_many([c["record_id"] for c in batch]))
         except Exception as e:
             print(f"[ERROR] Embedding batch {i//BATCH_SIZE}: {str(e)}")
+            continue
+        if len(batch_embs) == 0:
+            continue
+
+        writer.add([c["chunk_id"] for c in batch], [c["content_hash"] for c in batch],
+                   [c["record_id"] for c in batch],
+                   [url_mapping.get(c["filename"], "unknown_url") for c in batch], batch_embs)
+        added += len(batch)
 
-    if not vectors:
+    if not writer.save():
         print("[INDEX] No embeddings generated.")
         return
+    save_lexical(writer, chunk_store)
 
-    # Создание и сохранение индекса
-    dim = len(vectors[0])
-    index = faiss.IndexFlatL2(dim)
-    index.add(np.array(vectors).astype("float32"))
+    print(f"[INDEX] Saved index with {writer.index.ntotal} vectors "
+          f"(+{added} embedded, -{len(stale)} removed).")
 
-    INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
-    faiss.write_index(index, str(INDEX_PATH))
-    
-    with open(META_PATH, "wb") as f:
-        pickle.dump(metadata, f)
+class SearchEngine:
+    """
+    Резидентный поисковый движок: держит FAISS индекс и метаданные в памяти.
 
-    print(f"[INDEX] Saved index with {len(vectors)} vectors.")
+    Метаданные - пара небольших массивов (документ каждого вектора и
+    таблица URL); тексты найденных чанков читаются из ChunkStore по ID
+    вектора только для результатов. Файлы читаются с диска один раз; при
+    каждом запросе сверяется только сигнатура файлов (mtime и размер).
+    Если индекс был перестроен, новый набор индекс/метаданные/хранилище
+    загружается и подменяется атомарно, а уже начатые запросы дорабатывают
+    со старой копией. Безопасен для одновременных вызовов из asyncio.to_thread.
 
-def search(query: str, top_k=4):
-    """Поиск по индексу"""
-    if not INDEX_PATH.exists() or not META_PATH.exists():
-        print("[SEARCH] No index found. Please build index first.")
-        return []
+    С mmap=True (INDEX_MMAP) векторы flat/HNSW, doc_of и тексты чанков
+    отображаются из файлов: процессы бота на одном сервере делят одну
+    копию в кэше ОС. Списки IVF при этом у каждого процесса свои, а
+    прямая карта IVF не строится: расстояния до кандидатов BM25 считаются
+    поиском среди их ID, а MMR без векторов кандидатов заменяется выбором
+    лучшего чанка страницы.
 
-    try:
-        index = faiss.read_index(str(INDEX_PATH))
-        with open(META_PATH, "rb") as f:
-            metadata = pickle.load(f)
+    Рядом с индексом лежит индекс BM25 (bm25.npz): в режиме hybrid
+    кандидаты FAISS и BM25 объединяются reciprocal rank fusion, так что
+    запросы с названиями клиентов находят нужный кейс, даже если вектор
+    запроса на него не похож. Без файла BM25 поиск только векторный.
+
+    Перекрывающиеся чанки одной страницы почти одинаковы, поэтому из
+    кандидатов выбирается лучший чанк каждой страницы или набор по MMR;
+    чанки дальше SEARCH_MAX_DISTANCE от запроса отбрасываются, и на
+    вопрос не по теме бот отвечает без обращения к LLM.
+    """
+
+    def __init__(self, index_path=INDEX_PATH, meta_path=META_PATH, chunks_dir=None, mmap=INDEX_MMAP,
+                 lexical_path=None):
+        self.index_path = Path(index_path)
+        self.meta_path = Path(meta_path)
+        self.lexical_path = (Path(lexical_path) if lexical_path is not None
+                             else self.index_path.with_name(LEXICAL_PATH.name))
+        self.mmap = mmap
+        self.chunks_dir = Path(chunks_dir) if chunks_dir is not None else self.index_path.parent
+        self.generation = 0  # Увеличивается при каждой успешной загрузке
+        self._state = None  # (index, doc_of, urls, chunk_store, lexical, generation, signature)
+        self._lock = threading.Lock()
+
+    def _signature(self):
+        """Сигнатура файлов индекса или None, если их нет"""
+        try:
+            index_stat = self.index_path.stat()
+            meta_stat = self.meta_path.stat()
+        except FileNotFoundError:
+            return None
+        try:
+            lexical_stat = self.lexical_path.stat()
+            lexical = (lexical_stat.st_mtime_ns, lexical_stat.st_size)
+        except FileNotFoundError:
+            lexical = None
+        return (index_stat.st_mtime_ns, index_stat.st_size,
+                meta_stat.st_mtime_ns, meta_stat.st_size, lexical)
+
+    def load(self) -> bool:
+        """
+        Загружает индекс, если файлы на диске изменились с прошлой загрузки
+
+        Returns:
+            True если в памяти есть пригодный для поиска индекс
+        """
+        signature = self._signature()
+        state = self._state
+        if state is not None and (signature is None or state[-1] == signature):
+            return True
+        if signature is None:
+            return False
+
+        with self._lock:
+            # Другой поток мог уже перезагрузить индекс, пока мы ждали
+            state = self._state
+            if state is not None and state[-1] == signature:
+                return True
+            stamps = self._stamps()
+            try:
+                index = configure_search(read_index(self.index_path, self.mmap), direct_map=not self.mmap)
+                doc_of, urls = load_metadata(self.meta_path, self.mmap)
+                chunk_store = ChunkStore(self.chunks_dir)
+                lexical = LexicalIndex.load(self.lexical_path) if signature[-1] is not None else None
+            except Exception as e:
+                print(f"[SEARCH ERROR] Failed to load index: {str(e)}")
+                return state is not None
+
+            # Файлы пишутся по очереди: пока набор не согласован, работаем со старым.
+            # Метки сверяются и до, и после чтения: файл могли подменить между ними
+            if stamps[0] is not None:
+                in_sync = stamps[0] == stamps[1] and self._stamps() == stamps
+            else:
+                in_sync = index.ntotal == int((doc_of >= 0).sum())  # Файлы без меток
+            if not in_sync or len(chunk_store) < len(doc_of):
+                print("[SEARCH] Index and metadata are out of sync, keeping previous index")
+                return state is not None
+
+            self.generation += 1
+            self._state = (index, doc_of, urls, chunk_store, lexical, self.generation, signature)
+            print(f"[SEARCH] Loaded index with {index.ntotal} vectors (generation {self.generation})")
+            return True
+
+    def _stamps(self):
+        return read_stamp(self.index_path), read_stamp(self.meta_path)
+
+    @property
+    def lexical(self):
+        """Загруженный индекс BM25 (с сигнатурами чанков) или None"""
+        state = self._state
+        return state[4] if state is not None else None
+
+    def search_vector(self, query_emb, top_k=4):
+        """Поиск по готовому вектору запроса"""
+        return self.search_vectors([query_emb], top_k)[0]
+
+    def search_vectors(self, query_embs, top_k=4, queries: List[str] = None, mode: str = SEARCH_MODE,
+                       max_distance: float = SEARCH_MAX_DISTANCE, diversity: str = SEARCH_DIVERSITY,
+                       return_snapshot: bool = False):
+        """
+        Поиск по матрице векторов запросов одним вызовом FAISS
 
-        query_emb = get_embeddings([query])
-        if not query_emb:
+        С текстами запросов (queries) в режиме hybrid к кандидатам FAISS
+        добавляются кандидаты BM25, в режиме bm25 поиск идёт только по словам.
+        Кандидаты дальше max_distance от запроса отбрасываются (0 - без
+        порога), из оставшихся берутся top_k: лучший чанк каждой страницы
+        (diversity="url") или разнообразные по MMR (diversity="mmr"; без
+        векторов кандидатов - как url).
+
+        Returns:
+            Список результатов для каждого запроса в порядке query_embs.
+            distance - расстояние до запроса (None без вектора запроса),
+            score - оценка ранжирования режима (больше - лучше).
+            С return_snapshot=True - тройка (результаты, индекс BM25 и
+            поколение того же набора файлов): после подмены индекса
+            self.lexical и self.generation уже другие
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode {mode!r}, expected one of {', '.join(SEARCH_MODES)}")
+        if diversity not in DIVERSITY_MODES:
+            raise ValueError(f"Unknown diversity {diversity!r}, expected one of {', '.join(DIVERSITY_MODES)}")
+        n_queries = len(queries) if mode == "bm25" and queries is not None else len(query_embs)
+        if n_queries == 0:
+            return ([], None, None) if return_snapshot else []
+        if not self.load():
+            print("[SEARCH] No index found. Please build index first.")
+            results = [[] for _ in range(n_queries)]
+            return (results, None, None) if return_snapshot else results
+
+        index, doc_of, urls, chunk_store, lexical, generation, _ = self._state
+        if queries is None or lexical is None:
+            mode = "vector"
+        vectors = prepare_vectors(query_embs, index) if len(query_embs) else None
+        # Для гибрида и отбора разнообразных результатов нужен запас кандидатов
+        k = max(top_k, HYBRID_CANDIDATES) if mode == "hybrid" or diversity != "none" else top_k
+        if mode != "bm25":
+            D, I = index.search(vectors, k)
+
+        results = []
+        for q in range(n_queries):
+            vector = vectors[q] if vectors is not None else None
+            ids, distances = np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+            if mode != "bm25":
+                found = I[q] >= 0
+                ids, distances = I[q][found].astype("int64"), to_distances(D[q][found], index)
+                # Вектор без документа в doc_of (urls[-1] молча дал бы чужой URL)
+                live = _live(ids, doc_of)
+                ids, distances = ids[live], distances[live]
+            scores = -distances
+            if mode != "vector":
+                ids, scores = self._fuse(ids, lexical, doc_of, queries[q], k, mode)
+
+            # Векторы кандидатов: расстояния для найденных BM25 и сходство между кандидатами для MMR
+            candidates = None
+            if vector is not None and (mode != "vector" or diversity == "mmr"):
+                if can_reconstruct(index):
+                    candidates = reconstruct_vectors(index, ids)
+                if mode != "vector":
+                    distances = (vector_distances(vector, candidates, index) if candidates is not None
+                                 else candidate_distances(index, vector, ids))
+            elif mode != "vector":
+                distances = np.full(len(ids), np.nan, dtype="float32")
+
+            if max_distance > 0 and vector is not None:
+                close = distances <= max_distance
+                ids, scores, distances = ids[close], scores[close], distances[close]
+                candidates = candidates[close] if candidates is not None else None
+
+            if diversity == "mmr" and candidates is not None:
+                order = mmr_order(scores, candidates, top_k)
+            elif diversity != "none":
+                order = first_per_group(doc_of[ids])
+            else:
+                order = np.arange(len(ids))
+
+            results.append([{"id": int(ids[i]), "text": chunk_store.get(int(ids[i])), "url": urls[doc_of[ids[i]]],
+                             "distance": None if np.isnan(distances[i]) else float(distances[i]),
+                             "score": float(scores[i])}
+                            for i in order[:top_k]])
+        return (results, lexical, generation) if return_snapshot else results
+
+    @staticmethod
+    def _fuse(vector_ids, lexical, doc_of, query: str, n: int, mode: str):
+        """
+        Кандидаты BM25 (mode="bm25") или их reciprocal rank fusion с
+        кандидатами FAISS: (ID по убыванию оценки, оценки)
+        """
+        lexical_ids, lexical_scores = lexical.search(query, n)
+        # BM25 мог быть построен до удаления части векторов
+        live = _live(lexical_ids, doc_of)
+        lexical_ids, lexical_scores = lexical_ids[live], lexical_scores[live].astype("float32")
+        if mode == "bm25":
+            return lexical_ids, lexical_scores
+
+        ranked = np.concatenate([vector_ids, lexical_ids])
+        weights = np.concatenate([1.0 / (RRF_K + 1 + np.arange(len(vector_ids))),
+                                  1.0 / (RRF_K + 1 + np.arange(len(lexical_ids)))])
+        unique, inverse = np.unique(ranked, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights, minlength=len(unique))
+        order = np.argsort(-scores, kind="stable")
+        return unique[order].astype("int64"), scores[order].astype("float32")
+
+    def search(self, query: str, top_k=4):
+        """Поиск по текстовому запросу"""
+        return self.search_many([query], top_k)[0]
+
+    def search_many(self, queries: List[str], top_k=4, return_vectors=False):
+        """
+        Поиск по нескольким запросам: один вызов модели эмбеддингов и FAISS
+
+        Returns:
+            Список результатов для каждого запроса в порядке queries;
+            с return_vectors=True - пары (вектор запроса или None, результаты)
+        """
+        if not queries:
             return []
+        query_embs = [None] * len(queries)
+        results = [[] for _ in queries]
+        try:
+            embeddings = get_embeddings(list(queries))
+            if len(embeddings) == len(queries):
+                query_embs = embeddings
+                results = self.search_vectors(query_embs, top_k, queries=list(queries))
+        except Exception as e:
+            print(f"[SEARCH ERROR] {str(e)}")
+        if return_vectors:
+            return list(zip(query_embs, results))
+        return results
 
-        D, I = index.search(np.array(query_emb).astype("float32"), top_k)
-        return [metadata[idx] for idx in I[0]]
-    except Exception as e:
-        print(f"[SEARCH ERROR] {str(e)}")
-        return []
+_default_engine = SearchEngine()
+
+def search(query: str, top_k=4):
+    """Поиск по индексу через общий резидентный движок"""
+    return _default_engine.search(query, top_k)
+
+def search_many(queries: List[str], top_k=4):
+    """Пакетный поиск через общий резидентный движок"""
+    return _default_engine.search_many(queries, top_k)
 
 if __name__ == "__main__":
-    build_index()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Построение FAISS индекса")
+    parser.add_argument("--full", action="store_true", help="перестроить индекс с нуля")
+    args = parser.parse_args()
+
+    build_index(incremental=not args.full)
     print(search("Что вы можете сделать для ритейлеров?"))
\ No newline at end of file
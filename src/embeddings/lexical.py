@@ -0,0 +1,238 @@
+import math
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+LEXICAL_PATH = Path("src/storage/bm25.npz")
+BM25_K1 = 1.2
+BM25_B = 0.75
+STEM_CACHE_SIZE = 200_000  # Слов с готовой основой: словарь корпуса и вопросов повторяется
+
+WORD_RE = re.compile(r"\w+")
+CYRILLIC_RE = re.compile(r"[а-я]")
+VOWELS = "аеиоуыэюя"
+# Служебные слова не несут смысла для поиска и раздувают списки документов
+STOP_WORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "для", "к", "ко", "от", "до", "из", "о", "об", "у",
+    "за", "не", "но", "а", "или", "что", "как", "это", "то", "же", "бы", "ли", "вы", "мы", "он",
+    "она", "они", "оно", "их", "его", "её", "ее", "при", "так", "уже", "есть", "был", "была",
+    "были", "быть", "все", "всё", "который", "которые", "также", "the", "and", "of", "to",
+    "in", "for", "is", "on", "with", "a", "an",
+}
+
+# Окончания по алгоритму Snowball для русского языка, длинные - раньше коротких
+_PERFECTIVE_GERUND = (("вшись", "вши", "в"), ("ившись", "ывшись", "ивши", "ывши", "ив", "ыв"))
+_REFLEXIVE = ("ся", "сь")
+_ADJECTIVE = ("ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый",
+              "ой", "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею")
+_PARTICIPLE = (("ем", "нн", "вш", "ющ", "щ"), ("ивш", "ывш", "ующ"))
+_VERB = (("ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны", "ть",
+          "й", "л", "н"),
+         ("ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует",
+          "уют", "ены", "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят", "ит",
+          "ыт", "ую", "ю"))
+_NOUN = ("иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи", "ии",
+         "ей", "ой", "ий", "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья", "а", "е",
+         "и", "й", "о", "у", "ы", "ь", "ю", "я")
+_DERIVATIONAL = ("ость", "ост")
+_SUPERLATIVE = ("ейше", "ейш")
+
+def _regions(word: str):
+    """Начала областей RV и R2 алгоритма Snowball"""
+    rv = next((i + 1 for i, ch in enumerate(word) if ch in VOWELS), len(word))
+
+    def after_vowel_consonant(start):
+        for i in range(start + 1, len(word)):
+            if word[i] not in VOWELS and word[i - 1] in VOWELS:
+                return i + 1
+        return len(word)
+
+    return rv, after_vowel_consonant(after_vowel_consonant(0))
+
+def _strip(rv: str, endings) -> Optional[str]:
+    for ending in endings:
+        if rv.endswith(ending):
+            return rv[:-len(ending)]
+    return None
+
+def _strip_grouped(rv: str, groups) -> Optional[str]:
+    """Окончания первой группы снимаются только после а/я"""
+    preceded, plain = groups
+    for ending in preceded:
+        if rv.endswith(ending) and rv[:-len(ending)][-1:] in ("а", "я"):
+            return rv[:-len(ending)]
+    return _strip(rv, plain)
+
+def stem_ru(word: str) -> str:
+    """Основа русского слова (облегчённый Snowball): "кейсами" -> "кейс" """
+    rv_start, r2_start = _regions(word)
+    prefix, rv = word[:rv_start], word[rv_start:]
+
+    # Шаг 1: деепричастие, иначе возвратность и прилагательное / глагол / существительное
+    stripped = _strip_grouped(rv, _PERFECTIVE_GERUND)
+    if stripped is None:
+        rv = _strip(rv, _REFLEXIVE) if rv.endswith(_REFLEXIVE) else rv
+        stripped = _strip(rv, _ADJECTIVE)
+        if stripped is not None:
+            stripped = _strip_grouped(stripped, _PARTICIPLE) or stripped
+        else:
+            stripped = _strip_grouped(rv, _VERB)
+            if stripped is None:
+                stripped = _strip(rv, _NOUN)
+    rv = rv if stripped is None else stripped
+
+    # Шаг 2-4: "и", словообразовательное "ость" в R2, превосходная степень, "нн", "ь"
+    if rv.endswith("и"):
+        rv = rv[:-1]
+    r2 = max(0, r2_start - rv_start)
+    for ending in _DERIVATIONAL:
+        if rv.endswith(ending) and len(rv) - len(ending) >= r2:
+            rv = rv[:-len(ending)]
+            break
+    superlative = _strip(rv, _SUPERLATIVE)
+    if superlative is not None:
+        rv = superlative
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    elif rv.endswith("ь"):
+        rv = rv[:-1]
+    return prefix + rv
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def _term(word: str) -> str:
+    return stem_ru(word) if CYRILLIC_RE.search(word) else word
+
+def tokenize(text: str) -> List[str]:
+    """Термины для поиска: нижний регистр, ё -> е, русские слова - по основе"""
+    return [_term(word) for word in WORD_RE.findall(text.lower().replace("ё", "е"))
+            if word not in STOP_WORDS and (len(word) >= 2 or word.isdigit())]
+
+def build_lexical_index(ids, texts: List[str]) -> dict:
+    """
+    Инвертированный индекс BM25 в виде плоских массивов
+
+    terms - словарь (байты, через \\n); postings/tfs - ID чанков и
+    частоты терминов подряд для всех терминов; term_starts[t] - начало
+    списка термина t; doc_len[id] - длина чанка в терминах. Прямой
+    индекс doc_terms/doc_starts - термины каждого чанка (сигнатура для
+    проверки ответа по контексту).
+    """
+    ids = np.asarray(ids, dtype="int64")
+    vocab = {}
+    term_ids, doc_ids = [], []
+    doc_len = np.zeros(int(ids.max()) + 1 if len(ids) else 0, dtype="float32")
+    for record_id, text in zip(ids, texts):
+        terms = tokenize(text)
+        doc_len[record_id] = len(terms)
+        term_ids.extend(vocab.setdefault(t, len(vocab)) for t in terms)
+        doc_ids.extend([record_id] * len(terms))
+
+    # Номера терминов - по алфавиту, пары (термин, чанк) с числом повторов
+    # после np.unique идут по термину, внутри - по чанку
+    terms = sorted(vocab)
+    rank = np.empty(len(terms), dtype="int64")
+    rank[[vocab[t] for t in terms]] = np.arange(len(terms))
+    width = max(len(doc_len), 1)
+    keys, tfs = np.unique(rank[np.array(term_ids, dtype="int64")] * width + np.array(doc_ids, dtype="int64"),
+                          return_counts=True)
+
+    docs = keys % width
+    by_doc = np.argsort(docs, kind="stable")
+    return {
+        "terms": np.frombuffer("\n".join(terms).encode("utf-8"), dtype="uint8"),
+        "term_starts": np.searchsorted(keys // width, np.arange(len(terms) + 1)).astype("int64"),
+        "postings": docs.astype("int32"),
+        "tfs": tfs.astype("float32"),
+        "doc_len": doc_len,
+        "doc_terms": (keys // width)[by_doc].astype("int32"),
+        "doc_starts": np.searchsorted(docs[by_doc], np.arange(len(doc_len) + 1)).astype("int64"),
+    }
+
+def save_lexical_index(path: Path, ids, texts: List[str]):
+    """Строит и атомарно сохраняет индекс BM25"""
+    arrays = build_lexical_index(ids, texts)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+    return LexicalIndex(arrays)
+
+class LexicalIndex:
+    """
+    Поиск BM25 по инвертированному индексу чанков.
+
+    ID чанков совпадают с ID векторов FAISS. Оценки считаются векторно
+    по спискам терминов запроса, поэтому запрос стоит доли миллисекунды
+    даже на десятках тысяч чанков.
+    """
+
+    def __init__(self, arrays: dict, k1: float = BM25_K1, b: float = BM25_B):
+        blob = bytes(arrays["terms"])
+        terms = blob.decode("utf-8").split("\n") if blob else []
+        self.vocab = {term: i for i, term in enumerate(terms)}
+        self.term_starts = arrays["term_starts"]
+        self.postings = arrays["postings"]
+        self.tfs = arrays["tfs"]
+        self.doc_len = arrays["doc_len"]
+        # Прямого индекса нет в файлах, построенных до его появления
+        self.doc_terms = arrays.get("doc_terms")
+        self.doc_starts = arrays.get("doc_starts")
+        self.n_docs = int(np.count_nonzero(self.doc_len))
+        self.avg_len = float(self.doc_len.sum()) / max(self.n_docs, 1)
+        df = np.diff(self.term_starts)
+        self.idf = np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5)).astype("float32")
+        self.max_idf = float(math.log(1 + (self.n_docs + 0.5) / 0.5))  # Для слов вне словаря
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def load(cls, path: Path):
+        with np.load(path) as data:
+            return cls({name: data[name] for name in data.files})
+
+    def __len__(self):
+        return self.n_docs
+
+    def search(self, query: str, top_n: int = 10):
+        """(ID чанков, оценки BM25) лучших top_n по убыванию оценки"""
+        docs, weights = [], []
+        for term in set(tokenize(query)):
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            start, end = self.term_starts[t], self.term_starts[t + 1]
+            ids, tf = self.postings[start:end], self.tfs[start:end]
+            norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[ids] / self.avg_len)
+            docs.append(ids)
+            weights.append(self.idf[t] * tf * (self.k1 + 1) / norm)
+        if not docs:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+
+        unique, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights))
+        if len(scores) > top_n:
+            best = np.argpartition(-scores, top_n)[:top_n]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return unique[best].astype("int64"), scores[best].astype("float32")
+
+    def chunk_terms(self, ids) -> Optional[np.ndarray]:
+        """
+        Номера терминов чанков (с повторами между чанками) или None,
+        если прямого индекса нет или какого-то чанка в нём нет
+        """
+        if self.doc_terms is None:
+            return None
+        ids = np.asarray(ids, dtype="int64")
+        if len(ids) and (ids.min() < 0 or ids.max() >= len(self.doc_starts) - 1):
+            return None
+        starts, ends = self.doc_starts[ids], self.doc_starts[ids + 1]
+        return np.concatenate([self.doc_terms[a:b] for a, b in zip(starts, ends)] or
+                              [np.empty(0, dtype="int32")])
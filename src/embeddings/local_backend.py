@@ -0,0 +1,72 @@
+import os
+import threading
+from typing import List
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", 0))  # Потоков torch (0 - по числу ядер)
+EMBED_LOCAL_BATCH = int(os.getenv("EMBED_LOCAL_BATCH", 32))
+EMBED_DEVICE = os.getenv("EMBED_DEVICE") or None  # cpu / cuda / mps, по умолчанию - автоматически
+
+class LocalEmbedder:
+    """
+    Эмбеддинги моделью sentence-transformers внутри процесса.
+
+    Модель загружается один раз. Тексты сортируются по длине и режутся на
+    батчи из похожих по длине текстов, чтобы не тратить время на паддинг;
+    результат возвращается в исходном порядке матрицей float32. Вызовы из
+    разных потоков выполняются по очереди: параллелизм даёт сам torch
+    (EMBED_THREADS потоков на одну операцию).
+    """
+
+    def __init__(self, model_name: str, model=None, threads: int = EMBED_THREADS,
+                 batch_size: int = EMBED_LOCAL_BATCH, device: str = EMBED_DEVICE):
+        if model is None:
+            model = self._load(model_name, threads, device)
+        self.model = model
+        self.batch_size = batch_size
+        self.dim = model.get_sentence_embedding_dimension()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(model_name: str, threads: int, device: str):
+        if not model_name:
+            raise RuntimeError("EMBED_MODEL must name a sentence-transformers model for EMBED_BACKEND=local")
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise RuntimeError("EMBED_BACKEND=local requires sentence-transformers "
+                               "(pip install sentence-transformers)") from e
+
+        torch.set_num_threads(threads or os.cpu_count() or 1)
+        print(f"[EMBED] Loading {model_name} with {torch.get_num_threads()} threads")
+        return SentenceTransformer(model_name, device=device)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Матрица эмбеддингов (len(texts), dim) в порядке texts"""
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        with self._lock:
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                result[batch] = self.model.encode(
+                    [texts[i] for i in batch], batch_size=len(batch),
+                    convert_to_numpy=True, show_progress_bar=False
+                )
+        return result
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_local_embedder(model_name: str) -> LocalEmbedder:
+    """Общий для процесса экземпляр модели (загружается при первом обращении)"""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = LocalEmbedder(model_name)
+    return _embedder
@@ -1,25 +1,139 @@
 import os
-import requests
+import asyncio
+import aiohttp
+import numpy as np
 from typing import List
 from dotenv import load_dotenv
+from src.embeddings.cache import EmbeddingCache
+from src.embeddings.local_backend import get_local_embedder
+from src.rag.backends import get_pool
 
 load_dotenv()
 
-BASE_URL = os.getenv("LMSTUDIO_BASE_URL", "http://localhost:1234/v1")
 EMBED_MODEL = os.getenv("EMBED_MODEL")
+# lmstudio - HTTP запросы к LM Studio; local - модель sentence-transformers
+# в процессе (EMBED_MODEL - её имя), векторы возвращаются матрицей float32
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "lmstudio").lower()
+EMBED_CACHE = os.getenv("EMBED_CACHE", "true").lower() == "true"
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "src/storage/embeddings_cache.sqlite")
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", 200000))
+
+_cache = None
+
+def get_cache():
+    """Кэш эмбеддингов (создаётся при первом обращении) или None, если отключен"""
+    global _cache
+    if EMBED_CACHE and _cache is None:
+        _cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MAX_ENTRIES)
+    return _cache
+
+def request_embeddings(texts: List[str]) -> List[List[float]]:
+    """Запрашивает embeddings у LM Studio (или локальной модели) без кэша"""
+    if EMBED_BACKEND == "local":
+        try:
+            return get_local_embedder(EMBED_MODEL).encode(texts)
+        except Exception as e:
+            print(f"[EMBED ERROR] {str(e)}")
+            return []
 
-def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Получает embeddings для батча текстов"""
-    url = f"{BASE_URL}/embeddings"
     payload = {
         "model": EMBED_MODEL,
         "input": texts
     }
-    
+
     try:
-        r = requests.post(url, json=payload, timeout=60)
+        # Наименее загруженный из серверов LLM_BACKENDS, при отказе - следующий
+        r = get_pool().post_sync("/embeddings", payload, timeout=60)
         r.raise_for_status()
         return [item["embedding"] for item in r.json()["data"]]
     except Exception as e:
         print(f"[EMBED ERROR] {str(e)}")
-        return []
\ No newline at end of file
+        return []
+
+def _cached(cache, texts: List[str]):
+    """Векторы из кэша (None для промахов) и промахи без повторов"""
+    vectors = cache.get_many(EMBED_MODEL or "", texts)
+    missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+    return vectors, missing
+
+def _merge(cache, texts: List[str], vectors, missing: List[str], fetched):
+    """Сохраняет полученные векторы в кэш и собирает ответ в порядке texts"""
+    if len(fetched) != len(missing):
+        return []
+    if missing:
+        cache.put_many(EMBED_MODEL or "", missing, fetched)
+
+    if EMBED_BACKEND == "local":
+        # Матрица заполняется строками кэша и полученной матрицей без списков Python
+        hits = [i for i, v in enumerate(vectors) if v is not None]
+        misses = [i for i, v in enumerate(vectors) if v is None]
+        fetched = np.asarray(fetched, dtype=np.float32)
+        dim = fetched.shape[1] if misses else len(vectors[hits[0]]) if hits else 0
+        result = np.empty((len(texts), dim), dtype=np.float32)
+        if hits:
+            result[hits] = np.stack([vectors[i] for i in hits])
+        if misses:
+            row_of = {t: row for row, t in enumerate(missing)}
+            result[misses] = fetched[[row_of[texts[i]] for i in misses]]
+        return result
+
+    fetched_by_text = dict(zip(missing, fetched))
+    return [v.tolist() if v is not None else fetched_by_text[t] for t, v in zip(texts, vectors)]
+
+def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Получает embeddings для батча текстов
+
+    Векторы ищутся в кэше по (EMBED_MODEL, sha256 текста); к модели
+    отправляются только промахи, без повторов одинаковых текстов.
+    С EMBED_BACKEND=local возвращается матрица float32 (n, dim).
+    """
+    cache = get_cache()
+    if cache is None:
+        return request_embeddings(texts)
+
+    vectors, missing = _cached(cache, texts)
+    fetched = request_embeddings(missing) if missing else []
+    return _merge(cache, texts, vectors, missing, fetched)
+
+async def request_embeddings_async(texts: List[str], session: aiohttp.ClientSession,
+                                   executor=None) -> List[List[float]]:
+    """Асинхронный вариант request_embeddings: не занимает поток на время запроса"""
+    if EMBED_BACKEND == "local":
+        # Модель считает на CPU - в пуле потоков, чтобы не блокировать event loop
+        return await asyncio.get_running_loop().run_in_executor(executor, request_embeddings, texts)
+
+    payload = {
+        "model": EMBED_MODEL,
+        "input": texts
+    }
+
+    try:
+        async with get_pool().post(session, "/embeddings", payload) as r:
+            r.raise_for_status()
+            data = await r.json()
+        return [item["embedding"] for item in data["data"]]
+    except Exception as e:
+        print(f"[EMBED ERROR] {str(e) or type(e).__name__}")
+        return []
+
+async def get_embeddings_async(texts: List[str], session: aiohttp.ClientSession,
+                               executor=None) -> List[List[float]]:
+    """
+    Асинхронный вариант get_embeddings с тем же кэшем
+
+    Запросы к SQLite кэшу и локальная модель блокируют поток, поэтому
+    идут в executor (пул вызывающего, None - пул asyncio по умолчанию);
+    в event loop остаётся только HTTP запрос к серверу эмбеддингов.
+    """
+    loop = asyncio.get_running_loop()
+    if EMBED_BACKEND == "local":
+        # Кэш и модель - одним вызовом в пуле
+        return await loop.run_in_executor(executor, get_embeddings, texts)
+    cache = get_cache()
+    if cache is None:
+        return await request_embeddings_async(texts, session, executor)
+
+    vectors, missing = await loop.run_in_executor(executor, _cached, cache, texts)
+    fetched = await request_embeddings_async(missing, session, executor) if missing else []
+    return await loop.run_in_executor(executor, _merge, cache, texts, vectors, missing, fetched)
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+from dotenv import load_dotenv
+
+from src.embeddings.provider import get_embeddings_async
+
+load_dotenv()
+
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", 2))  # Потоков для FAISS поиска
+STATS_WINDOW = 1000  # Последних запросов для перцентилей
+LOG_EVERY = 100  # Вызовов между выводом статистики
+STAGES = ("embed", "queue", "search", "total")
+
+class AsyncRetriever:
+    """
+    Асинхронный поиск для бота без общего пула потоков asyncio.
+
+    Эмбеддинг запроса - асинхронный HTTP запрос через пул серверов (поток
+    на время ожидания не занимается), кэш эмбеддингов, локальная модель,
+    поиск FAISS и чтение текстов - в собственном пуле из SEARCH_WORKERS
+    потоков. Для каждого этапа
+    собираются задержки (embed, queue - ожидание свободного потока,
+    search, total) и глубина очереди к пулу поиска.
+    """
+
+    def __init__(self, engine, get_session, workers: int = SEARCH_WORKERS):
+        self.engine = engine
+        self.get_session = get_session
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="search")
+        self.calls = 0
+        self.in_flight = 0  # Отправлено в пул поиска и ещё не завершено
+        self.max_queue_depth = 0
+        self._timings = {stage: deque(maxlen=STATS_WINDOW) for stage in STAGES}
+
+    @property
+    def queue_depth(self) -> int:
+        """Задач поиска, ждущих свободного потока"""
+        return max(0, self.in_flight - self.workers)
+
+    async def search_many(self, queries: List[str], top_k=4, return_vectors=False, return_snapshot=False):
+        """
+        То же, что SearchEngine.search_many, но не блокирует event loop
+
+        С return_snapshot=True к каждому результату добавляются индекс BM25
+        и поколение индекса, по которому шёл поиск: (вектор, результаты,
+        индекс BM25 или None, поколение или None)
+        """
+        if not queries:
+            return []
+        started = time.perf_counter()
+        query_embs = [None] * len(queries)
+        results, lexical, generation = [[] for _ in queries], None, None
+        embeddings = await get_embeddings_async(list(queries), self.get_session(), self.executor)
+        embedded = time.perf_counter()
+        self._timings["embed"].append(embedded - started)
+
+        if len(embeddings) == len(queries):
+            query_embs = embeddings
+            try:
+                results, lexical, generation = await self._in_executor(self._search, query_embs, top_k,
+                                                                       list(queries))
+            except Exception as e:
+                print(f"[SEARCH ERROR] {str(e)}")
+        self._timings["total"].append(time.perf_counter() - started)
+
+        self.calls += 1
+        if self.calls % LOG_EVERY == 0:
+            self._log()
+        if return_snapshot:
+            return [(query_emb, rows, lexical, generation) for query_emb, rows in zip(query_embs, results)]
+        if return_vectors:
+            return list(zip(query_embs, results))
+        return results
+
+    def _search(self, query_embs, top_k, queries):
+        return self.engine.search_vectors(query_embs, top_k, queries, return_snapshot=True)
+
+    async def _in_executor(self, fn, *args):
+        submitted = time.perf_counter()
+        self.in_flight += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        def job():
+            # Время начала меряется в потоке пула: разница с submitted - ожидание в очереди
+            began = time.perf_counter()
+            return began, fn(*args), time.perf_counter()
+
+        try:
+            began, result, finished = await asyncio.get_running_loop().run_in_executor(self.executor, job)
+        finally:
+            self.in_flight -= 1
+        self._timings["queue"].append(began - submitted)
+        self._timings["search"].append(finished - began)
+        return result
+
+    def stats(self) -> dict:
+        """p50/p99 задержек этапов в миллисекундах и состояние очереди"""
+        stats = {"calls": self.calls, "queue_depth": self.queue_depth,
+                 "max_queue_depth": self.max_queue_depth}
+        for stage, values in self._timings.items():
+            ms = np.array(values) * 1000 if values else np.zeros(1)
+            stats[f"{stage}_p50_ms"] = float(np.percentile(ms, 50))
+            stats[f"{stage}_p99_ms"] = float(np.percentile(ms, 99))
+        return stats
+
+    def _log(self):
+        stats = self.stats()
+        stages = "  ".join(f"{stage} p50={stats[f'{stage}_p50_ms']:.1f}/p99={stats[f'{stage}_p99_ms']:.1f} ms"
+                           for stage in STAGES)
+        print(f"[SEARCH] calls={stats['calls']} queue={stats['queue_depth']} "
+              f"(max {stats['max_queue_depth']})  {stages}")
+
+    def close(self):
+        self.executor.shutdown(wait=False)
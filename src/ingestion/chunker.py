@@ -1,6 +1,26 @@
+import os
+import re
+import hashlib
 from pathlib import Path
+from typing import Iterator, List, Tuple
+from dotenv import load_dotenv
+from src.storage.chunk_store import ChunkStore
+from src.storage.db import DocumentStore
+from src.ingestion.workers import Throughput, map_files
+
+load_dotenv()
 
 TXT_DIR = Path(__file__).resolve().parent.parent / "storage" / "files"
+CHUNKER = os.getenv("CHUNKER", "structured")  # structured или fixed (800 символов)
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 256))  # Бюджет чанка в токенах
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 32))
+
+# Оценка токенов без токенизатора модели: слова режутся на куски по 4
+# символа (примерно как BPE режет русские слова), знаки - отдельные токены
+TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+SENTENCE_BOUNDARY_RE = re.compile(r"(?<=[.!?…])\s+")
+HEADING_MAX_CHARS = 80
+SENTENCE_END = (".", "!", "?", "…", ":", ";", ",")
 
 def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100):
     """
@@ -15,16 +35,205 @@ def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100):
         start += chunk_size - overlap
     return chunks
 
-def process_all_txt():
-    for txt_file in TXT_DIR.glob("*.txt"):
-        text = txt_file.read_text(encoding="utf-8")
-        chunks = chunk_text(text)
-        chunk_dir = TXT_DIR / "chunks"
-        chunk_dir.mkdir(exist_ok=True)
-        for i, chunk in enumerate(chunks):
-            chunk_path = chunk_dir / f"{txt_file.stem}_chunk{i}.txt"
-            chunk_path.write_text(chunk, encoding="utf-8")
-        print(f"[CHUNK] {txt_file.name} -> {len(chunks)} chunks")
+def count_tokens(text: str) -> int:
+    """Приблизительное число токенов текста"""
+    return sum(1 for _ in TOKEN_RE.finditer(text))
+
+def _is_heading(line: str) -> bool:
+    """Короткая строка без знака препинания в конце - заголовок или подпись"""
+    return len(line) <= HEADING_MAX_CHARS and not line.endswith(SENTENCE_END)
+
+def _split_words(sentence: str, max_tokens: int) -> Iterator[Tuple[str, int, bool]]:
+    """Режет слишком длинное предложение по границам слов"""
+    words, size = [], 0
+    for word in sentence.split():
+        tokens = count_tokens(word)
+        if tokens > max_tokens:
+            # Слово длиннее бюджета (например, base64) - режем по символам
+            step = max_tokens * 4
+            pieces = [word[i:i + step] for i in range(0, len(word), step)]
+        else:
+            pieces = [word]
+        for piece in pieces:
+            tokens = count_tokens(piece)
+            if words and size + tokens > max_tokens:
+                yield " ".join(words), size, False
+                words, size = [], 0
+            words.append(piece)
+            size += tokens
+    if words:
+        yield " ".join(words), size, False
+
+def _segments(text: str, max_tokens: int) -> Iterator[Tuple[str, int, bool]]:
+    """
+    Неделимые куски текста: (текст, токены, заголовок ли)
+
+    Строка из extract_text_from_html (абзац, заголовок, пункт списка)
+    остаётся целой, если влезает в бюджет; иначе делится по предложениям,
+    а предложение - по словам.
+    """
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        tokens = count_tokens(line)
+        if tokens <= max_tokens:
+            yield line, tokens, _is_heading(line)
+            continue
+        for sentence in SENTENCE_BOUNDARY_RE.split(line):
+            tokens = count_tokens(sentence)
+            if tokens <= max_tokens:
+                yield sentence, tokens, False
+            else:
+                yield from _split_words(sentence, max_tokens)
+
+def chunk_structured(text: str, max_tokens: int = CHUNK_TOKENS,
+                     overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """
+    Разбивает текст на чанки по границам абзацев и заголовков в пределах бюджета токенов
+
+    Абзацы набираются в чанк жадно, пока помещаются в max_tokens.
+    Заголовки в конце чанка переносятся в начало следующего, чтобы
+    остаться рядом со своим текстом. Перекрытие - целые абзацы или
+    предложения с конца предыдущего чанка общим размером до
+    overlap_tokens. Каждый кусок текста обрабатывается O(1) раз, поэтому
+    время линейно от длины документа.
+    """
+    chunks = []
+    current = []  # (текст, токены, заголовок ли)
+    size = 0
+    repeated = 0  # Сколько кусков в начале current повторяют предыдущий чанк
+
+    for segment in _segments(text, max_tokens):
+        tokens = segment[1]
+        if current and size + tokens > max_tokens:
+            # Заголовки не оставляем в хвосте чанка, если в нём есть что-то ещё
+            carry = []
+            if any(not s[2] for s in current[repeated:]):
+                while current[-1][2]:
+                    carry.append(current.pop())
+                carry.reverse()
+            if len(current) > repeated:
+                chunks.append("\n".join(s[0] for s in current))
+
+            overlap = []
+            if not carry:
+                overlap_size = 0
+                for s in reversed(current):
+                    if s[2] or overlap_size + s[1] > overlap_tokens:
+                        break
+                    overlap.append(s)
+                    overlap_size += s[1]
+                overlap.reverse()
+
+            current, repeated = overlap + carry, len(overlap)
+            size = sum(s[1] for s in current)
+            if size + tokens > max_tokens:
+                # Перекрытие не помещается вместе с новым куском - обходимся без него
+                current, repeated = carry, 0
+                size = sum(s[1] for s in carry)
+                if size + tokens > max_tokens:
+                    chunks.append("\n".join(s[0] for s in carry))
+                    current, size = [], 0
+
+        current.append(segment)
+        size += tokens
+
+    if len(current) > repeated:
+        chunks.append("\n".join(s[0] for s in current))
+    return chunks
+
+def split_into_chunks(text: str) -> List[str]:
+    """Разбиение текста чанкером, выбранным в CHUNKER"""
+    if CHUNKER == "fixed":
+        return chunk_text(text)
+    return chunk_structured(text)
+
+def save_chunks(store: DocumentStore, chunk_store: ChunkStore, filename: str,
+                chunks: List[str]) -> Tuple[List[dict], List[str]]:
+    """
+    Сохраняет чанки документа: тексты в ChunkStore, описание в базу
+
+    Неизменённые чанки сохраняют прежнюю запись в хранилище (и вектор в
+    индексе), новые и изменённые дописываются одним вызовом.
+
+    Returns:
+        Записи чанков (chunk_id, position, content_hash, record_id, text)
+        и ID чанков документа, которых больше нет
+    """
+    stem = Path(filename).stem
+    existing = store.document_chunks(filename)
+    records = []
+    for i, chunk in enumerate(chunks):
+        chunk_id = f"{stem}_chunk{i}"
+        content_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+        old = existing.get(chunk_id)
+        record_id = old["record_id"] if old and old["hash"] == content_hash else None
+        if record_id is not None and record_id >= len(chunk_store):
+            record_id = None  # Хранилище было очищено
+        records.append({"chunk_id": chunk_id, "position": i, "content_hash": content_hash,
+                        "record_id": record_id, "text": chunk})
+
+    new_records = [r for r in records if r["record_id"] is None]
+    for record, record_id in zip(new_records, chunk_store.append([r["text"] for r in new_records])):
+        record["record_id"] = record_id
+    return records, store.replace_chunks(filename, records)
+
+def _chunk_file(txt_file: Path) -> dict:
+    """Разбиение одного текстового файла (выполняется в процессе-обработчике)"""
+    text = txt_file.read_text(encoding="utf-8")
+    return {"name": txt_file.name, "size": len(text.encode("utf-8")), "chunks": split_into_chunks(text)}
+
+def reset_chunks(store: DocumentStore, chunk_store: ChunkStore):
+    """
+    Очищает хранилище и базу чанков для полной перестройки
+
+    Номера записей после reset начинаются с нуля, а это и ID векторов:
+    старый индекс им больше не соответствует. Таблица vectors очищается
+    первой, поэтому следующий build_index увидит расхождение с индексом и
+    построит его заново, а не будет дописывать векторы под занятыми ID.
+    """
+    store.clear_vectors()
+    chunk_store.reset()
+    store.clear_chunks()
+
+def process_all_txt(store: DocumentStore = None, workers: int = 1,
+                    chunk_store: ChunkStore = None, full: bool = False):
+    """
+    Разбивает все текстовые файлы на чанки
+
+    Args:
+        store: База документов
+        workers: Число процессов (0 - по числу ядер)
+        chunk_store: Хранилище текстов чанков (по умолчанию src/storage/chunks.bin)
+        full: Очистить хранилище и записать все чанки заново
+    """
+    store = store or DocumentStore()
+    chunk_store = chunk_store if chunk_store is not None else ChunkStore()
+    if full:
+        reset_chunks(store, chunk_store)
+    files = sorted(TXT_DIR.glob("*.txt"))
+    throughput = Throughput("CHUNK")
+    chunked = []
+    for result in map_files(_chunk_file, files, workers):
+        throughput.add(result["size"])
+
+        # Документ стал короче - лишние чанки пропадают из базы, а значит и из индекса
+        filename = Path(result["name"]).stem + ".html"
+        save_chunks(store, chunk_store, filename, result["chunks"])
+        chunked.append({"filename": filename, "status": "chunked"})
+        print(f"[CHUNK] {result['name']} -> {len(result['chunks'])} chunks")
+
+    store.update_by_filename(chunked)
+    throughput.report()
+    print(f"[CHUNK] Chunk store: {len(chunk_store)} records, {chunk_store.size_bytes() / (1024 * 1024):.1f} MB")
 
 if __name__ == "__main__":
-    process_all_txt()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Разбиение текста на чанки")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов (0 - по числу ядер)")
+    parser.add_argument("--full", action="store_true", help="очистить хранилище чанков и записать заново")
+    args = parser.parse_args()
+
+    process_all_txt(workers=args.workers, full=args.full)
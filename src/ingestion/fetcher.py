@@ -1,24 +1,36 @@
 import os
+import asyncio
+import hashlib
 import httpx
-import json
 from pathlib import Path
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+from src.storage.db import DocumentStore
 
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent.parent / "storage" / "files"
 BASE_DIR.mkdir(parents=True, exist_ok=True)
-URL_MAPPING_FILE = BASE_DIR / "url_mapping.json"
 SSL_VERIFY = os.getenv("SSL_VERIFY", "false").lower() == "true"
 
+# Ограничения параллельной загрузки
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", 16))  # Всего одновременных запросов
+FETCH_PER_HOST = int(os.getenv("FETCH_PER_HOST", 4))  # Одновременных запросов к одному сайту
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", 3))
+FETCH_BACKOFF = 0.5  # Базовая пауза между повторами в секундах
+FETCH_TIMEOUT = 15
+FLUSH_EVERY = 50  # Сколько результатов копить перед записью в базу
+
+# Коды ответа, при которых имеет смысл повторить запрос
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 def slugify_url(url: str) -> str:
     """
     Преобразует URL в безопасное имя файла
-    
+
     Args:
         url: URL для преобразования
-        
+
     Returns:
         Безопасное имя файла
     """
@@ -26,80 +38,168 @@ def slugify_url(url: str) -> str:
     safe_path = parsed.netloc + parsed.path
     return safe_path.replace("/", "_").replace("?", "_").strip("_")
 
-def fetch_and_save(url: str):
+class Fetcher:
     """
-    Скачивает HTML страницы и сохраняет локально
-    
-    Args:
-        url: URL для скачивания
+    Асинхронный загрузчик страниц с общим пулом соединений.
+
+    Ограничивает число одновременных запросов глобально и для каждого
+    хоста, повторяет неудачные запросы с экспоненциальной паузой и
+    отправляет условные запросы (If-None-Match / If-Modified-Since) для
+    уже скачанных страниц, пропуская ответы 304.
     """
-    print(f"[FETCH] {url}")
-    try:
-        # Загрузка с учетом SSL_VERIFY
-        r = httpx.get(
-            url, 
-            timeout=15, 
-            follow_redirects=True,
-            verify=SSL_VERIFY
-        )
-        r.raise_for_status()
-
-        final_url = str(r.url)  # Конечный URL после редиректов
-        filename = slugify_url(final_url) + ".html"
-        filepath = BASE_DIR / filename
-
-        # Сохранение файла
-        filepath.write_text(r.text, encoding="utf-8")
-        print(f"[OK] Saved to {filepath}")
-
-        # Обновление маппинга URL
-        url_mapping = {}
-        if URL_MAPPING_FILE.exists():
+
+    def __init__(self, store: DocumentStore, base_dir: Path = BASE_DIR,
+                 concurrency: int = FETCH_CONCURRENCY, per_host: int = FETCH_PER_HOST,
+                 retries: int = FETCH_RETRIES, backoff: float = FETCH_BACKOFF):
+        self.store = store
+        self.base_dir = Path(base_dir)
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {"fetched": 0, "not_modified": 0, "failed": 0}
+        self._global_limit = asyncio.Semaphore(concurrency)
+        self._host_limits = {}
+        self._pending = []  # Результаты, ещё не записанные в базу
+
+    def _conditional_headers(self, doc: dict) -> dict:
+        """Заголовки условного запроса, если страница уже скачана"""
+        if not doc or not doc["filename"] or not (self.base_dir / doc["filename"]).exists():
+            return {}
+        headers = {}
+        if doc["etag"]:
+            headers["If-None-Match"] = doc["etag"]
+        if doc["last_modified"]:
+            headers["If-Modified-Since"] = doc["last_modified"]
+        return headers
+
+    def _record(self, row: dict):
+        """Копит результат загрузки и пишет в базу пакетами"""
+        self._pending.append(row)
+        if len(self._pending) >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные результаты одной транзакцией"""
+        if self._pending:
+            self.store.upsert_documents(self._pending)
+            self._pending = []
+
+    async def _request(self, client: httpx.AsyncClient, url: str, headers: dict) -> httpx.Response:
+        """GET с повторами при сетевых ошибках и временных кодах ответа"""
+        host = urlparse(url).netloc
+        host_limit = self._host_limits.setdefault(host, asyncio.Semaphore(self.per_host))
+
+        for attempt in range(self.retries + 1):
             try:
-                with open(URL_MAPPING_FILE, "r", encoding="utf-8") as f:
-                    url_mapping = json.load(f)
-            except json.JSONDecodeError:
-                print("[WARN] Invalid JSON in url_mapping, resetting")
-        
-        # Сохраняем оба URL (оригинальный и конечный)
-        url_mapping[filename] = {
-            "original_url": url,
-            "final_url": final_url
-        }
-        
-        with open(URL_MAPPING_FILE, "w", encoding="utf-8") as f:
-            json.dump(url_mapping, f, ensure_ascii=False, indent=2)
-
-    except httpx.HTTPError as e:
-        print(f"[HTTP ERROR] {url} -> {str(e)}")
-    except Exception as e:
-        print(f"[ERROR] {url} -> {str(e)}")
+                # Сначала слот хоста, чтобы не занимать общий слот в ожидании
+                async with host_limit, self._global_limit:
+                    r = await client.get(url, headers=headers)
+                if r.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return r
+                print(f"[RETRY] {url} -> {r.status_code}")
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                print(f"[RETRY] {url} -> {str(e)}")
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def fetch_and_save(self, client: httpx.AsyncClient, url: str) -> dict:
+        """
+        Скачивает HTML страницы и сохраняет локально
+
+        Args:
+            client: Общий HTTP клиент
+            url: URL для скачивания
+
+        Returns:
+            Результат загрузки: status (fetched / not_modified / failed),
+            filename, final_url и html для скачанной страницы
+        """
+        print(f"[FETCH] {url}")
+        try:
+            doc = self.store.get_document(url)
+            r = await self._request(client, url, self._conditional_headers(doc))
+            if r.status_code == 304:
+                # Статус этапа обработки не трогаем: содержимое не изменилось
+                self.stats["not_modified"] += 1
+                row = {"url": url, "http_status": 304}
+                if doc["status"] == "failed":
+                    row["status"] = "fetched"  # Прошлая ошибка была временной
+                self._record(row)
+                print(f"[NOT MODIFIED] {url}")
+                return {"url": url, "status": "not_modified", "filename": doc["filename"],
+                        "final_url": doc["final_url"], "stage": doc["status"]}
+            r.raise_for_status()
+
+            final_url = str(r.url)  # Конечный URL после редиректов
+            filename = slugify_url(final_url) + ".html"
+            filepath = self.base_dir / filename
+
+            # Сохранение файла
+            filepath.write_text(r.text, encoding="utf-8")
+            print(f"[OK] Saved to {filepath}")
+
+            # Сохраняем оба URL (оригинальный и конечный) и валидаторы кэша
+            self._record({
+                "url": url,
+                "final_url": final_url,
+                "filename": filename,
+                "status": "fetched",
+                "http_status": r.status_code,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "content_hash": hashlib.sha256(r.content).hexdigest()
+            })
+            self.stats["fetched"] += 1
+            return {"url": url, "status": "fetched", "filename": filename,
+                    "final_url": final_url, "html": r.text}
+
+        except httpx.HTTPError as e:
+            self.stats["failed"] += 1
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            self._record({"url": url, "status": "failed", "http_status": status})
+            print(f"[HTTP ERROR] {url} -> {str(e)}")
+        except Exception as e:
+            self.stats["failed"] += 1
+            self._record({"url": url, "status": "failed"})
+            print(f"[ERROR] {url} -> {str(e)}")
+        return {"url": url, "status": "failed"}
+
+    def client(self) -> httpx.AsyncClient:
+        """HTTP клиент с пулом соединений под лимиты загрузчика"""
+        limits = httpx.Limits(max_connections=self.concurrency,
+                              max_keepalive_connections=self.concurrency)
+        return httpx.AsyncClient(limits=limits, timeout=FETCH_TIMEOUT,
+                                 follow_redirects=True, verify=SSL_VERIFY)
+
+    async def fetch_all(self, urls: list) -> dict:
+        """Загружает все URL через общий пул соединений"""
+        try:
+            async with self.client() as client:
+                await asyncio.gather(*(self.fetch_and_save(client, url) for url in urls))
+        finally:
+            self.flush()
+        return self.stats
 
 def main():
     """Основная функция обработки URL"""
-    # Загрузка существующего маппинга
-    url_mapping = {}
-    if URL_MAPPING_FILE.exists():
-        try:
-            with open(URL_MAPPING_FILE, "r", encoding="utf-8") as f:
-                url_mapping = json.load(f)
-        except json.JSONDecodeError:
-            print("[ERROR] Corrupted url_mapping.json, resetting")
-            url_mapping = {}
-    
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Загрузка HTML-страниц из sources.txt")
+    parser.add_argument("--concurrency", type=int, default=FETCH_CONCURRENCY)
+    parser.add_argument("--per-host", type=int, default=FETCH_PER_HOST)
+    args = parser.parse_args()
+
     # Загрузка URL из файла
     with open("sources.txt", "r", encoding="utf-8") as f:
-        urls = [line.strip() for line in f if line.strip()]
-    
-    # Фильтрация уже обработанных URL
-    new_urls = [
-        url for url in urls 
-        if not any(slugify_url(url) in key for key in url_mapping)
-    ]
-    
-    # Обработка новых URL
-    for url in new_urls:
-        fetch_and_save(url)
+        urls = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    # Уже скачанные страницы запрашиваются условно и пропускаются при 304
+    fetcher = Fetcher(DocumentStore(), concurrency=args.concurrency, per_host=args.per_host)
+    stats = asyncio.run(fetcher.fetch_all(urls))
+    print(f"[FETCH] fetched={stats['fetched']} not_modified={stats['not_modified']} "
+          f"failed={stats['failed']}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,36 +1,91 @@
 import re
-from bs4 import BeautifulSoup, Comment
+import hashlib
+from bs4 import BeautifulSoup, Comment, Tag
 from pathlib import Path
+from src.storage.db import DocumentStore
+from src.ingestion.workers import Throughput, map_files
 
 BASE_DIR = Path(__file__).resolve().parent.parent / "storage" / "files"
 
+# Теги, которые никогда не содержат полезного текста
+REMOVED_TAGS = ["script", "style", "noscript", "header", "footer",
+                "nav", "aside", "form", "button", "input", "select"]
+
+# Запрещённые подстроки в class/id (ищутся как подстроки, как и раньше:
+# "ad" совпадает и с "header", и с "loading")
+BLACKLIST = ["advertisement", "ad", "popup", "modal", "cookie", "banner"]
+BLACKLIST_RE = re.compile("|".join(map(re.escape, BLACKLIST)))
+
+def _is_blacklisted(tag: Tag) -> bool:
+    """Проверяет class и id элемента на запрещённые слова"""
+    classes = tag.get("class", []) or []
+    id_val = tag.get("id", "") or ""
+    return bool(BLACKLIST_RE.search(" ".join(classes).lower()) or
+                BLACKLIST_RE.search(id_val.lower()))
+
+def _tags_without_text(roots: list) -> set:
+    """
+    Находит элементы без видимого текста за один обход снизу вверх
+
+    Возвращает id() элементов, у которых get_text().strip() пуст.
+    """
+    empty = set()
+    has_text = {}  # Есть ли в поддереве непустые строки основных типов
+    # Итеративный обход: потомки обрабатываются раньше предков
+    stack = [(root, False) for root in roots]
+    while stack:
+        node, children_done = stack.pop()
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.contents if isinstance(child, Tag))
+            continue
+
+        text = False
+        for child in node.contents:
+            if isinstance(child, Tag):
+                text = has_text[id(child)]
+            elif type(child) in Tag.MAIN_CONTENT_STRING_TYPES:
+                text = bool(child.strip())
+            if text:
+                break
+        has_text[id(node)] = text
+
+        if node.interesting_string_types != Tag.MAIN_CONTENT_STRING_TYPES:
+            # template, rt, rp считают свой текст по особым типам строк - редкий случай
+            if not node.get_text().strip():
+                empty.add(id(node))
+        elif not text:
+            empty.add(id(node))
+    return empty
+
 def extract_text_from_html(html_content: str) -> str:
-    """Извлекает чистый текст из HTML с улучшенной очисткой контента."""
+    """
+    Извлекает чистый текст из HTML с улучшенной очисткой контента.
+
+    Очистка выполняется за линейное время: пустота элементов считается
+    одним обходом снизу вверх, затем один обход сверху вниз удаляет
+    пустые и запрещённые элементы, не заходя в уже удалённые поддеревья.
+    """
     soup = BeautifulSoup(html_content, "lxml")
     
     # Удаляем ненужные элементы
-    for tag in soup(["script", "style", "noscript", "header", "footer", 
-                   "nav", "aside", "form", "button", "input", "select"]):
+    for tag in soup(REMOVED_TAGS):
         tag.decompose()
         
     # Удаляем комментарии
     for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
         comment.extract()
         
-    # Удаляем элементы с классами/ids, содержащими запрещенные слова
-    blacklist = ["advertisement", "ad", "popup", "modal", "cookie", "banner"]
-    for tag in soup.find_all(True):
-        classes = tag.get("class", []) or []
-        id_val = tag.get("id", "") or ""
-        
-        if (any(black_word in " ".join(classes).lower() for black_word in blacklist) or
-            any(black_word in id_val.lower() for black_word in blacklist)):
+    # Удаляем элементы с классами/ids, содержащими запрещенные слова, и пустые элементы
+    roots = [child for child in soup.contents if isinstance(child, Tag)]
+    empty = _tags_without_text(roots)
+    stack = roots[::-1]
+    while stack:
+        tag = stack.pop()
+        if _is_blacklisted(tag) or id(tag) in empty:
             tag.decompose()
             continue
-            
-        # Удаляем пустые элементы
-        if not tag.get_text().strip():
-            tag.decompose()
+        stack.extend(child for child in reversed(tag.contents) if isinstance(child, Tag))
 
     # Ищем основной контент
     main_selectors = [
@@ -76,22 +131,60 @@ def validate_parsing():
         elif "html" in text.lower() or "body" in text.lower():
             print(f"⚠️  Предупреждение: {html_file.name} возможно содержит неочищенный HTML")
 
-def process_all_html():
-    """Обрабатывает все HTML файлы с валидацией."""
-    for html_file in BASE_DIR.glob("*.html"):
-        try:
-            html_content = html_file.read_text(encoding="utf-8")
-            text = extract_text_from_html(html_content)
-            
-            txt_path = html_file.with_suffix(".txt")
-            txt_path.write_text(text, encoding="utf-8")
-            print(f"[PARSE] {html_file.name} -> {txt_path.name} ({len(text)} символов)")
-            
-        except Exception as e:
-            print(f"[ERROR] Ошибка обработки {html_file.name}: {str(e)}")
+def _parse_file(html_file: Path) -> dict:
+    """Разбор одного HTML файла (выполняется в процессе-обработчике)"""
+    try:
+        html_content = html_file.read_text(encoding="utf-8")
+        text = extract_text_from_html(html_content)
+
+        txt_path = html_file.with_suffix(".txt")
+        txt_path.write_text(text, encoding="utf-8")
+        return {
+            "filename": html_file.name,
+            "size": len(html_content.encode("utf-8")),
+            "chars": len(text),
+            "text_hash": hashlib.sha256(text.encode("utf-8")).hexdigest()
+        }
+    except Exception as e:
+        return {"filename": html_file.name, "error": str(e)}
+
+def process_all_html(store: DocumentStore = None, workers: int = 1):
+    """
+    Обрабатывает все HTML файлы с валидацией.
+
+    Args:
+        store: База документов
+        workers: Число процессов для разбора (0 - по числу ядер)
+    """
+    store = store or DocumentStore()
+    files = sorted(BASE_DIR.glob("*.html"))
+    throughput = Throughput("PARSE")
+    parsed = []
+    for result in map_files(_parse_file, files, workers):
+        if "error" in result:
+            print(f"[ERROR] Ошибка обработки {result['filename']}: {result['error']}")
+            continue
+        throughput.add(result["size"])
+        parsed.append({
+            "filename": result["filename"],
+            "status": "parsed",
+            "text_hash": result["text_hash"]
+        })
+        txt_name = Path(result["filename"]).with_suffix(".txt").name
+        print(f"[PARSE] {result['filename']} -> {txt_name} ({result['chars']} символов)")
+
+    # Статусы документов обновляются одной транзакцией
+    store.update_by_filename(parsed)
+    throughput.report()
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Парсинг HTML в чистый текст")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов (0 - по числу ядер)")
+    args = parser.parse_args()
+
     print("Запуск улучшенного парсера...")
-    process_all_html()
+    process_all_html(workers=args.workers)
     print("\nВалидация качества парсинга:")
-    validate_parsing()
\ No newline at end of file
+    validate_parsing()
@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.embeddings.indexer import BATCH_SIZE, IndexWriter, save_lexical
+from src.embeddings.provider import get_embeddings
+from src.ingestion.chunker import reset_chunks, save_chunks, split_into_chunks
+from src.ingestion.fetcher import BASE_DIR, FETCH_CONCURRENCY, FETCH_PER_HOST, Fetcher
+from src.ingestion.parser import extract_text_from_html
+from src.ingestion.workers import resolve_workers
+from src.storage.chunk_store import ChunkStore
+from src.storage.db import DocumentStore
+
+QUEUE_SIZE = 32  # Документов в каждой очереди между этапами
+CHECKPOINT_EVERY = 50  # Документов между сохранениями индекса
+DONE = None  # Маркер конца потока
+
+STAGES = ("fetch", "parse", "chunk", "embed", "index")
+
+class StageTimer:
+    """Учёт работы этапа: обработанные документы и время работы без ожидания очередей"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+
+    @contextmanager
+    def measure(self, items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy += time.perf_counter() - start
+            self.items += items
+
+class Pipeline:
+    """
+    Потоковый пайплайн загрузки: fetch -> parse -> chunk -> embed -> index.
+
+    Этапы работают одновременно и передают документы через ограниченные
+    очереди, поэтому в памяти одновременно находится не больше нескольких
+    десятков документов. Промежуточные txt-файлы не пишутся, тексты чанков
+    дописываются в ChunkStore. Прогресс фиксируется в базе документов и индексе каждые
+    CHECKPOINT_EVERY документов, так что прерванный запуск продолжается
+    с места остановки: неизменённые (304) и уже проиндексированные
+    страницы пропускаются.
+    """
+
+    def __init__(self, store: DocumentStore, base_dir: Path = BASE_DIR, workers: int = 0,
+                 concurrency: int = FETCH_CONCURRENCY, per_host: int = FETCH_PER_HOST,
+                 incremental: bool = True, queue_size: int = QUEUE_SIZE,
+                 chunk_store: ChunkStore = None):
+        self.store = store
+        self.chunk_store = chunk_store if chunk_store is not None else ChunkStore()
+        if not incremental:
+            # Полная перестройка заодно избавляет хранилище от старых версий чанков
+            reset_chunks(store, self.chunk_store)
+        self.base_dir = Path(base_dir)
+        self.workers = resolve_workers(workers)
+        self.incremental = incremental
+        self.queue_size = queue_size
+        self.fetcher = Fetcher(store, base_dir, concurrency=concurrency, per_host=per_host)
+        self.writer = IndexWriter(store, incremental)
+        self.timers = {name: StageTimer(name) for name in STAGES}
+        self.skipped = 0
+        self.failed = 0
+        self._indexed_docs = []  # Документы, ожидающие фиксации в базе
+        # IndexWriter не потокобезопасен: пока контрольная точка сохраняет
+        # индекс в потоке, этап чанков его не трогает
+        self._writer_lock = asyncio.Lock()
+
+    async def run(self, urls: list):
+        """Прогоняет URL через все этапы и печатает статистику"""
+        started = time.perf_counter()
+        fetched, parsed, chunked, embedded = (asyncio.Queue(self.queue_size) for _ in range(4))
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            await asyncio.gather(
+                self._fetch_stage(urls, fetched),
+                self._parse_stage(pool, fetched, parsed),
+                self._chunk_stage(parsed, chunked),
+                self._embed_stage(chunked, embedded),
+                self._index_stage(embedded)
+            )
+        await self._checkpoint()
+        if self.writer.index is not None:
+            # BM25 перестраивается целиком один раз в конце, а не на каждой контрольной точке
+            await asyncio.to_thread(save_lexical, self.writer, self.chunk_store)
+        self.report(time.perf_counter() - started)
+
+    def _to_document(self, result: dict):
+        """Решает, нужно ли обрабатывать результат загрузки дальше"""
+        if result["status"] == "fetched":
+            return {"filename": result["filename"], "final_url": result["final_url"],
+                    "html": result["html"]}
+        if result["status"] == "not_modified":
+            # Страница не изменилась: обрабатываем, только если прошлый запуск не дошёл до индекса
+            if self.incremental and result["stage"] == "indexed":
+                self.skipped += 1
+                return None
+            html = (self.base_dir / result["filename"]).read_text(encoding="utf-8")
+            return {"filename": result["filename"], "final_url": result["final_url"], "html": html}
+        self.failed += 1
+        return None
+
+    async def _fetch_stage(self, urls: list, out_q: asyncio.Queue):
+        """Загрузка страниц ограниченным числом обработчиков"""
+        url_q = asyncio.Queue()
+        for url in urls:
+            url_q.put_nowait(url)
+
+        async def worker(client):
+            while not url_q.empty():
+                url = url_q.get_nowait()
+                with self.timers["fetch"].measure():
+                    result = await self.fetcher.fetch_and_save(client, url)
+                try:
+                    doc = self._to_document(result)
+                except Exception as e:
+                    self.failed += 1
+                    print(f"[ERROR] {url} -> {str(e)}")
+                    continue
+                if doc is not None:
+                    await out_q.put(doc)
+
+        try:
+            async with self.fetcher.client() as client:
+                await asyncio.gather(*(worker(client) for _ in range(self.fetcher.concurrency)))
+        finally:
+            self.fetcher.flush()
+            await out_q.put(DONE)
+
+    async def _parse_stage(self, pool: ProcessPoolExecutor, in_q: asyncio.Queue, out_q: asyncio.Queue):
+        """Разбор HTML в пуле процессов (по одному документу на процесс)"""
+        loop = asyncio.get_running_loop()
+
+        async def worker():
+            while (doc := await in_q.get()) is not DONE:
+                try:
+                    with self.timers["parse"].measure():
+                        doc["text"] = await loop.run_in_executor(pool, extract_text_from_html, doc.pop("html"))
+                except Exception as e:
+                    self.failed += 1
+                    print(f"[ERROR] Ошибка обработки {doc['filename']}: {str(e)}")
+                    continue
+                await out_q.put(doc)
+            # Возвращаем маркер, чтобы его увидели остальные обработчики
+            await in_q.put(DONE)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        await out_q.put(DONE)
+
+    async def _chunk_stage(self, in_q: asyncio.Queue, out_q: asyncio.Queue):
+        """Разбиение на чанки и отбор чанков, которых нет в индексе"""
+        while (doc := await in_q.get()) is not DONE:
+            with self.timers["chunk"].measure():
+                text = doc.pop("text")
+                doc["text_hash"] = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                # Разбиение и запись чанков (файл хранилища, SQLite) - в потоке
+                chunks, stale = await asyncio.to_thread(self._save_chunks, doc["filename"], text)
+
+                # Чанки, которые документ больше не выдаёт, сразу убираем из индекса
+                async with self._writer_lock:
+                    self.writer.remove(stale)
+                    for chunk in chunks:
+                        self.writer.update_url(chunk["chunk_id"], doc["final_url"])
+                    doc["pending"] = [c for c in chunks if self.writer.needs_embedding(
+                        c["chunk_id"], c["content_hash"], c["record_id"])]
+            await out_q.put(doc)
+        await out_q.put(DONE)
+
+    def _save_chunks(self, filename: str, text: str):
+        return save_chunks(self.store, self.chunk_store, filename, split_into_chunks(text))
+
+    async def _embed_stage(self, in_q: asyncio.Queue, out_q: asyncio.Queue):
+        """Векторизация чанков батчами, общими для нескольких документов"""
+        batch_docs = []
+        batch_size = 0
+        while (doc := await in_q.get()) is not DONE:
+            batch_docs.append(doc)
+            batch_size += len(doc["pending"])
+            # Не ждём полного батча, если следующих документов пока нет
+            if batch_size >= BATCH_SIZE or in_q.empty():
+                await self._embed_documents(batch_docs, out_q)
+                batch_docs, batch_size = [], 0
+        if batch_docs:
+            await self._embed_documents(batch_docs, out_q)
+        await out_q.put(DONE)
+
+    async def _embed_documents(self, docs: list, out_q: asyncio.Queue):
+        texts = [c["text"] for doc in docs for c in doc["pending"]]
+        vectors = []
+        with self.timers["embed"].measure(len(docs)):
+            for i in range(0, len(texts), BATCH_SIZE):
+                batch = texts[i:i+BATCH_SIZE]
+                batch_embs = await asyncio.to_thread(get_embeddings, batch)
+                # Неудачный батч: документы с этими чанками повторятся при следующем запуске
+                vectors.extend(batch_embs if len(batch_embs) == len(batch) else [None] * len(batch))
+
+        offset = 0
+        for doc in docs:
+            doc["vectors"] = vectors[offset:offset + len(doc["pending"])]
+            offset += len(doc["pending"])
+            if any(v is None for v in doc["vectors"]):
+                self.failed += 1
+                print(f"[ERROR] Embedding failed for {doc['filename']}")
+                continue
+            await out_q.put(doc)
+
+    async def _index_stage(self, in_q: asyncio.Queue):
+        """Добавление векторов в индекс с периодическим сохранением"""
+        while (doc := await in_q.get()) is not DONE:
+            with self.timers["index"].measure():
+                pending = doc["pending"]
+                if pending:
+                    self.writer.add(
+                        [c["chunk_id"] for c in pending],
+                        [c["content_hash"] for c in pending],
+                        [c["record_id"] for c in pending],
+                        [doc["final_url"]] * len(pending),
+                        doc["vectors"]
+                    )
+                self._indexed_docs.append({"filename": doc["filename"], "status": "indexed",
+                                           "text_hash": doc["text_hash"]})
+                if len(self._indexed_docs) >= CHECKPOINT_EVERY:
+                    await self._checkpoint()
+
+    async def _checkpoint(self):
+        """Сохраняет индекс и отмечает документы как проиндексированные"""
+        async with self._writer_lock:
+            docs, self._indexed_docs = self._indexed_docs, []
+            # Обучение, запись индекса и базы занимают секунды - не на event loop
+            await asyncio.to_thread(self._commit, docs)
+
+    def _commit(self, docs: list):
+        if self.writer.changed:
+            self.writer.save()
+        if docs:
+            self.store.update_by_filename(docs)
+
+    def report(self, elapsed: float):
+        """Печатает статистику по этапам"""
+        stats = self.fetcher.stats
+        print(f"[PIPELINE] fetched={stats['fetched']} not_modified={stats['not_modified']} "
+              f"skipped={self.skipped} failed={self.failed}")
+        for timer in self.timers.values():
+            print(f"[PIPELINE] {timer.name:<6} {timer.items:6d} docs  {timer.busy:8.2f}s busy")
+        total = self.writer.index.ntotal if self.writer.index is not None else 0
+        print(f"[PIPELINE] index: {total} vectors, wall time {elapsed:.2f}s")
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Потоковый пайплайн: загрузка -> парсинг -> чанки -> индекс")
+    parser.add_argument("--sources", default="sources.txt", help="файл со списком URL")
+    parser.add_argument("--workers", type=int, default=0, help="процессов для парсинга (0 - по числу ядер)")
+    parser.add_argument("--concurrency", type=int, default=FETCH_CONCURRENCY)
+    parser.add_argument("--per-host", type=int, default=FETCH_PER_HOST)
+    parser.add_argument("--full", action="store_true", help="перестроить индекс с нуля")
+    args = parser.parse_args()
+
+    with open(args.sources, "r", encoding="utf-8") as f:
+        urls = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+    pipeline = Pipeline(DocumentStore(), workers=args.workers, concurrency=args.concurrency,
+                        per_host=args.per_host, incremental=not args.full)
+    asyncio.run(pipeline.run(urls))
+
+if __name__ == "__main__":
+    main()
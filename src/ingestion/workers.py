@@ -0,0 +1,49 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List
+
+def resolve_workers(workers: int) -> int:
+    """0 или отрицательное значение - по числу ядер"""
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+def map_files(fn: Callable, items: List, workers: int = 1) -> Iterator:
+    """
+    Применяет fn к файлам в пуле процессов с сохранением порядка
+
+    Файлы раздаются процессам пачками, чтобы не платить за пересылку
+    каждого файла отдельно; результаты возвращаются в порядке items.
+
+    Args:
+        fn: Функция уровня модуля (должна сериализоваться pickle)
+        items: Список файлов
+        workers: Число процессов; 1 - обработка в текущем процессе
+    """
+    workers = resolve_workers(workers)
+    if workers == 1 or len(items) < 2:
+        yield from map(fn, items)
+        return
+
+    # Несколько пачек на процесс сглаживают разницу в размерах файлов
+    chunksize = max(1, len(items) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(fn, items, chunksize=chunksize)
+
+class Throughput:
+    """Счётчик пропускной способности этапа: файлы/с и МБ/с"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.files = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+
+    def add(self, size: int):
+        self.files += 1
+        self.bytes += size
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        mb = self.bytes / (1024 * 1024)
+        print(f"[{self.stage}] {self.files} files, {mb:.1f} MB in {elapsed:.2f}s "
+              f"({self.files / elapsed:.1f} files/s, {mb / elapsed:.2f} MB/s)")
@@ -0,0 +1,106 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "true").lower() == "true"
+# Минимальное косинусное сходство запросов, при котором ответ переиспользуется
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 3600))  # Секунд жизни ответа
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    return vector / max(float(np.linalg.norm(vector)), 1e-9)
+
+class AnswerCache:
+    """
+    Кэш готовых ответов LLM по смыслу запроса.
+
+    Ответ переиспользуется, если вектор нового запроса близок к
+    сохранённому (косинус не ниже threshold) и поиск вернул те же чанки:
+    совпадение чанков гарантирует, что ответ построен на том же контексте.
+    Записи живут ttl секунд, при переполнении вытесняются давно не
+    использованные. Смена поколения индекса (SearchEngine.generation)
+    очищает кэш. Рассчитан на вызовы из одного event loop.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, ttl: float = ANSWER_CACHE_TTL,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # ключ -> (вектор, ID чанков, ответ, parse_mode, время записи)
+        self._next_key = 0
+        self._keys = []
+        self._matrix = None  # Векторы всех записей для сравнения одним умножением
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self._entries:
+                print(f"[CACHE] Index generation changed, dropping {len(self._entries)} answers")
+            self.clear()
+            self.generation = generation
+
+    def _expire(self, now: float):
+        expired = [key for key, entry in self._entries.items() if now - entry[4] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def get(self, query_emb, chunk_ids, generation) -> Optional[tuple]:
+        """(ответ, parse_mode) похожего запроса с теми же чанками или None"""
+        self._check_generation(generation)
+        self._expire(time.monotonic())
+        if self._entries:
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key][0] for key in self._keys])
+            similarities = self._matrix @ _normalize(query_emb)
+            chunk_ids = tuple(chunk_ids)
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                key = self._keys[i]
+                entry = self._entries[key]
+                if entry[1] == chunk_ids:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2], entry[3]
+        self.misses += 1
+        return None
+
+    def put(self, query_emb, chunk_ids, generation, answer: str, parse_mode: Optional[str]):
+        self._check_generation(generation)
+        self._entries[self._next_key] = (_normalize(query_emb), tuple(chunk_ids), answer,
+                                         parse_mode, time.monotonic())
+        self._next_key += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+    def clear(self):
+        self._entries.clear()
+        self._matrix = None
+
+    def stats(self) -> dict:
+        """Статистика попаданий для мониторинга"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
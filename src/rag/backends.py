@@ -0,0 +1,216 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import aiohttp
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Адреса OpenAI-совместимых серверов (LM Studio) через запятую
+LLM_BACKENDS = [url.strip().rstrip("/") for url in (
+    os.getenv("LLM_BACKENDS") or os.getenv("LMSTUDIO_BASE_URL", "http://localhost:1234/v1")
+).split(",") if url.strip()]
+BACKEND_FAILURES = int(os.getenv("BACKEND_FAILURES", 3))  # Ошибок подряд до отключения
+BACKEND_COOLDOWN = float(os.getenv("BACKEND_COOLDOWN", 30))  # Секунд до пробного запроса
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", 10))  # Секунд между проверками
+HEALTH_TIMEOUT = 5
+
+class BackendUnavailableError(Exception):
+    """Ни один сервер не смог обработать запрос"""
+
+class Backend:
+    """Сервер и его состояние: запросы в работе и автомат отключения"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0  # Ошибок подряд
+        self.opened_at = None  # Время отключения (None - сервер в работе)
+        self.trial = False  # Идёт пробный запрос после паузы
+        self.requests = 0
+        self.errors = 0
+        self.last_used = 0
+
+    def available(self, now: float, cooldown: float) -> bool:
+        if self.opened_at is None:
+            return True
+        # После паузы пропускаем один пробный запрос
+        return not self.trial and now - self.opened_at >= cooldown
+
+class BackendPool:
+    """
+    Балансировка запросов между несколькими серверами LLM.
+
+    Запрос уходит на доступный сервер с наименьшим числом запросов в
+    работе (при равенстве - на давно не использованный). Сетевые ошибки,
+    таймауты и ответы 5xx считаются отказом сервера: после failures
+    отказов подряд сервер отключается (circuit breaker) на cooldown
+    секунд, затем получает один пробный запрос. Неудачный запрос
+    повторяется на следующем сервере, пока ответ ещё не начал читаться.
+    Фоновая проверка GET /models возвращает восстановившиеся серверы
+    раньше и отключает упавшие до того, как на них придут пользователи.
+
+    Пул общий для генерации (aiohttp) и эмбеддингов (requests из потоков),
+    поэтому состояние защищено блокировкой.
+    """
+
+    def __init__(self, urls: List[str] = None, failures: int = BACKEND_FAILURES,
+                 cooldown: float = BACKEND_COOLDOWN, clock=time.monotonic):
+        urls = LLM_BACKENDS if urls is None else urls
+        if not urls:
+            raise ValueError("At least one backend URL is required")
+        self.backends = [Backend(url.rstrip("/")) for url in urls]
+        self.failure_threshold = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self._picks = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()) -> Optional[Backend]:
+        """Сервер для следующего запроса или None, если доступных нет"""
+        with self._lock:
+            now = self.clock()
+            candidates = [b for b in self.backends
+                          if b not in exclude and b.available(now, self.cooldown)]
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda b: (b.outstanding, b.last_used))
+            if backend.opened_at is not None:
+                backend.trial = True
+            self._picks += 1
+            backend.last_used = self._picks
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend: Backend, ok: bool):
+        """Учитывает результат запроса"""
+        with self._lock:
+            backend.outstanding -= 1
+            backend.trial = False
+            if ok:
+                backend.failures = 0
+                if backend.opened_at is not None:
+                    print(f"[BACKEND] {backend.url} is back")
+                backend.opened_at = None
+                return
+            backend.errors += 1
+            backend.failures += 1
+            if backend.opened_at is not None or backend.failures >= self.failure_threshold:
+                if backend.opened_at is None:
+                    print(f"[BACKEND] {backend.url} disabled after {backend.failures} failures")
+                backend.opened_at = self.clock()
+
+    def mark_health(self, backend: Backend, ok: bool):
+        """Результат проверки здоровья: включает или отключает сервер"""
+        with self._lock:
+            if ok:
+                if backend.opened_at is not None:
+                    print(f"[BACKEND] {backend.url} passed health check")
+                backend.failures = 0
+                backend.opened_at = None
+            elif backend.opened_at is None:
+                print(f"[BACKEND] {backend.url} failed health check")
+                backend.failures = self.failure_threshold
+                backend.opened_at = self.clock()
+            elif not backend.trial:
+                backend.opened_at = self.clock()
+
+    @asynccontextmanager
+    async def post(self, session: aiohttp.ClientSession, path: str, payload: dict):
+        """
+        POST на наименее загруженный сервер с переключением при отказе
+
+        Отдаёт ответ сервера (статус < 500); ошибки при чтении ответа
+        тоже засчитываются серверу.
+        """
+        tried = []
+        while True:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                raise BackendUnavailableError(f"No LLM backend available for {path}")
+            tried.append(backend)
+            try:
+                response = await session.post(f"{backend.url}{path}", json=payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"[BACKEND] {backend.url}{path} failed: {str(e) or type(e).__name__}")
+                self.release(backend, ok=False)
+                continue
+            if response.status >= 500:
+                print(f"[BACKEND] {backend.url}{path} returned {response.status}")
+                response.release()
+                self.release(backend, ok=False)
+                continue
+
+            ok = True
+            try:
+                yield response
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+                raise
+            finally:
+                response.release()
+                self.release(backend, ok)
+            return
+
+    def post_sync(self, path: str, payload: dict, timeout: float = 60) -> requests.Response:
+        """То же для синхронного кода (requests): ответ со статусом < 500"""
+        tried = []
+        while True:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                raise BackendUnavailableError(f"No LLM backend available for {path}")
+            tried.append(backend)
+            try:
+                response = requests.post(f"{backend.url}{path}", json=payload, timeout=timeout)
+            except requests.RequestException as e:
+                print(f"[BACKEND] {backend.url}{path} failed: {str(e)}")
+                self.release(backend, ok=False)
+                continue
+            self.release(backend, ok=response.status_code < 500)
+            if response.status_code >= 500:
+                print(f"[BACKEND] {backend.url}{path} returned {response.status_code}")
+                continue
+            return response
+
+    async def check_health(self, session: aiohttp.ClientSession):
+        """Один раунд проверки GET /models всех серверов"""
+        async def check(backend):
+            try:
+                async with session.get(f"{backend.url}/models",
+                                       timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as response:
+                    ok = response.status < 500
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            self.mark_health(backend, ok)
+
+        await asyncio.gather(*(check(b) for b in self.backends))
+
+    async def run_health_checks(self, session: aiohttp.ClientSession, interval: float = HEALTH_INTERVAL):
+        """Фоновая задача проверки здоровья на всё время работы бота"""
+        while True:
+            await self.check_health(session)
+            await asyncio.sleep(interval)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [{"url": b.url, "outstanding": b.outstanding, "requests": b.requests,
+                     "errors": b.errors, "healthy": b.opened_at is None}
+                    for b in self.backends]
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> BackendPool:
+    """Общий пул серверов процесса для генерации и эмбеддингов"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BackendPool()
+    return _pool
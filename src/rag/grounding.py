@@ -0,0 +1,83 @@
+import os
+import re
+from typing import List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from src.embeddings.lexical import LexicalIndex, tokenize
+
+load_dotenv()
+
+# Доля IDF-веса слов ответа, которая должна найтись в контексте
+GROUNDING_THRESHOLD = float(os.getenv("GROUNDING_THRESHOLD", 0.25))
+MIN_TERM_LEN = 4  # Короткие основы почти ничего не говорят о содержании
+MIN_ANSWER_WORDS = 5
+
+# Явные признаки того, что модель не нашла ответ в контексте
+UNCERTAINTY_PHRASES = (
+    "я не уверен", "не знаю", "не могу сказать",
+    "не имею информации", "не могу найти", "не располагаю данными",
+    "у меня нет данных", "информация отсутствует",
+)
+
+def compile_phrases(phrases) -> re.Pattern:
+    """Одно регулярное выражение на все фразы: ответ просматривается за один проход"""
+    alternatives = sorted({p.lower() for p in phrases}, key=len, reverse=True)
+    return re.compile("|".join(re.escape(p) for p in alternatives), re.IGNORECASE)
+
+UNCERTAINTY_RE = compile_phrases(UNCERTAINTY_PHRASES)
+CITATION_RE = re.compile(r"\[\d+\]")
+
+class GroundingChecker:
+    """
+    Проверка, что ответ LLM опирается на найденный контекст.
+
+    Сигнатуры чанков (их термины и IDF) строятся вместе с индексом BM25,
+    поэтому при ответе остаётся разбить на основы только сам ответ и
+    сравнить его термины с объединением терминов чанков контекста.
+    Оценка - доля IDF-веса терминов ответа, найденных в контексте: редкие
+    слова (названия клиентов, технологий) весят больше общих, а слова,
+    которых нет во всём корпусе, - как самые редкие. Без индекса BM25
+    сигнатура строится по тексту контекста с одинаковыми весами.
+
+    Фразы неопределённости ищутся одним скомпилированным выражением.
+    """
+
+    def __init__(self, threshold: float = GROUNDING_THRESHOLD, phrases=UNCERTAINTY_PHRASES):
+        self.threshold = threshold
+        self.uncertainty_re = UNCERTAINTY_RE if phrases is UNCERTAINTY_PHRASES else compile_phrases(phrases)
+
+    def score(self, answer: str, context: str = "", lexical: Optional[LexicalIndex] = None,
+              chunk_ids: List[int] = None) -> float:
+        """Доля (0..1) IDF-веса терминов ответа, которые есть в контексте"""
+        terms = sorted({t for t in tokenize(answer) if len(t) >= MIN_TERM_LEN})
+        if not terms:
+            return 1.0
+
+        signature = lexical.chunk_terms(chunk_ids) if lexical is not None and chunk_ids else None
+        if signature is not None:
+            ids = np.fromiter((lexical.vocab.get(t, -1) for t in terms), dtype="int64", count=len(terms))
+            known = ids >= 0
+            weights = np.where(known, lexical.idf[np.maximum(ids, 0)], lexical.max_idf)
+            in_context = np.zeros(len(lexical.idf), dtype=bool)
+            in_context[signature] = True
+            grounded = known & in_context[np.maximum(ids, 0)]
+        else:
+            context_terms = set(tokenize(context))
+            weights = np.ones(len(terms), dtype="float32")
+            grounded = np.fromiter((t in context_terms for t in terms), dtype=bool, count=len(terms))
+        return float(weights[grounded].sum() / weights.sum())
+
+    def is_hallucination(self, answer: str, context: str = "", lexical: Optional[LexicalIndex] = None,
+                         chunk_ids: List[int] = None) -> bool:
+        """True, если ответ вероятно не опирается на контекст"""
+        # Очень консервативный подход: только явные признаки галлюцинаций
+        if self.uncertainty_re.search(answer):
+            return True
+        # Ответ со ссылками на источники, вероятно, не галлюцинация
+        if CITATION_RE.search(answer):
+            return False
+        if len(answer.split()) < MIN_ANSWER_WORDS:
+            return False
+        return self.score(answer, context, lexical, chunk_ids) < self.threshold
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 2))  # Одновременных генераций
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 8))  # Ждущих сверх этого - сразу отказ
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 60))  # Секунд ожидания в очереди
+
+class QueueFullError(Exception):
+    """Очередь генераций переполнена или ожидание слишком долгое"""
+
+class GenerationLimiter:
+    """
+    Ограничение одновременных генераций с очередью по порядку прихода.
+
+    Не больше max_active запросов к LLM одновременно; остальные ждут в
+    очереди не длиннее max_queue. Если очередь полна или ожидание дольше
+    max_wait, запрос сразу получает QueueFullError, а не таймаут через
+    две минуты. Ждущим сообщается их позиция: on_position(n) вызывается при
+    постановке и каждом сдвиге очереди, on_position(0) - когда слот получен
+    после ожидания. Работает внутри одного event loop.
+    """
+
+    def __init__(self, max_active: int = LLM_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE,
+                 max_wait: float = LLM_QUEUE_TIMEOUT):
+        self.max_active = max(1, max_active)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.granted = 0
+        self.rejected = 0
+        self.max_wait_seen = 0.0
+        self._waiters = deque()  # (future, on_position)
+        self._notifications = set()  # Задачи уведомлений: event loop хранит только слабые ссылки
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @asynccontextmanager
+    async def slot(self, on_position=None):
+        await self.acquire(on_position)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, on_position=None):
+        if self.active < self.max_active and not self._waiters:
+            self.active += 1
+            self.granted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(f"{len(self._waiters)} generations already queued")
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, on_position)
+        self._waiters.append(waiter)
+        started = time.perf_counter()
+        self._notify(on_position, len(self._waiters))
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self._drop(waiter)
+            self.rejected += 1
+            raise QueueFullError(f"waited more than {self.max_wait:.0f}s for a generation slot")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже передан нам - отдаём следующему
+                self.release()
+            else:
+                self._drop(waiter)
+            raise
+
+        self.granted += 1
+        self.max_wait_seen = max(self.max_wait_seen, time.perf_counter() - started)
+        self._notify(on_position, 0)
+
+    def release(self):
+        """Передаёт слот первому ждущему или освобождает его"""
+        while self._waiters:
+            future, _ = self._waiters.popleft()
+            if not future.done():
+                # active не меняется: слот переходит к ждущему
+                future.set_result(None)
+                self._notify_positions()
+                return
+        self.active -= 1
+
+    def _drop(self, waiter):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            self._notify_positions()
+
+    def _notify_positions(self):
+        for position, (_, on_position) in enumerate(self._waiters, start=1):
+            self._notify(on_position, position)
+
+    def _notify(self, on_position, position: int):
+        if on_position is None:
+            return
+        task = asyncio.ensure_future(on_position(position))
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+        # Ошибки уведомления (например, правки сообщения) не влияют на очередь
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": len(self._waiters),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "max_wait_s": self.max_wait_seen
+        }
@@ -1,31 +1,175 @@
+import os
+import re
+import threading
+from typing import Callable, List, Tuple
+
+from dotenv import load_dotenv
+
+from src.ingestion.chunker import SENTENCE_BOUNDARY_RE, count_tokens
+
+load_dotenv()
+
+CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", 1024))  # Бюджет контекста в токенах модели
+# Токенизатор LLM (имя или путь для transformers); пусто - оценка как в чанкере
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "")
+CHUNK_SEPARATOR = "\n---\n"
+WORD_BOUNDARY_RE = re.compile(r"\s+")
+
+# Раскладка промпта: prefix (неизменная инструкция отдельным сообщением) или single
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "prefix").lower()
+PROMPT_LAYOUTS = ("prefix", "single")
+# Просить сервер держать KV кэш общего начала промпта (cache_prompt в llama.cpp)
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "true").lower() == "true"
+
+# Неизменная часть промпта: всё, что зависит от запроса, идёт после неё
+SYSTEM_PROMPT = (
+    "Ты — ассистент компании EORA. Отвечай на вопросы, используя только предоставленный контекст.\n\n"
+    "### СТРОГИЕ ИНСТРУКЦИИ ПО ССЫЛКАМ:\n"
+    "1. Используй ссылки ТОЛЬКО когда напрямую цитируешь конкретный кейс или решение из контекста\n"
+    "2. НЕ создавай ссылки самостоятельно - используй ТОЛЬКО предоставленные\n"
+    "3. Нумерация ссылок должна быть последовательной: [1], [2], [3] без пропусков\n"
+    "4. Если вопрос общий (не о конкретном проекте) - НЕ используй ссылки\n"
+    "5. Для вопросов не о EORA - вежливо откажись отвечать БЕЗ ссылок\n"
+    "6. Примеры правильного использования:\n"
+    "   - 'Мы разработали систему для Lamoda [1]'\n"
+    "   - 'Для KazanExpress создали поиск по фото [2]'\n"
+    "7. Примеры НЕправильного использования:\n"
+    "   - Упоминание решения без ссылки на конкретный источник\n"
+    "   - Ссылки на общие вопросы\n"
+    "   - Пропуск номеров ([1], [3] без [2])"
+)
+
+_counter = None
+_counter_lock = threading.Lock()
+
+def _load_counter(name: str) -> Callable[[str], int]:
+    if not name:
+        return count_tokens
+    try:
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise RuntimeError("CONTEXT_TOKENIZER requires transformers "
+                           "(pip install sentence-transformers)") from e
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    print(f"[PROMPT] Counting context tokens with {name}")
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+def get_token_counter() -> Callable[[str], int]:
+    """Счётчик токенов контекста (токенизатор загружается при первом обращении)"""
+    global _counter
+    if _counter is None:
+        with _counter_lock:
+            if _counter is None:
+                _counter = _load_counter(CONTEXT_TOKENIZER)
+    return _counter
+
+def _trim(text: str, budget: int, count: Callable[[str], int], by_words: bool = False) -> str:
+    """
+    Самое длинное начало текста до границы предложения (или слова), влезающее в budget
+
+    Число токенов начала растёт с его длиной, поэтому граница ищется
+    двоичным поиском: O(log n) вызовов токенизатора, а не по одному на границу.
+    """
+    cuts = [m.start() for m in (WORD_BOUNDARY_RE if by_words else SENTENCE_BOUNDARY_RE).finditer(text)]
+    fits = 0  # cuts[:fits] влезают в бюджет
+    end = len(cuts)
+    while fits < end:
+        middle = (fits + end) // 2
+        if count(text[:cuts[middle]]) <= budget:
+            fits = middle + 1
+        else:
+            end = middle
+    return text[:cuts[fits - 1]] if fits else ""
+
+def pack_context(chunks: List[dict], budget: int = CONTEXT_TOKENS,
+                 count: Callable[[str], int] = None) -> Tuple[str, List[str], int, List[int]]:
+    """
+    Собирает контекст из найденных чанков в бюджет токенов
+
+    Чанки идут в порядке ранжирования и добавляются целиком, пока влезают;
+    не влезающий чанк обрезается по границе предложения, а чанк, от
+    которого не влезает ни одного предложения, пропускается. Лучший чанк
+    попадает в контекст всегда (в крайнем случае обрезанным по словам).
+    Источники нумеруются по порядку попадания в контекст, и каждый чанк
+    помечен номером своего источника, поэтому [n] в ответе указывает ровно
+    на то, что видела модель. Чанки без URL идут в контекст без номера.
+    ID возвращаются только у чанков, попавших в контекст целиком: по их
+    сигнатурам проверяется ответ, а обрезанный чанк модель видела не весь.
+
+    Args:
+        chunks: Результаты поиска (text, url, id) по убыванию релевантности
+        budget: Бюджет контекста в токенах
+        count: Счётчик токенов, по умолчанию - токенизатор модели
+
+    Returns:
+        (контекст, список URL источников, токенов контекста, ID целых чанков)
+    """
+    count = count or get_token_counter()
+    blocks, sources, packed = [], [], []
+    used = 0
+    for chunk in chunks:
+        url = chunk.get("url", "")
+        if not url or url == "unknown_url":
+            url, label = None, ""
+        else:
+            label = f"[{sources.index(url) + 1 if url in sources else len(sources) + 1}] "
+        cost = count(label) + (count(CHUNK_SEPARATOR) if blocks else 0)
+        remaining = budget - used - cost
+        if remaining <= 0:
+            break
+        text = chunk["text"].strip()
+        tokens = count(text)
+        if tokens > remaining:
+            text = _trim(text, remaining, count) or (_trim(text, remaining, count, by_words=True)
+                                                     if not blocks else "")
+            if not text:
+                continue
+            tokens = count(text)
+        elif chunk.get("id") is not None:
+            packed.append(chunk["id"])
+        if url is not None and url not in sources:
+            sources.append(url)
+        blocks.append(label + text)
+        used += cost + tokens
+    return CHUNK_SEPARATOR.join(blocks), sources, used, packed
+
+def build_context_block(context: str, sources: list) -> str:
+    """Источники и контекст - часть промпта, меняющаяся от запроса к запросу"""
+    sources_list = "\n".join([f"[{i+1}] {url}" for i, url in enumerate(sources)])
+    return f"### Источники:\n{sources_list}\n\n### Контекст:\n{context}"
+
 def build_system_prompt(context: str, sources: list) -> str:
     """
     Формирует системный промпт для LLM с инструкциями по форматированию ссылок
     
     Args:
-        context: Текст контекста для ответа
-        sources: Список URL источников
+        context: Контекст для ответа, собранный pack_context
+        sources: Список URL источников в нумерации контекста
         
     Returns:
         Строка с форматированным системным промптом
     """
-    sources_list = "\n".join([f"[{i+1}] {url}" for i, url in enumerate(sources)])
-    
-    return (
-        "Ты — ассистент компании EORA. Отвечай на вопросы, используя только предоставленный контекст.\n\n"
-        "### СТРОГИЕ ИНСТРУКЦИИ ПО ССЫЛКАМ:\n"
-        "1. Используй ссылки ТОЛЬКО когда напрямую цитируешь конкретный кейс или решение из контекста\n"
-        "2. НЕ создавай ссылки самостоятельно - используй ТОЛЬКО предоставленные\n"
-        "3. Нумерация ссылок должна быть последовательной: [1], [2], [3] без пропусков\n"
-        "4. Если вопрос общий (не о конкретном проекте) - НЕ используй ссылки\n"
-        "5. Для вопросов не о EORA - вежливо откажись отвечать БЕЗ ссылок\n"
-        "6. Примеры правильного использования:\n"
-        "   - 'Мы разработали систему для Lamoda [1]'\n"
-        "   - 'Для KazanExpress создали поиск по фото [2]'\n"
-        "7. Примеры НЕправильного использования:\n"
-        "   - Упоминание решения без ссылки на конкретный источник\n"
-        "   - Ссылки на общие вопросы\n"
-        "   - Пропуск номеров ([1], [3] без [2])\n\n"
-        f"### Источники:\n{sources_list}\n\n"
-        f"### Контекст:\n{context[:2000]}"  # Ограничение длины контекста
-    )
\ No newline at end of file
+    return f"{SYSTEM_PROMPT}\n\n{build_context_block(context, sources)}"
+
+def build_messages(question: str, context: str, sources: list, layout: str = PROMPT_LAYOUT) -> list:
+    """
+    Сообщения чата для LLM
+
+    prefix: инструкция SYSTEM_PROMPT - отдельное системное сообщение,
+    одинаковое до байта во всех запросах, а источники, контекст и вопрос
+    идут последним сообщением пользователя. Сервер с кэшем промпта
+    (cache_prompt в llama.cpp) не пересчитывает инструкцию при каждом
+    вопросе. single: прежняя раскладка - инструкция и контекст в одном
+    системном сообщении, вопрос отдельно.
+    """
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Unknown PROMPT_LAYOUT {layout!r}, expected one of {', '.join(PROMPT_LAYOUTS)}")
+    if layout == "single":
+        return [
+            {"role": "system", "content": build_system_prompt(context, sources)},
+            {"role": "user", "content": question},
+        ]
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{build_context_block(context, sources)}\n\n### Вопрос:\n{question}"},
+    ]
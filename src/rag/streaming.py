@@ -0,0 +1,86 @@
+import json
+import os
+import time
+from typing import AsyncIterator, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LLM_STREAM = os.getenv("LLM_STREAM", "true").lower() == "true"
+# Telegram ограничивает частоту правок сообщения, чаще раза в секунду не правим
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+TELEGRAM_MAX_LENGTH = 4096
+CURSOR = " ▌"  # Признак, что ответ ещё печатается
+
+def parse_sse_line(line: str) -> Optional[str]:
+    """
+    Текст из строки SSE потока /chat/completions
+
+    Returns:
+        Фрагмент ответа ("" для служебных строк) или None в конце потока
+    """
+    line = line.strip()
+    if not line.startswith("data:"):
+        return ""
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None
+    try:
+        choice = json.loads(data)["choices"][0]
+    except (ValueError, KeyError, IndexError):
+        return ""
+    return (choice.get("delta") or {}).get("content") or ""
+
+async def iter_sse_text(lines: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Фрагменты ответа из потока строк (response.content у aiohttp)"""
+    async for raw in lines:
+        text = parse_sse_line(raw.decode("utf-8", errors="replace"))
+        if text is None:
+            return
+        if text:
+            yield text
+
+class ProgressiveEditor:
+    """
+    Показывает ответ по мере генерации, правя одно сообщение.
+
+    Правки идут не чаще interval секунд; последний текст, не успевший
+    попасть в сообщение, дописывает финальная правка вызывающего кода.
+    Ошибки правки (например, лимиты Telegram) не прерывают генерацию.
+    Запоминает время первой видимой правки - время до первого токена,
+    которое видит пользователь (от started, по умолчанию - от создания).
+    """
+
+    def __init__(self, edit, interval: float = STREAM_EDIT_INTERVAL, clock=time.perf_counter,
+                 started: float = None):
+        self.edit = edit
+        self.interval = interval
+        self.clock = clock
+        self.started = clock() if started is None else started
+        self.first_edit_at = None
+        self.edits = 0
+        self._last_edit = None
+        self._shown = ""
+
+    async def update(self, text: str):
+        now = self.clock()
+        if not text.strip() or text == self._shown:
+            return
+        if self._last_edit is not None and now - self._last_edit < self.interval:
+            return
+        self._last_edit = now
+        self._shown = text
+        try:
+            await self.edit(text[:TELEGRAM_MAX_LENGTH - len(CURSOR)] + CURSOR)
+        except Exception as e:
+            print(f"[STREAM] Edit failed: {str(e)}")
+            return
+        self.edits += 1
+        if self.first_edit_at is None:
+            self.first_edit_at = now
+
+    @property
+    def time_to_first_edit(self) -> Optional[float]:
+        """Секунды от начала до первого видимого фрагмента"""
+        return None if self.first_edit_at is None else self.first_edit_at - self.started
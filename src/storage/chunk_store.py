@@ -0,0 +1,150 @@
+import mmap
+import os
+import threading
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+CHUNKS_DIR = Path(__file__).resolve().parent
+OFFSET_DTYPE = np.dtype("<i8")
+# Сколько раз refresh перечитывает файлы, если их подменили между чтениями
+REFRESH_ATTEMPTS = 3
+
+class ChunkStore:
+    """
+    Хранилище текстов чанков в двух файлах вместо файла на чанк.
+
+    chunks.bin - упакованные подряд тексты в UTF-8, chunks.offsets - массив
+    int64 с концом каждой записи. Номер записи (record_id) служит и ID
+    вектора в FAISS индексе. Хранилище только дописывается: изменённый
+    чанк получает новую запись, старая остаётся мусором до полной
+    перестройки (reset). Чтение идёт через mmap, текст декодируется
+    только для запрошенных записей.
+    """
+
+    def __init__(self, directory=CHUNKS_DIR, name: str = "chunks"):
+        self.directory = Path(directory)
+        self.blob_path = self.directory / f"{name}.bin"
+        self.offsets_path = self.directory / f"{name}.offsets"
+        self._lock = threading.Lock()
+        self._blob = None
+        self._offsets = np.empty(0, dtype=OFFSET_DTYPE)
+        self.refresh()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def refresh(self):
+        """
+        Перечитывает файлы (после дописывания другим процессом)
+
+        Тексты отображаются в память сразу вместе со смещениями, чтобы оба
+        всегда относились к одной версии файлов: после reset в другом
+        процессе старые смещения не попадут на новый файл текстов.
+        """
+        with self._lock:
+            self._close_blob()
+            for _ in range(REFRESH_ATTEMPTS):
+                offsets = self._read_offsets()
+                blob = self._map_blob()
+                need = int(offsets[-1]) if len(offsets) else 0
+                if (len(blob) if blob is not None else 0) >= need:
+                    self._offsets, self._blob = offsets, blob
+                    return
+                # Между чтениями файлы подменили (reset): читаем заново
+                if blob is not None:
+                    blob.close()
+            raise RuntimeError(f"Файлы {self.blob_path} и {self.offsets_path} не согласованы")
+
+    def _read_offsets(self):
+        if not self.offsets_path.exists():
+            return np.empty(0, dtype=OFFSET_DTYPE)
+        # Неполная запись в конце файла (сбой при дописывании) отбрасывается
+        count = self.offsets_path.stat().st_size // OFFSET_DTYPE.itemsize
+        if not count:
+            return np.empty(0, dtype=OFFSET_DTYPE)
+        return np.memmap(self.offsets_path, dtype=OFFSET_DTYPE, mode="r", shape=(count,))
+
+    def _map_blob(self):
+        """mmap файла текстов, None для пустого или отсутствующего файла"""
+        try:
+            with open(self.blob_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def _close_blob(self):
+        if self._blob is not None:
+            self._blob.close()
+            self._blob = None
+
+    def get(self, record_id: int) -> str:
+        """Текст записи по её номеру"""
+        with self._lock:
+            end = int(self._offsets[record_id])
+            start = int(self._offsets[record_id - 1]) if record_id > 0 else 0
+            if end == start:
+                return ""
+            return self._blob[start:end].decode("utf-8")
+
+    def get_many(self, record_ids) -> List[str]:
+        return [self.get(int(i)) for i in record_ids]
+
+    def append(self, texts: List[str]) -> List[int]:
+        """
+        Дописывает тексты и возвращает номера новых записей
+
+        Сначала пишутся тексты, потом смещения: читатель никогда не увидит
+        смещение, указывающее на ещё не записанные данные.
+        """
+        if not texts:
+            return []
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            first = len(self._offsets)
+            end = int(self._offsets[-1]) if first else 0
+
+            ends = []
+            with open(self.blob_path, "ab") as f:
+                # Хвост от прерванной записи перезаписываем
+                f.truncate(end)
+                for text in texts:
+                    data = text.encode("utf-8")
+                    f.write(data)
+                    end += len(data)
+                    ends.append(end)
+
+            with open(self.offsets_path, "ab") as f:
+                f.truncate(first * OFFSET_DTYPE.itemsize)
+                f.write(np.array(ends, dtype=OFFSET_DTYPE).tobytes())
+
+        self.refresh()
+        return list(range(first, first + len(texts)))
+
+    def reset(self):
+        """
+        Очищает хранилище для полной перестройки
+
+        Файлы подменяются новыми, а не обрезаются: другие процессы до своего
+        refresh продолжают читать прежние тексты из старых файлов, которые
+        у них отображены в память.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._close_blob()
+            for path in (self.blob_path, self.offsets_path):
+                tmp = path.with_suffix(path.suffix + ".tmp")
+                tmp.write_bytes(b"")
+                os.replace(tmp, path)
+        self.refresh()
+
+    def size_bytes(self) -> int:
+        return int(self._offsets[-1]) if len(self._offsets) else 0
+
+    def close(self):
+        with self._lock:
+            self._close_blob()
+            self._offsets = np.empty(0, dtype=OFFSET_DTYPE)
@@ -0,0 +1,294 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+STORAGE_DIR = Path(__file__).resolve().parent
+DB_PATH = STORAGE_DIR / "documents.db"
+# Старый формат метаданных загрузки, импортируется при первом открытии базы
+LEGACY_URL_MAPPING = STORAGE_DIR / "files" / "url_mapping.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    url TEXT PRIMARY KEY,           -- URL из sources.txt
+    final_url TEXT,                 -- URL после редиректов
+    filename TEXT,                  -- Имя сохранённого HTML файла
+    status TEXT NOT NULL DEFAULT 'new',  -- Последний пройденный этап: fetched / parsed / chunked / indexed / failed
+    http_status INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,              -- sha256 HTML
+    text_hash TEXT,                 -- sha256 извлечённого текста
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_documents_filename ON documents (filename);
+CREATE INDEX IF NOT EXISTS idx_documents_final_url ON documents (final_url);
+
+-- Чанки, которые сейчас выдаёт чанкер
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id TEXT PRIMARY KEY,      -- {имя документа}_chunk{номер}
+    filename TEXT NOT NULL,         -- HTML файл документа
+    position INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    record_id INTEGER               -- Номер записи текста в ChunkStore
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_filename ON chunks (filename);
+
+-- Векторы, которые сейчас лежат в FAISS индексе
+CREATE TABLE IF NOT EXISTS vectors (
+    vector_id INTEGER PRIMARY KEY,  -- Совпадает с record_id чанка
+    chunk_id TEXT NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_vectors_chunk_id ON vectors (chunk_id);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+DOCUMENT_FIELDS = ("url", "final_url", "filename", "status", "http_status",
+                   "etag", "last_modified", "content_hash", "text_hash")
+
+class DocumentStore:
+    """
+    Хранилище метаданных пайплайна на SQLite (режим WAL).
+
+    Хранит загруженные документы (URL, конечный URL, статус, валидаторы
+    кэша, хэши содержимого), чанки и соответствие векторов FAISS чанкам.
+    Все поиски идут по индексам, пакетные записи - одной транзакцией.
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._conn.commit()
+
+        if self.path == DB_PATH and LEGACY_URL_MAPPING.exists() and self.count_documents() == 0:
+            self.import_url_mapping(LEGACY_URL_MAPPING)
+
+    def _migrate(self):
+        """Дополняет таблицы баз, созданных предыдущими версиями"""
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(chunks)")}
+        if "record_id" not in columns:
+            # Чанки из файлов без record_id будут заново разбиты чанкером
+            self._conn.execute("ALTER TABLE chunks ADD COLUMN record_id INTEGER")
+
+    @contextmanager
+    def transaction(self):
+        """Группирует записи в одну транзакцию"""
+        with self._lock:
+            try:
+                yield self._conn
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Документы ---
+
+    def upsert_documents(self, rows: Iterable[dict]):
+        """
+        Добавляет или обновляет документы пакетом
+
+        Args:
+            rows: Словари с ключом url и любыми полями из DOCUMENT_FIELDS;
+                отсутствующие поля сохраняют прежние значения
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            for row in rows:
+                fields = [f for f in DOCUMENT_FIELDS if f in row and f != "url"]
+                updates = ", ".join(f"{f} = excluded.{f}" for f in [*fields, "updated_at"])
+                columns = ", ".join(["url", *fields, "updated_at"])
+                placeholders = ", ".join("?" * (len(fields) + 2))
+                conn.execute(
+                    f"INSERT INTO documents ({columns}) VALUES ({placeholders}) "
+                    f"ON CONFLICT(url) DO UPDATE SET {updates}",
+                    [row["url"], *(row[f] for f in fields), now]
+                )
+
+    def update_by_filename(self, rows: Iterable[dict]):
+        """Обновляет поля документов, найденных по имени HTML файла"""
+        now = time.time()
+        with self.transaction() as conn:
+            for row in rows:
+                fields = [f for f in DOCUMENT_FIELDS if f in row and f not in ("url", "filename")]
+                assignments = ", ".join(f"{f} = ?" for f in fields)
+                conn.execute(
+                    f"UPDATE documents SET {assignments}, updated_at = ? WHERE filename = ?",
+                    [*(row[f] for f in fields), now, row["filename"]]
+                )
+
+    def get_document(self, url: str) -> Optional[dict]:
+        """Документ по исходному URL"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM documents WHERE url = ?", (url,)).fetchone()
+        return dict(row) if row else None
+
+    def get_by_filename(self, filename: str) -> Optional[dict]:
+        """Документ по имени HTML файла"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM documents WHERE filename = ? ORDER BY updated_at DESC LIMIT 1",
+                (filename,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def url_by_filename(self) -> Dict[str, str]:
+        """Маппинг HTML файл -> конечный URL для всех скачанных документов"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename, final_url FROM documents "
+                "WHERE filename IS NOT NULL AND final_url IS NOT NULL ORDER BY updated_at"
+            ).fetchall()
+        return {row["filename"]: row["final_url"] for row in rows}
+
+    def count_documents(self, status: Optional[str] = None) -> int:
+        with self._lock:
+            if status is None:
+                return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM documents WHERE status = ?", (status,)
+            ).fetchone()[0]
+
+    def import_url_mapping(self, path: Path):
+        """Импорт url_mapping.json из старой версии загрузчика"""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                url_mapping = json.load(f)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"[DB] Skipping invalid {path.name}: {str(e)}")
+            return
+
+        rows = []
+        for filename, entry in url_mapping.items():
+            if isinstance(entry, str):
+                entry = {"original_url": entry, "final_url": entry}
+            rows.append({
+                "url": entry.get("original_url") or entry.get("final_url"),
+                "final_url": entry.get("final_url"),
+                "filename": filename,
+                "status": "fetched",
+                "etag": entry.get("etag"),
+                "last_modified": entry.get("last_modified")
+            })
+        self.upsert_documents(rows)
+        print(f"[DB] Imported {len(rows)} documents from {path.name}")
+
+    # --- Чанки ---
+
+    def replace_chunks(self, filename: str, chunks: List[dict]) -> List[str]:
+        """
+        Заменяет набор чанков документа
+
+        Args:
+            filename: HTML файл документа
+            chunks: Словари с chunk_id, position, content_hash, record_id
+
+        Returns:
+            ID чанков документа, которых больше нет
+        """
+        with self.transaction() as conn:
+            old_ids = {row[0] for row in conn.execute(
+                "SELECT chunk_id FROM chunks WHERE filename = ?", (filename,)
+            )}
+            new_ids = {c["chunk_id"] for c in chunks}
+            stale = sorted(old_ids - new_ids)
+            conn.executemany("DELETE FROM chunks WHERE chunk_id = ?", [(c,) for c in stale])
+            conn.executemany(
+                "INSERT INTO chunks (chunk_id, filename, position, content_hash, record_id) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(chunk_id) DO UPDATE SET filename = excluded.filename, "
+                "position = excluded.position, content_hash = excluded.content_hash, "
+                "record_id = excluded.record_id",
+                [(c["chunk_id"], filename, c["position"], c["content_hash"], c["record_id"])
+                 for c in chunks]
+            )
+        return stale
+
+    def document_chunks(self, filename: str) -> Dict[str, dict]:
+        """Чанки документа: chunk_id -> {"hash": хэш текста, "record_id": запись в ChunkStore}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id, content_hash, record_id FROM chunks WHERE filename = ?", (filename,)
+            ).fetchall()
+        return {row["chunk_id"]: {"hash": row["content_hash"], "record_id": row["record_id"]}
+                for row in rows}
+
+    def all_chunks(self) -> List[dict]:
+        """Все текущие чанки в порядке документов"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id, filename, position, content_hash, record_id FROM chunks "
+                "ORDER BY filename, position"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count_chunks(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def clear_chunks(self):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM chunks")
+
+    # --- Векторы FAISS ---
+
+    def indexed_vectors(self) -> Dict[str, dict]:
+        """Проиндексированные чанки: chunk_id -> {"id": ID вектора, "hash": хэш текста}"""
+        with self._lock:
+            rows = self._conn.execute("SELECT vector_id, chunk_id, content_hash FROM vectors").fetchall()
+        return {row["chunk_id"]: {"id": row["vector_id"], "hash": row["content_hash"]} for row in rows}
+
+    def count_vectors(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def update_vectors(self, added: List[tuple], removed: List[int]):
+        """
+        Фиксирует изменения индекса одной транзакцией
+
+        Args:
+            added: Кортежи (vector_id, chunk_id, content_hash)
+            removed: ID удалённых из индекса векторов
+        """
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM vectors WHERE vector_id = ?", [(i,) for i in removed])
+            conn.executemany(
+                "INSERT OR REPLACE INTO vectors (vector_id, chunk_id, content_hash) VALUES (?, ?, ?)",
+                added
+            )
+
+    def clear_vectors(self):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM vectors")
+
+    # --- Настройки ---
+
+    def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_settings(self, values: Dict[str, str]):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [(k, str(v)) for k, v in values.items()]
+            )
@@ -1,9 +1,15 @@
+import json
 import pytest
 import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from src.ingestion.parser import extract_text_from_html
-from src.ingestion.chunker import chunk_text
+from src.ingestion.chunker import chunk_structured, chunk_text, count_tokens, split_into_chunks
 from src.rag.response_formatter import add_html_links
+from src.storage.chunk_store import ChunkStore
+from src.storage.db import DocumentStore
 import asyncio
 
 def test_html_parsing():
@@ -29,6 +35,45 @@ def test_html_parsing():
     assert "Футер" not in result  # Должен быть удален
     assert "alert" not in result  # Скрипт должен быть удален
 
+@pytest.mark.parametrize(
+    "html_file", sorted((Path(__file__).parent / "data" / "pages").glob("*.html")),
+    ids=lambda p: p.stem
+)
+def test_html_parsing_golden(html_file):
+    """Сверка извлечённого текста с эталоном для сохранённых страниц."""
+    html = html_file.read_text(encoding="utf-8")
+    expected = html_file.with_suffix(".txt").read_text(encoding="utf-8")
+    assert extract_text_from_html(html) == expected
+
+def test_parallel_parse_and_chunk(tmp_path, monkeypatch):
+    """Тест многопроцессного парсинга и чанкинга: результат как у эталона."""
+    import shutil
+    from src.ingestion import parser, chunker
+
+    pages_dir = Path(__file__).parent / "data" / "pages"
+    for html_file in pages_dir.glob("*.html"):
+        shutil.copy(html_file, tmp_path / html_file.name)
+    monkeypatch.setattr(parser, "BASE_DIR", tmp_path)
+    monkeypatch.setattr(chunker, "TXT_DIR", tmp_path)
+    store = DocumentStore(tmp_path / "documents.db")
+
+    parser.process_all_html(store, workers=2)
+    for html_file in pages_dir.glob("*.html"):
+        expected = html_file.with_suffix(".txt").read_text(encoding="utf-8")
+        assert (tmp_path / html_file.name).with_suffix(".txt").read_text(encoding="utf-8") == expected
+
+    chunk_store = ChunkStore(tmp_path)
+    chunker.process_all_txt(store, workers=2, chunk_store=chunk_store)
+    chunks = store.all_chunks()
+    assert [c["chunk_id"] for c in chunks] == ["eora.ru_cases_kazanexpress_chunk0", "eora.ru_cases_lamoda_chunk0"]
+    for c in chunks:
+        expected = (pages_dir / c["filename"]).with_suffix(".txt").read_text(encoding="utf-8")
+        assert chunk_store.get(c["record_id"]) == split_into_chunks(expected)[0]
+
+    # Повторный запуск без изменений не дописывает хранилище
+    chunker.process_all_txt(store, workers=2, chunk_store=chunk_store)
+    assert len(chunk_store) == 2
+
 def test_chunking():
     """Тест разбиения текста на чанки."""
     text = "Это длинный текст, который должен быть разбит на несколько чанков для обработки."
@@ -40,6 +85,26 @@ def test_chunking():
     # Проверяем что есть перекрытие между чанками
     assert chunks[0][-5:] in chunks[1]  # Последние 5 символов первого чанка должны быть в начале второго
 
+def test_structured_chunking():
+    """Тест чанкера по абзацам: бюджет токенов, целые слова, заголовки при своём тексте."""
+    paragraph = "Мы обучили нейросеть выделять на фото отдельные предметы одежды. " * 3
+    text = "\n".join(["Lamoda", paragraph, "Результат", paragraph, "KazanExpress", paragraph])
+
+    chunks = chunk_structured(text, max_tokens=60, overlap_tokens=0)
+    assert len(chunks) > 1
+    assert all(count_tokens(c) <= 60 for c in chunks)
+    # Заголовок начинает чанк, а не висит в конце предыдущего
+    for heading in ("Результат", "KazanExpress"):
+        assert any(c.startswith(heading) for c in chunks)
+        assert not any(c.endswith(heading) for c in chunks)
+    # Слова не разрезаются: чанки склеиваются обратно в исходный текст
+    assert " ".join(" ".join(chunks).split()) == " ".join(text.split())
+
+    # Перекрытие - целые предложения с конца предыдущего чанка
+    overlapped = chunk_structured(paragraph * 4, max_tokens=60, overlap_tokens=20)
+    first_tail = overlapped[0].split("\n")[-1]
+    assert overlapped[1].startswith(first_tail)
+
 def test_response_formatting():
     """Тест форматирования ответа с ссылками."""
     answer = "Мы разработали систему для Lamoda [1] и KazanExpress [2]"
@@ -86,5 +151,1021 @@ async def test_hallucination_detection():
     result = await detect_hallucinations(answer, context)
     assert result == False
 
+
+def test_grounding_checker():
+    """Проверка ответа по сигнатурам чанков: IDF-вес, слова вне корпуса, фразы неопределённости."""
+    from src.embeddings.lexical import LexicalIndex, build_lexical_index, tokenize
+    from src.rag.grounding import GroundingChecker
+
+    texts = [
+        "Для Dodo Pizza разработали чат-бота, который принимает заказы пиццы",
+        "Для KazanExpress сделали поиск товаров по фотографии покупателя",
+        "Голосовой ассистент для банка отвечает клиентам круглосуточно",
+    ]
+    lexical = LexicalIndex(build_lexical_index([0, 1, 2], texts))
+    # Сигнатура чанка - его термины из прямого индекса BM25
+    assert sorted(lexical.chunk_terms([1]).tolist()) == sorted(lexical.vocab[t] for t in set(tokenize(texts[1])))
+    assert set(lexical.chunk_terms([0, 1]).tolist()) == {lexical.vocab[t] for t in tokenize(texts[0] + " " + texts[1])}
+    assert lexical.chunk_terms([7]) is None
+
+    checker = GroundingChecker(threshold=0.5)
+    grounded = "Для KazanExpress разработали поиск товаров по фотографиям покупателей"
+    invented = "Для Сбербанка внедрили блокчейн платформу учёта кредитных договоров"
+    assert checker.score(grounded, lexical=lexical, chunk_ids=[1]) > 0.8
+    assert checker.score(grounded, lexical=lexical, chunk_ids=[0]) < checker.score(grounded, lexical=lexical, chunk_ids=[1])
+    assert checker.score(invented, lexical=lexical, chunk_ids=[0, 1, 2]) == 0.0
+    assert not checker.is_hallucination(grounded, lexical=lexical, chunk_ids=[1])
+    assert checker.is_hallucination(invented, lexical=lexical, chunk_ids=[1])
+
+    # Без индекса сигнатура строится по тексту контекста; результат не зависит от порядка слов
+    assert checker.score(grounded, context=texts[1]) == checker.score(" ".join(reversed(grounded.split())), context=texts[1])
+    assert not checker.is_hallucination(grounded, context=texts[1])
+    assert checker.is_hallucination(invented, context=texts[1])
+    assert checker.is_hallucination("Честно говоря, я НЕ УВЕРЕН, что у нас был такой проект", context=texts[1])
+    assert not checker.is_hallucination(invented + " [1]", context=texts[1])
+    assert not checker.is_hallucination("Нет такого кейса", context=texts[1])
+
+def _write_index(tmp_path, vectors, texts):
+    """Записывает маленький FAISS индекс, метаданные и тексты во временную папку."""
+    import os
+    import faiss
+    import numpy as np
+    from src.embeddings.indexer import save_metadata
+
+    ids = ChunkStore(tmp_path).append(texts)
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(len(vectors[0])))
+    index.add_with_ids(np.array(vectors, dtype="float32"), np.array(ids, dtype="int64"))
+    # Как и IndexWriter, подменяем файл: поверх отображённого в память писать нельзя
+    faiss.write_index(index, str(tmp_path / "index.tmp"))
+    os.replace(tmp_path / "index.tmp", tmp_path / "index.faiss")
+    save_metadata(tmp_path / "meta.npy", {i: f"https://eora.ru/{text}" for i, text in zip(ids, texts)})
+
+def test_search_engine_hot_swap(tmp_path):
+    """Тест резидентного поиска и подмены индекса при изменении файлов."""
+    import os
+    import numpy as np
+    from src.embeddings.indexer import SearchEngine
+
+    _write_index(tmp_path, [[0.0, 0.0], [1.0, 1.0]], ["a", "b"])
+    engine = SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy")
+
+    assert engine.load()
+    assert engine.generation == 1
+    # Метаданные отображены из файла, а не скопированы в память процесса
+    assert isinstance(engine._state[1], np.memmap)
+    [hit] = engine.search_vector([0.9, 0.9], top_k=1)
+    assert (hit["id"], hit["text"], hit["url"]) == (1, "b", "https://eora.ru/b")
+    assert hit["distance"] == pytest.approx(0.02) and hit["score"] == pytest.approx(-0.02)
+    # top_k больше размера индекса не должен давать ссылок на -1
+    assert len(engine.search_vector([0.0, 0.0], top_k=5)) == 2
+
+    # Повторная загрузка без изменений файлов не перечитывает индекс
+    assert engine.load()
+    assert engine.generation == 1
+
+    _write_index(tmp_path, [[5.0, 5.0]], ["c"])
+    future = 2_000_000_000
+    os.utime(tmp_path / "index.faiss", (future, future))
+
+    # Поколение возвращается вместе с результатами, по которым его нашли
+    [hits], _, generation = engine.search_vectors([[0.0, 0.0]], top_k=1, return_snapshot=True)
+    assert [r["text"] for r in hits] == ["c"]
+    assert generation == engine.generation == 2
+
+def test_index_generation_stamp(tmp_path, monkeypatch):
+    """Индекс и метаданные из разных сохранений не загружаются; векторы без документа не выдаются."""
+    import os
+    import faiss
+    import numpy as np
+    from src.embeddings import indexer
+
+    monkeypatch.setattr(indexer, "INDEX_PATH", tmp_path / "index.faiss")
+    monkeypatch.setattr(indexer, "META_PATH", tmp_path / "meta.npy")
+    ids = ChunkStore(tmp_path).append(["a", "b", "c"])
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(2))
+    index.add_with_ids(np.array([[0.0, 0.0], [1.0, 1.0], [2.0, 2.0]], dtype="float32"), np.array(ids))
+    urls = {i: f"https://eora.ru/{t}" for i, t in zip(ids, "abc")}
+
+    # Вектор 2 есть в индексе, но не в doc_of: в выдачу он не попадает
+    indexer._save_index(index, {0: urls[0], 1: urls[1]})
+    stamp = indexer.read_stamp(tmp_path / "index.faiss")
+    assert stamp is not None and stamp == indexer.read_stamp(tmp_path / "meta.npy")
+    engine = indexer.SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy")
+    hits = engine.search_vector([2.0, 2.0], top_k=3)
+    assert [(r["id"], r["url"]) for r in hits] == [(1, urls[1]), (0, urls[0])]
+
+    # Метаданные уже нового сохранения, индекс ещё старый - работаем с прежним набором
+    indexer.save_metadata(tmp_path / "meta.npy", urls, stamp + 1)
+    future = 2_000_000_000
+    os.utime(tmp_path / "meta.npy", (future, future))
+    assert engine.load() and engine.generation == 1
+    indexer._save_index(index, urls)
+    assert [r["id"] for r in engine.search_vector([2.0, 2.0], top_k=1)] == [2]
+    assert engine.generation == 2
+
+def test_search_many(tmp_path, monkeypatch):
+    """Тест пакетного поиска: результаты выровнены по запросам."""
+    from src.embeddings import indexer
+
+    _write_index(tmp_path, [[0.0, 0.0], [1.0, 1.0]], ["a", "b"])
+    engine = indexer.SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy")
+
+    calls = []
+    def fake_embeddings(texts):
+        calls.append(list(texts))
+        return [[0.9, 0.9] if t == "b?" else [0.1, 0.0] for t in texts]
+    monkeypatch.setattr(indexer, "get_embeddings", fake_embeddings)
+
+    results = engine.search_many(["b?", "a?", "b?"], top_k=1)
+    assert [[r["text"] for r in rows] for rows in results] == [["b"], ["a"], ["b"]]
+    assert calls == [["b?", "a?", "b?"]]
+    query_emb, rows = engine.search_many(["b?"], top_k=1, return_vectors=True)[0]
+    assert query_emb == [0.9, 0.9] and rows == results[0]
+    assert engine.search("a?", top_k=1) == results[1]
+
+    monkeypatch.setattr(indexer, "get_embeddings", lambda texts: [])
+    assert engine.search_many(["x", "y"]) == [[], []]
+    assert engine.search_many(["x"], return_vectors=True) == [(None, [])]
+    assert engine.search_many([]) == []
+
+def test_lexical_search():
+    """Тест BM25: русская морфология через основы, названия клиентов."""
+    from src.embeddings.lexical import LexicalIndex, build_lexical_index, stem_ru, tokenize
+
+    assert stem_ru("кейсами") == stem_ru("кейсы") == "кейс"
+    assert stem_ru("банковских") == stem_ru("банковская")
+    assert tokenize("Что вы делали для Dodo Pizza?") == ["дела", "dodo", "pizza"]
+
+    lexical = LexicalIndex(build_lexical_index([0, 3, 7], [
+        "Для Dodo Pizza сделали бота для заказа пиццы",
+        "Голосовые ассистенты для банков и страховых компаний",
+        "Поиск товаров по фото для KazanExpress",
+    ]))
+    assert lexical.search("кейсы Dodo Pizza", 2)[0].tolist() == [0]
+    assert lexical.search("голосовой ассистент банка", 2)[0].tolist() == [3]
+    assert lexical.search("KazanExpress")[0].tolist() == [7]
+    assert len(lexical.search("погода")[0]) == 0
+
+def test_hybrid_search(tmp_path):
+    """Гибридный поиск находит чанк по названию, даже если вектор далеко."""
+    from src.embeddings.indexer import SearchEngine
+    from src.embeddings.lexical import save_lexical_index
+
+    texts = ["Бот для Dodo Pizza", "Поиск по фото для KazanExpress", "Голосовой ассистент"]
+    _write_index(tmp_path, [[0.0, 0.0], [5.0, 5.0], [1.0, 1.0]], texts)
+    save_lexical_index(tmp_path / "bm25.npz", [0, 1, 2], texts)
+    engine = SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy")
+
+    query = [[0.1, 0.1]]
+    assert [r["text"] for r in engine.search_vectors(query, 1, ["KazanExpress"], mode="vector")[0]] == [texts[0]]
+    assert [r["text"] for r in engine.search_vectors(query, 1, ["KazanExpress"], mode="bm25")[0]] == [texts[1]]
+    hybrid = engine.search_vectors(query, 2, ["KazanExpress"], mode="hybrid")[0]
+    assert {r["text"] for r in hybrid} == {texts[0], texts[1]}
+    # Без текста запроса поиск только векторный
+    assert engine.search_vectors(query, 1)[0][0]["text"] == texts[0]
+    # Индекс BM25 возвращается из того же набора файлов, что и результаты
+    results, lexical, generation = engine.search_vectors(query, 1, ["KazanExpress"], return_snapshot=True)
+    assert lexical is engine.lexical and lexical.chunk_terms([results[0][0]["id"]]) is not None
+
+def test_relevance_cutoff_and_diversity(tmp_path):
+    """Порог расстояния, один чанк на страницу и MMR вместо почти одинаковых чанков."""
+    import faiss
+    import numpy as np
+    from src.embeddings.diversity import mmr_order
+    from src.embeddings.indexer import SearchEngine, save_metadata
+    from src.embeddings.lexical import save_lexical_index
+
+    # Три перекрывающихся чанка страницы a и по одному на страницах b и c
+    vectors = np.array([[1.0, 0.0], [0.99, 0.05], [0.98, 0.1], [0.6, 0.6], [0.0, 3.0]], dtype="float32")
+    texts = ["a1 Dodo", "a2 Dodo", "a3 Dodo", "b", "c"]
+    pages = ["a", "a", "a", "b", "c"]
+    ids = ChunkStore(tmp_path).append(texts)
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(2))
+    index.add_with_ids(vectors, np.array(ids, dtype="int64"))
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    save_metadata(tmp_path / "meta.npy", {i: f"https://eora.ru/{p}" for i, p in zip(ids, pages)})
+    save_lexical_index(tmp_path / "bm25.npz", ids, texts)
+    engine = SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy")
+
+    query = [[1.0, 0.0]]
+    plain = engine.search_vectors(query, 3, diversity="none")[0]
+    assert [r["text"] for r in plain] == ["a1 Dodo", "a2 Dodo", "a3 Dodo"]
+    assert [r["distance"] for r in plain] == sorted(r["distance"] for r in plain)
+    by_url = engine.search_vectors(query, 3, diversity="url")[0]
+    assert [r["url"] for r in by_url] == ["https://eora.ru/a", "https://eora.ru/b", "https://eora.ru/c"]
+    mmr = engine.search_vectors(query, 2, diversity="mmr")[0]
+    assert [r["text"] for r in mmr] == ["a1 Dodo", "b"]
+
+    # Далёкие чанки отсекаются; совсем не по теме - пустой ответ
+    near = engine.search_vectors(query, 5, max_distance=0.2, diversity="none")[0]
+    assert [r["text"] for r in near] == ["a1 Dodo", "a2 Dodo", "a3 Dodo"]
+    assert engine.search_vectors([[-5.0, -5.0]], 3, max_distance=0.2)[0] == []
+    # Порог действует и на кандидатов BM25: расстояние считается по их векторам
+    hybrid = engine.search_vectors([[0.0, 3.0]], 3, ["Dodo"], mode="hybrid", max_distance=0.2)[0]
+    assert [r["text"] for r in hybrid] == ["c"]
+    bm25 = engine.search_vectors(query, 3, ["Dodo"], mode="bm25", diversity="none")[0]
+    assert all(r["distance"] is not None and r["score"] > 0 for r in bm25)
+
+    assert mmr_order([1.0, 0.9, 0.5], [[1, 0], [1, 0], [0, 1]], 2, lam=0.5).tolist() == [0, 2]
+    assert mmr_order([], np.empty((0, 2)), 3).tolist() == []
+    with pytest.raises(ValueError):
+        engine.search_vectors(query, 3, diversity="random")
+
+def test_chunk_store(tmp_path):
+    """Тест хранилища чанков: дописывание, чтение по ID, обрезанный хвост, очистка."""
+    store = ChunkStore(tmp_path)
+    assert store.append(["первый", "", "третий"]) == [0, 1, 2]
+    assert store.append(["четвёртый"]) == [3]
+    assert store.get_many([3, 0, 1]) == ["четвёртый", "первый", ""]
+
+    # Недописанное смещение (сбой при записи) игнорируется и перезаписывается
+    with open(store.offsets_path, "ab") as f:
+        f.write(b"\x01\x02")
+    reopened = ChunkStore(tmp_path)
+    assert len(reopened) == 4
+    assert reopened.append(["пятый"]) == [4]
+    assert ChunkStore(tmp_path).get(4) == "пятый"
+
+    reopened.reset()
+    assert len(reopened) == 0
+    assert reopened.append(["новый"]) == [0]
+
+def test_chunk_store_reset_by_other_reader(tmp_path):
+    """Читатель со старыми смещениями после reset в другом экземпляре читает прежние тексты."""
+    writer = ChunkStore(tmp_path)
+    writer.append(["длинный старый текст", "второй"])
+    reader = ChunkStore(tmp_path)
+
+    # Пустой файл текстов после reset не ломает чтение
+    writer.reset()
+    assert reader.get_many([0, 1]) == ["длинный старый текст", "второй"]
+
+    # Новые тексты не попадают под старые смещения
+    writer.append(["новый"])
+    assert reader.get(0) == "длинный старый текст"
+    reader.refresh()
+    assert len(reader) == 1
+    assert reader.get(0) == "новый"
+
+def test_incremental_build_index(tmp_path, monkeypatch):
+    """Тест инкрементального обновления индекса: векторизуются только изменения."""
+    import faiss
+    import numpy as np
+    from src.embeddings import indexer
+    from src.ingestion.chunker import save_chunks
+
+    embedded = []
+    def fake_embeddings(texts):
+        embedded.extend(texts)
+        return [[float(len(t)), float(t.count("а"))] for t in texts]
+
+    monkeypatch.setattr(indexer, "INDEX_PATH", tmp_path / "index.faiss")
+    monkeypatch.setattr(indexer, "META_PATH", tmp_path / "meta.npy")
+    monkeypatch.setattr(indexer, "get_embeddings", fake_embeddings)
+    store = DocumentStore(tmp_path / "documents.db")
+    store.upsert_documents([{"url": "https://eora.ru/a", "final_url": "https://eora.ru/cases/a",
+                             "filename": "a.html", "status": "chunked"}])
+    chunk_store = ChunkStore(tmp_path)
+
+    save_chunks(store, chunk_store, "a.html", ["первый чанк", "второй чанк"])
+    save_chunks(store, chunk_store, "b.html", ["третий чанк"])
+    indexer.build_index(store=store, chunk_store=chunk_store)
+    assert len(embedded) == 3
+
+    # Повторный запуск без изменений не обращается к модели
+    embedded.clear()
+    indexer.build_index(store=store, chunk_store=chunk_store)
+    assert embedded == []
+
+    # Изменился один чанк, один исчез
+    save_chunks(store, chunk_store, "a.html", ["первый чанк", "изменённый чанк"])
+    save_chunks(store, chunk_store, "b.html", [])
+    indexer.build_index(store=store, chunk_store=chunk_store)
+    assert embedded == ["изменённый чанк"]
+
+    index = faiss.read_index(str(tmp_path / "index.faiss"))
+    doc_of, urls = indexer.load_metadata(tmp_path / "meta.npy")
+    ids = np.flatnonzero(doc_of >= 0)
+    assert index.ntotal == 2
+    assert sorted(chunk_store.get_many(ids)) == ["изменённый чанк", "первый чанк"]
+    assert {urls[i] for i in doc_of[ids]} == {"https://eora.ru/cases/a"}
+    assert store.count_vectors() == 2
+
+    # BM25 перестроен вместе с индексом и знает только живые чанки
+    lexical = indexer.LexicalIndex.load(tmp_path / "bm25.npz")
+    assert sorted(lexical.search("изменённые чанки")[0].tolist()) == sorted(ids.tolist())
+    assert len(lexical.search("третий")[0]) == 0
+
+def test_full_rechunk_then_incremental_index(tmp_path, monkeypatch):
+    """После chunker --full номера записей начинаются заново: индекс перестраивается, векторы не теряются."""
+    import numpy as np
+    from src.embeddings import indexer
+    from src.ingestion import chunker
+
+    monkeypatch.setattr(indexer, "INDEX_PATH", tmp_path / "index.faiss")
+    monkeypatch.setattr(indexer, "META_PATH", tmp_path / "meta.npy")
+    monkeypatch.setattr(indexer, "BATCH_SIZE", 1)  # Каждый чанк - отдельный батч
+    monkeypatch.setattr(indexer, "get_embeddings", lambda texts: [[float(len(t)), 1.0] for t in texts])
+    txt_dir = tmp_path / "txt"
+    txt_dir.mkdir()
+    monkeypatch.setattr(chunker, "TXT_DIR", txt_dir)
+    store = DocumentStore(tmp_path / "documents.db")
+    chunk_store = ChunkStore(tmp_path)
+
+    (txt_dir / "b.txt").write_text("Бот для Dodo Pizza", encoding="utf-8")
+    (txt_dir / "c.txt").write_text("Поиск по фото", encoding="utf-8")
+    chunker.process_all_txt(store, chunk_store=chunk_store)
+    indexer.build_index(store=store, chunk_store=chunk_store)
+
+    # Новый файл в начале списка занимает номер 0, остальные сдвигаются
+    (txt_dir / "a.txt").write_text("Голосовой ассистент", encoding="utf-8")
+    chunker.process_all_txt(store, chunk_store=chunk_store, full=True)
+    indexer.build_index(store=store, chunk_store=chunk_store)
+
+    writer = indexer.IndexWriter(store)
+    doc_of, _ = indexer.load_metadata(tmp_path / "meta.npy")
+    live = np.flatnonzero(doc_of >= 0)
+    assert writer.index.ntotal == store.count_vectors() == len(live) == 3
+    assert sorted(chunk_store.get_many(live)) == ["Бот для Dodo Pizza", "Голосовой ассистент", "Поиск по фото"]
+
+@pytest.mark.parametrize("index_type,metric", [("flat", "cosine"), ("hnsw", "l2"), ("ivf", "l2"), ("ivfpq", "cosine")])
+def test_index_types(tmp_path, monkeypatch, index_type, metric):
+    """Тест типов индекса: добавление, удаление (перестройка HNSW), обучение IVF, поиск."""
+    import numpy as np
+    from src.embeddings import indexer, index_factory
+
+    monkeypatch.setattr(indexer, "INDEX_PATH", tmp_path / "index.faiss")
+    monkeypatch.setattr(indexer, "META_PATH", tmp_path / "meta.npy")
+    monkeypatch.setattr(indexer, "INDEX_TYPE", index_type)
+    monkeypatch.setattr(indexer, "INDEX_METRIC", metric)
+    monkeypatch.setattr(index_factory, "IVF_MIN_TRAIN", 100)
+    monkeypatch.setattr(index_factory, "PQ_NBITS", 4)
+
+    n = 800
+    vectors = np.random.default_rng(0).random((n, 8), dtype=np.float32)
+    ids = ChunkStore(tmp_path).append([f"chunk {i}" for i in range(n)])
+    writer = indexer.IndexWriter(DocumentStore(tmp_path / "documents.db"))
+    writer.add([f"c{i}" for i in ids], ["h"] * n, ids, ["https://eora.ru/x"] * n, vectors)
+    writer.remove(["c0", "c1"])
+    assert writer.save()
+    assert index_factory.index_kind(writer.index) == index_type
+    assert writer.index.ntotal == n - 2
+
+    engine = indexer.SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy")
+    assert engine.search_vector(vectors[5], top_k=1)[0]["text"] == "chunk 5"
+    assert all(r["id"] not in (0, 1) for r in engine.search_vector(vectors[0], top_k=10))
+
+@pytest.mark.parametrize("index_type", ["ivf", "ivfpq"])
+def test_ivf_remove_after_training(tmp_path, monkeypatch, index_type):
+    """Тест IVF: удаления после обучения в нескольких сохранениях подряд."""
+    import numpy as np
+    from src.embeddings import indexer, index_factory
+
+    monkeypatch.setattr(indexer, "INDEX_PATH", tmp_path / "index.faiss")
+    monkeypatch.setattr(indexer, "META_PATH", tmp_path / "meta.npy")
+    monkeypatch.setattr(indexer, "INDEX_TYPE", index_type)
+    monkeypatch.setattr(index_factory, "IVF_MIN_TRAIN", 100)
+    monkeypatch.setattr(index_factory, "PQ_NBITS", 4)
+
+    n = 800
+    vectors = np.random.default_rng(0).random((n, 8), dtype=np.float32)
+    ids = ChunkStore(tmp_path).append([f"chunk {i}" for i in range(n)])
+    store = DocumentStore(tmp_path / "documents.db")
+    writer = indexer.IndexWriter(store)
+    writer.add([f"c{i}" for i in ids], ["h"] * n, ids, ["https://eora.ru/x"] * n, vectors)
+    assert writer.save()
+    assert index_factory.index_kind(writer.index) == index_type
+
+    # Каждое сохранение - новый процесс индексации, читающий индекс с диска
+    for removed in (["c0", "c1"], ["c2", "c3"]):
+        writer = indexer.IndexWriter(store)
+        writer.remove(removed)
+        assert writer.save()
+    assert writer.index.ntotal == n - 4
+
+    engine = indexer.SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy", mmap=True)
+    assert engine.search_vector(vectors[5], top_k=1)[0]["text"] == "chunk 5"
+    assert all(r["id"] > 3 for r in engine.search_vector(vectors[2], top_k=10))
+
+    # Через mmap прямой карты нет: расстояния до кандидатов BM25 - поиском
+    # среди их ID, те же, что по восстановленным векторам без mmap
+    indexer.save_lexical(writer, ChunkStore(tmp_path))
+    assert not index_factory.can_reconstruct(engine._state[0])
+    in_memory = indexer.SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy", mmap=False)
+    found = [engine.search_vectors([vectors[5]], 10, ["chunk"], mode="hybrid", diversity=diversity)[0]
+             for diversity in ("none", "mmr")]
+    expected = in_memory.search_vectors([vectors[5]], 10, ["chunk"], mode="hybrid", diversity="none")[0]
+    assert len(found[0]) == 10 and len(found[1]) > 0
+    assert [r["id"] for r in found[0]] == [r["id"] for r in expected]
+    assert np.allclose([r["distance"] for r in found[0]], [r["distance"] for r in expected], rtol=1e-3)
+
+def test_embedding_cache(tmp_path, monkeypatch):
+    """Тест кэша эмбеддингов: к модели уходят только промахи, работает LRU."""
+    from src.embeddings import provider
+    from src.embeddings.cache import EmbeddingCache
+
+    requested = []
+    def fake_request(texts):
+        requested.append(list(texts))
+        return [[float(len(t)), 1.0] for t in texts]
+
+    cache = EmbeddingCache(tmp_path / "cache.sqlite", max_entries=3)
+    monkeypatch.setattr(provider, "_cache", cache)
+    monkeypatch.setattr(provider, "request_embeddings", fake_request)
+
+    assert provider.get_embeddings(["один", "два", "один"]) == [[4.0, 1.0], [3.0, 1.0], [4.0, 1.0]]
+    assert requested == [["один", "два"]]
+
+    # Повторный запрос целиком из кэша, новый текст - отдельным запросом
+    assert provider.get_embeddings(["два", "три"]) == [[3.0, 1.0], [3.0, 1.0]]
+    assert requested[1:] == [["три"]]
+    assert cache.stats()["hits"] == 1
+
+    # Переполнение вытесняет давно не использованный "один"
+    provider.get_embeddings(["четыре"])
+    assert len(cache) == 3
+    assert cache.get_many(provider.EMBED_MODEL or "", ["один"]) == [None]
+
+def test_embedding_cache_shared_file(tmp_path):
+    """Два процесса с одним файлом кэша: размер не расходится, попадания не пишут в базу."""
+    from src.embeddings.cache import EmbeddingCache
+
+    bot = EmbeddingCache(tmp_path / "cache.sqlite", max_entries=3)
+    indexer = EmbeddingCache(tmp_path / "cache.sqlite", max_entries=3)
+    for text in ("a", "b"):
+        bot.put_many("m", [text], [[1.0]])
+    for text in ("c", "d"):
+        indexer.put_many("m", [text], [[1.0]])
+    # Вытеснен самый старый "a", хотя бот сам добавил только две записи
+    assert len(bot) == len(indexer) == 3
+    assert bot.stats()["entries"] == 3
+
+    changes = bot._conn.total_changes
+    assert [v is not None for v in bot.get_many("m", ["a", "b"])] == [False, True]
+    assert bot._conn.total_changes == changes
+    # Накопленное попадание "b" учитывается при следующем вытеснении
+    bot.put_many("m", ["e"], [[5.0]])
+    assert len(indexer) == 3
+    assert [v is not None for v in indexer.get_many("m", ["b", "c", "d", "e"])] == [True, False, True, True]
+
+def test_local_embedder(tmp_path, monkeypatch):
+    """Тест локального бэкенда: батчи по длине, float32 в исходном порядке."""
+    import numpy as np
+    from src.embeddings import provider
+    from src.embeddings.local_backend import LocalEmbedder
+
+    class FakeModel:
+        def __init__(self):
+            self.batches = []
+        def get_sentence_embedding_dimension(self):
+            return 2
+        def encode(self, texts, **kwargs):
+            self.batches.append(list(texts))
+            return np.array([[len(t), 1.0] for t in texts], dtype=np.float64)
+
+    model = FakeModel()
+    embedder = LocalEmbedder("fake", model=model, batch_size=2)
+    texts = ["aa", "aaaaa", "a", "aaaa"]
+    vectors = embedder.encode(texts)
+
+    assert vectors.dtype == np.float32
+    assert vectors[:, 0].tolist() == [2.0, 5.0, 1.0, 4.0]
+    assert model.batches == [["aaaaa", "aaaa"], ["aa", "a"]]
+
+    # provider с EMBED_BACKEND=local отдаёт матрицу, в том числе из кэша
+    from src.embeddings.cache import EmbeddingCache
+    monkeypatch.setattr(provider, "EMBED_BACKEND", "local")
+    monkeypatch.setattr(provider, "get_local_embedder", lambda name: embedder)
+    monkeypatch.setattr(provider, "_cache", EmbeddingCache(tmp_path / "cache.sqlite"))
+    for _ in range(2):
+        result = provider.get_embeddings(["abc", "ab"])
+        assert isinstance(result, np.ndarray) and result.dtype == np.float32
+        assert result[:, 0].tolist() == [3.0, 2.0]
+    assert len(model.batches) == 3
+
+    # Асинхронный вариант считает модель и ходит в кэш в переданном пуле
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    threads = []
+    model.encode = lambda texts, **kwargs: (threads.append(threading.current_thread().name),
+                                            np.ones((len(texts), 2)))[1]
+    with ThreadPoolExecutor(1, thread_name_prefix="search") as executor:
+        result = asyncio.run(provider.get_embeddings_async(["abcd", "ab"], None, executor))
+    assert result[:, 0].tolist() == [1.0, 2.0] and threads[0].startswith("search")
+
+def test_query_batcher():
+    """Тест микробатчинга: одновременные запросы уходят к модели одним вызовом."""
+    from src.embeddings.batcher import QueryBatcher
+
+    calls = []
+    def fake_embed(texts):
+        calls.append(list(texts))
+        if "сбой" in texts:
+            return []
+        return [[float(len(t))] for t in texts]
+
+    async def scenario():
+        batcher = QueryBatcher(fake_embed, window_ms=20, max_items=3)
+        first = await asyncio.gather(*(batcher.submit(t) for t in ["а", "бб", "а"]))
+        second = await asyncio.gather(*(batcher.submit(t) for t in ["ввв", "гггг"]))
+        failed = await batcher.submit("сбой")
+        return batcher, first, second, failed
+
+    batcher, first, second, failed = asyncio.run(scenario())
+    assert first == [[1.0], [2.0], [1.0]]
+    assert second == [[3.0], [4.0]]
+    assert failed is None
+    # Полный батч уходит сразу, повторы текста не пересчитываются
+    assert calls == [["а", "бб"], ["ввв", "гггг"], ["сбой"]]
+
+    stats = batcher.stats()
+    assert stats["batches"] == 3 and stats["items"] == 6 and stats["max_batch"] == 3
+    assert stats["queue_p99_ms"] >= stats["queue_p50_ms"] >= 0
+
+def test_answer_cache(monkeypatch):
+    """Тест кэша ответов: сходство запроса, те же чанки, TTL, LRU и смена поколения."""
+    from src.rag import answer_cache
+    from src.rag.answer_cache import AnswerCache
+
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache.time, "monotonic", lambda: now[0])
+    cache = AnswerCache(threshold=0.9, ttl=60, max_entries=2)
+
+    cache.put([1.0, 0.0], [3, 5], 1, "<b>Dodo</b>", "HTML")
+    assert cache.get([0.99, 0.05], [3, 5], 1) == ("<b>Dodo</b>", "HTML")
+    # Похожий запрос, но другой контекст, и непохожий запрос - промахи
+    assert cache.get([0.99, 0.05], [3, 7], 1) is None
+    assert cache.get([0.0, 1.0], [3, 5], 1) is None
+
+    cache.put([0.0, 1.0], [1], 1, "второй", None)
+    cache.get([1.0, 0.0], [3, 5], 1)
+    cache.put([0.7, 0.7], [2], 1, "третий", None)
+    # Вытеснен давно не использованный "второй"
+    assert len(cache) == 2 and cache.get([0.0, 1.0], [1], 1) is None
+
+    now[0] += 61
+    assert cache.get([1.0, 0.0], [3, 5], 1) is None and len(cache) == 0
+
+    cache.put([1.0, 0.0], [3, 5], 1, "ответ", None)
+    assert cache.get([1.0, 0.0], [3, 5], 2) is None and len(cache) == 0
+    assert cache.stats()["hits"] == 2 and cache.stats()["hit_rate"] == 2 / 7
+
+def test_streaming_edits():
+    """Тест потокового ответа: разбор SSE и правки не чаще интервала."""
+    from src.rag.streaming import CURSOR, ProgressiveEditor, iter_sse_text, parse_sse_line
+
+    assert parse_sse_line('data: {"choices": [{"delta": {"content": "При"}}]}') == "При"
+    assert parse_sse_line('data: {"choices": [{"delta": {"role": "assistant"}}]}') == ""
+    assert parse_sse_line(": keep-alive") == ""
+    assert parse_sse_line("data: [DONE]") is None
+
+    async def lines():
+        for piece in ["При", "вет", ", мир"]:
+            yield f'data: {{"choices": [{{"delta": {{"content": "{piece}"}}}}]}}\n'.encode()
+        yield b"data: [DONE]\n"
+        yield b'data: {"choices": [{"delta": {"content": "lost"}}]}\n'
+
+    now = [0.0]
+    edits = []
+    async def edit(text):
+        edits.append(text)
+
+    async def scenario():
+        editor = ProgressiveEditor(edit, interval=1.0, clock=lambda: now[0])
+        answer = ""
+        async for piece in iter_sse_text(lines()):
+            now[0] += 0.6
+            answer += piece
+            await editor.update(answer)
+        return editor, answer
+
+    editor, answer = asyncio.run(scenario())
+    assert answer == "Привет, мир"
+    # Первый фрагмент показывается сразу, следующий - только через интервал
+    assert edits == ["При" + CURSOR, "Привет, мир" + CURSOR]
+    assert editor.time_to_first_edit == pytest.approx(0.6)
+
+def test_pack_context():
+    """Контекст в бюджете токенов: целые предложения, нумерация по попавшим источникам."""
+    from src.rag.prompt_builder import build_system_prompt, pack_context
+
+    chunks = [
+        {"id": 0, "text": "Для Dodo Pizza сделали бота. Бот принимает заказы.\nИ считает бонусы.",
+         "url": "https://eora.ru/a"},
+        {"id": 1, "text": "Очень длинный чанк " * 50, "url": "https://eora.ru/long"},
+        {"id": 2, "text": "Поиск по фото для KazanExpress.", "url": "https://eora.ru/b"},
+        {"id": 3, "text": "Ещё про Dodo Pizza.", "url": "https://eora.ru/a"},
+    ]
+    context, sources, tokens, packed = pack_context(chunks, budget=52, count=count_tokens)
+    # Длинный чанк не влез ни одним предложением и не занял номер
+    assert sources == ["https://eora.ru/a", "https://eora.ru/b"]
+    assert context.split("\n---\n") == [
+        "[1] Для Dodo Pizza сделали бота. Бот принимает заказы.\nИ считает бонусы.",
+        "[2] Поиск по фото для KazanExpress.",
+        "[1] Ещё про Dodo Pizza.",
+    ]
+    assert tokens == count_tokens(context) <= 52
+    assert packed == [0, 2, 3]
+
+    # Не влезающий чанк режется по границе предложения, лучший чанк попадает всегда
+    # Обрезанные чанки не попадают в ID, по сигнатурам которых проверяется ответ
+    context, sources, tokens, packed = pack_context(chunks, budget=14, count=count_tokens)
+    assert context == "[1] Для Dodo Pizza сделали бота." and sources == ["https://eora.ru/a"]
+    assert packed == []
+    context, _, tokens, _ = pack_context(chunks[1:2], budget=8, count=count_tokens)
+    assert context.startswith("[1] Очень длинный") and tokens <= 8
+    assert pack_context([], count=count_tokens) == ("", [], 0, [])
+
+    # Длинный чанк режется за логарифмическое число вызовов токенизатора
+    calls = []
+    def counting(text):
+        calls.append(text)
+        return count_tokens(text)
+    context, _, tokens, _ = pack_context([{"text": "Короткое предложение. " * 400, "url": ""}],
+                                         budget=300, count=counting)
+    assert 290 < tokens <= 300 and context.endswith(".") and len(calls) < 30
+
+    prompt = build_system_prompt(context, sources)
+    assert prompt.endswith(context) and "[1] https://eora.ru/a" in prompt
+
+def test_prompt_layout():
+    """Неизменная инструкция - отдельное первое сообщение, одинаковое во всех запросах."""
+    from src.rag.prompt_builder import SYSTEM_PROMPT, build_messages, build_system_prompt
+
+    first = build_messages("Что сделали для Dodo?", "[1] Бот для Dodo", ["https://eora.ru/a"], layout="prefix")
+    second = build_messages("А для Lamoda?", "[1] Рекомендации", ["https://eora.ru/b"], layout="prefix")
+    assert first[0] == second[0] == {"role": "system", "content": SYSTEM_PROMPT}
+    assert first[1]["role"] == "user"
+    assert first[1]["content"].startswith("### Источники:\n[1] https://eora.ru/a")
+    assert first[1]["content"].endswith("### Вопрос:\nЧто сделали для Dodo?")
+
+    # Прежняя раскладка: всё в системном сообщении
+    single = build_messages("Вопрос", "контекст", ["https://eora.ru/a"], layout="single")
+    assert single == [{"role": "system", "content": build_system_prompt("контекст", ["https://eora.ru/a"])},
+                      {"role": "user", "content": "Вопрос"}]
+    assert single[0]["content"].startswith(SYSTEM_PROMPT)
+    with pytest.raises(ValueError):
+        build_messages("Вопрос", "", [], layout="middle")
+
+def test_generation_limiter():
+    """Тест очереди генераций: порядок, позиции в очереди, быстрый отказ."""
+    from src.rag.limiter import GenerationLimiter, QueueFullError
+
+    async def scenario():
+        limiter = GenerationLimiter(max_active=1, max_queue=2, max_wait=5)
+        order, positions = [], {"b": [], "c": []}
+
+        async def job(name, hold):
+            async def on_position(position):
+                positions[name].append(position)
+            async with limiter.slot(on_position=on_position):
+                order.append(name)
+                await hold.wait()
+
+        holds = {name: asyncio.Event() for name in "abc"}
+        tasks = [asyncio.create_task(job(name, holds[name])) for name in "abc"]
+        await asyncio.sleep(0.01)
+        assert limiter.stats()["active"] == 1 and limiter.queued == 2
+
+        # Очередь полна - отказ сразу, без ожидания
+        try:
+            await limiter.acquire()
+            assert False, "expected QueueFullError"
+        except QueueFullError:
+            pass
+
+        for name in "abc":
+            holds[name].set()
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+
+        # Долгое ожидание тоже превращается в отказ
+        limiter.max_wait = 0.01
+        await limiter.acquire()
+        try:
+            await limiter.acquire()
+            assert False, "expected QueueFullError"
+        except QueueFullError:
+            pass
+        limiter.release()
+        return limiter, order, positions
+
+    limiter, order, positions = asyncio.run(scenario())
+    assert order == ["a", "b", "c"]
+    assert positions == {"b": [1, 0], "c": [2, 1, 0]}
+    # Завершённые задачи уведомлений не копятся
+    assert not limiter._notifications
+    assert limiter.stats() == {"active": 0, "queued": 0, "granted": 4, "rejected": 2,
+                               "max_wait_s": limiter.max_wait_seen}
+
+def test_document_store(tmp_path):
+    """Тест базы документов: частичные обновления и поиск по индексам."""
+    store = DocumentStore(tmp_path / "documents.db")
+    store.upsert_documents([{"url": "https://eora.ru/x", "final_url": "https://eora.ru/cases/x",
+                             "filename": "x.html", "status": "fetched", "etag": '"1"'}])
+    # Обновление статуса не затирает остальные поля
+    store.upsert_documents([{"url": "https://eora.ru/x", "status": "not_modified"}])
+    store.update_by_filename([{"filename": "x.html", "status": "parsed", "text_hash": "abc"}])
+
+    doc = store.get_document("https://eora.ru/x")
+    assert doc["status"] == "parsed"
+    assert doc["etag"] == '"1"'
+    assert store.url_by_filename() == {"x.html": "https://eora.ru/cases/x"}
+
+    chunks = [{"chunk_id": f"x_chunk{i}", "position": i, "content_hash": str(i), "record_id": i}
+              for i in range(3)]
+    assert store.replace_chunks("x.html", chunks) == []
+    assert store.replace_chunks("x.html", chunks[:1]) == ["x_chunk1", "x_chunk2"]
+    assert store.count_chunks() == 1
+    assert store.document_chunks("x.html") == {"x_chunk0": {"hash": "0", "record_id": 0}}
+
+PAGE_DELAY = 0.05  # Имитация задержки ответа сайта
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Отдаёт страницы с ETag и отвечает 304 на условные запросы."""
+
+    def do_GET(self):
+        time.sleep(PAGE_DELAY)
+        etag = f'"{self.path}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f"<html><body><p>Страница {self.path}</p></body></html>".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    request_queue_size = 64  # Иначе параллельные подключения упираются в backlog
+
+@pytest.fixture
+def stub_server():
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+@pytest.mark.asyncio
+async def test_concurrent_fetch_throughput(stub_server, tmp_path):
+    """Параллельная загрузка заметно быстрее последовательной."""
+    from src.ingestion.fetcher import Fetcher
+
+    urls = [f"{stub_server}/cases/{i}" for i in range(20)]
+
+    serial_dir = tmp_path / "serial"
+    serial_dir.mkdir()
+    start = time.perf_counter()
+    await Fetcher(DocumentStore(serial_dir / "documents.db"), serial_dir, concurrency=1, per_host=1).fetch_all(urls)
+    serial_time = time.perf_counter() - start
+
+    concurrent_dir = tmp_path / "concurrent"
+    concurrent_dir.mkdir()
+    start = time.perf_counter()
+    stats = await Fetcher(DocumentStore(concurrent_dir / "documents.db"), concurrent_dir,
+                          concurrency=10, per_host=10).fetch_all(urls)
+    concurrent_time = time.perf_counter() - start
+
+    print(f"serial {len(urls) / serial_time:.1f} pages/s, "
+          f"concurrent {len(urls) / concurrent_time:.1f} pages/s")
+    assert stats["fetched"] == len(urls)
+    assert len(list(concurrent_dir.glob("*.html"))) == len(urls)
+    assert concurrent_time < serial_time / 2
+
+@pytest.mark.asyncio
+async def test_conditional_refetch(stub_server, tmp_path):
+    """Повторный обход отправляет условные запросы и пропускает 304."""
+    from src.ingestion.fetcher import Fetcher
+
+    urls = [f"{stub_server}/cases/{i}" for i in range(3)]
+    store = DocumentStore(tmp_path / "documents.db")
+
+    stats = await Fetcher(store, tmp_path).fetch_all(urls)
+    assert stats["fetched"] == 3
+    assert all(store.get_document(url)["etag"] for url in urls)
+
+    stats = await Fetcher(store, tmp_path).fetch_all(urls)
+    assert stats == {"fetched": 0, "not_modified": 3, "failed": 0}
+    assert all(store.get_document(url)["http_status"] == 304 for url in urls)
+    assert store.count_documents("fetched") == 3
+
+@pytest.mark.asyncio
+async def test_streaming_pipeline_resumes(stub_server, tmp_path, monkeypatch):
+    """Пайплайн индексирует страницы, а повторный запуск пропускает неизменённые."""
+    from src.embeddings import indexer
+    from src.ingestion import pipeline
+
+    embedded = []
+    def fake_embeddings(texts):
+        embedded.extend(texts)
+        return [[float(len(t)), 1.0] for t in texts]
+
+    monkeypatch.setattr(indexer, "INDEX_PATH", tmp_path / "index.faiss")
+    monkeypatch.setattr(indexer, "META_PATH", tmp_path / "meta.npy")
+    monkeypatch.setattr(pipeline, "get_embeddings", fake_embeddings)
+
+    urls = [f"{stub_server}/cases/{i}" for i in range(5)]
+    store = DocumentStore(tmp_path / "documents.db")
+
+    chunk_store = ChunkStore(tmp_path)
+    await pipeline.Pipeline(store, tmp_path, workers=2, chunk_store=chunk_store).run(urls)
+    assert len(embedded) == 5
+    assert store.count_documents("indexed") == 5
+    doc_of, indexed_urls = indexer.load_metadata(tmp_path / "meta.npy")
+    assert sorted(indexed_urls) == sorted(urls)
+    assert sorted(chunk_store.get_many(range(len(chunk_store)))) == sorted(embedded)
+
+    # Все страницы ответят 304 и уже проиндексированы - модель не вызывается
+    embedded.clear()
+    run = pipeline.Pipeline(store, tmp_path, workers=2, chunk_store=chunk_store)
+    await run.run(urls)
+    assert embedded == []
+    assert run.skipped == 5
+    assert run.writer.index.ntotal == 5
+
+class LLMStubHandler(BaseHTTPRequestHandler):
+    """OpenAI-совместимый сервер: /models, /embeddings, /chat/completions (в т.ч. поток)."""
+
+    def _reply(self, body: bytes, content_type: str = "application/json"):
+        if self.server.failing:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.server.hits += 1
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(b'{"data": [{"id": "stub"}]}')
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        name = self.server.name
+        if self.path.endswith("/embeddings"):
+            data = [{"embedding": [float(len(t)), 1.0]} for t in payload["input"]]
+            self._reply(json.dumps({"data": data}).encode())
+        elif payload.get("stream"):
+            events = [f'data: {json.dumps({"choices": [{"delta": {"content": piece}}]})}\n\n'
+                      for piece in ("Ответ ", name)]
+            self._reply("".join(events + ["data: [DONE]\n\n"]).encode(), "text/event-stream")
+        else:
+            body = {"choices": [{"message": {"content": f"Ответ {name}"}}]}
+            self._reply(json.dumps(body).encode())
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def llm_stubs():
+    """Фабрика заглушек LM Studio: llm_stubs(name) -> сервер с .url, .failing, .hits"""
+    servers = []
+
+    def start(name: str):
+        server = StubServer(("127.0.0.1", 0), LLMStubHandler)
+        server.name, server.failing, server.hits = name, False, 0
+        server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def _dead_url():
+    """Адрес, на котором никто не слушает"""
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1"
+
+def test_least_outstanding_routing():
+    """Запрос уходит на сервер с наименьшим числом запросов в работе."""
+    from src.rag.backends import BackendPool
+
+    pool = BackendPool(["http://a/v1", "http://b/v1", "http://c/v1"])
+    first, second, third = pool.acquire(), pool.acquire(), pool.acquire()
+    assert {first.url, second.url, third.url} == {"http://a/v1", "http://b/v1", "http://c/v1"}
+
+    pool.release(second, ok=True)
+    assert pool.acquire() is second
+    assert [b["outstanding"] for b in pool.stats()] == [1, 1, 1]
+
+def test_failover_and_circuit_breaker(llm_stubs):
+    """Отказавшие серверы отключаются, после паузы получают пробный запрос."""
+    from src.rag.backends import BackendPool, BackendUnavailableError
+
+    good, bad = llm_stubs("good"), llm_stubs("bad")
+    bad.failing = True
+    now = [0.0]
+    pool = BackendPool([_dead_url(), bad.url, good.url], failures=2, cooldown=30, clock=lambda: now[0])
+
+    for _ in range(4):
+        response = pool.post_sync("/embeddings", {"input": ["abc"]}, timeout=5)
+        assert response.json()["data"][0]["embedding"] == [3.0, 1.0]
+    assert good.hits == 4
+    assert [b["healthy"] for b in pool.stats()] == [False, False, True]
+    # Отключённые серверы больше не получают запросов
+    assert [b["requests"] for b in pool.stats()] == [2, 2, 4]
+
+    # После паузы пробный запрос к поднявшемуся серверу возвращает его в работу
+    bad.failing = False
+    now[0] += 31
+    for _ in range(2):
+        pool.post_sync("/embeddings", {"input": ["abc"]}, timeout=5)
+    assert bad.hits >= 1
+    assert [b["healthy"] for b in pool.stats()] == [False, True, True]
+
+    good.failing = bad.failing = True
+    with pytest.raises(BackendUnavailableError):
+        pool.post_sync("/embeddings", {"input": ["abc"]}, timeout=5)
+
+@pytest.mark.asyncio
+async def test_async_streaming_and_health_checks(llm_stubs):
+    """Поток генерации через пул и возврат сервера проверкой здоровья."""
+    import aiohttp
+    from src.rag.backends import BackendPool
+    from src.rag.streaming import iter_sse_text
+
+    good, bad = llm_stubs("good"), llm_stubs("bad")
+    bad.failing = True
+    pool = BackendPool([bad.url, good.url], failures=1, cooldown=300)
+
+    async with aiohttp.ClientSession() as session:
+        async with pool.post(session, "/chat/completions", {"stream": True}) as response:
+            pieces = [piece async for piece in iter_sse_text(response.content)]
+        assert "".join(pieces) == "Ответ good"
+        assert [b["healthy"] for b in pool.stats()] == [False, True]
+
+        bad.failing = False
+        await pool.check_health(session)
+        assert [b["healthy"] for b in pool.stats()] == [True, True]
+        assert [b["outstanding"] for b in pool.stats()] == [0, 0]
+
+def test_provider_embeddings_through_pool(llm_stubs, monkeypatch):
+    """Эмбеддинги LM Studio идут через общий пул серверов."""
+    from src.embeddings import provider
+    from src.rag.backends import BackendPool
+
+    good = llm_stubs("good")
+    pool = BackendPool([_dead_url(), good.url])
+    monkeypatch.setattr(provider, "get_pool", lambda: pool)
+    monkeypatch.setattr(provider, "EMBED_BACKEND", "lmstudio")
+
+    assert provider.request_embeddings(["ab", "abcd"]) == [[2.0, 1.0], [4.0, 1.0]]
+
+@pytest.mark.asyncio
+async def test_async_retriever(llm_stubs, tmp_path, monkeypatch):
+    """Асинхронный поиск: эмбеддинг через пул серверов, FAISS в своём пуле потоков."""
+    import aiohttp
+    import faiss
+    import numpy as np
+    from src.embeddings import provider
+    from src.embeddings.indexer import SearchEngine, save_metadata
+    from src.embeddings.retrieval import AsyncRetriever
+    from src.rag.backends import BackendPool
+
+    ids = ChunkStore(tmp_path).append(["two", "four"])
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(2))
+    index.add_with_ids(np.array([[2.0, 1.0], [4.0, 1.0]], dtype="float32"), np.array(ids, dtype="int64"))
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    save_metadata(tmp_path / "meta.npy", {i: f"https://eora.ru/{i}" for i in ids})
+
+    good = llm_stubs("good")
+    monkeypatch.setattr(provider, "get_pool", lambda: BackendPool([good.url]))
+    monkeypatch.setattr(provider, "EMBED_BACKEND", "lmstudio")
+    monkeypatch.setattr(provider, "_cache", None)
+    monkeypatch.setattr(provider, "EMBED_CACHE", False)
+
+    async with aiohttp.ClientSession() as session:
+        retriever = AsyncRetriever(SearchEngine(tmp_path / "index.faiss", tmp_path / "meta.npy"),
+                                   lambda: session, workers=1)
+        results = await retriever.search_many(["abcd", "ab"], top_k=1, return_vectors=True)
+        [(_, _, _, generation)] = await retriever.search_many(["ab"], top_k=1, return_snapshot=True)
+        retriever.close()
+
+    assert [(emb, [r["text"] for r in rows]) for emb, rows in results] == [
+        ([4.0, 1.0], ["four"]), ([2.0, 1.0], ["two"])
+    ]
+    # Поколение индекса, по которому шёл поиск, - ключ кэша ответов в боте
+    assert generation == 1
+    stats = retriever.stats()
+    assert stats["calls"] == 2 and stats["queue_depth"] == 0
+    assert stats["total_p50_ms"] >= stats["search_p50_ms"] > 0
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file